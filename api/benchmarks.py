@@ -0,0 +1,517 @@
+from .instrumentation import Tracer
+from .registry import resolving
+from .src import constants
+from .src.variable_configs import VARIABLE_CONFIGS
+from .uploads import wait_for_uploads
+from concurrent.futures import ThreadPoolExecutor
+from dateutil.relativedelta import relativedelta
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from socketserver import ThreadingMixIn
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+import datetime
+import json
+import numpy as np
+import requests
+import threading
+import time
+import zipfile
+
+
+# Offline benchmarks of the batch.
+# Sources are replaced by seeded synthetic generators served from a local http stub,
+# so that hot paths run end to end on sqlite and filesystem storage.
+
+class SyntheticMarket:
+    def __init__(self, n_stocks, starts_on, ends_on, seed=0):
+        rng = np.random.default_rng(seed)
+        self.stock_codes = [f"{100000 + i * 5:06d}" for i in range(n_stocks)]
+        self.markets = ['KOSPI' if i % 2 else 'KOSDAQ' for i in range(n_stocks)]
+        self.days = [
+            starts_on + datetime.timedelta(days=i)
+            for i in range((ends_on - starts_on).days + 1)
+            if (starts_on + datetime.timedelta(days=i)).weekday() < 5
+        ]
+        self.day_to_loc = {dt: i for i, dt in enumerate(self.days)}
+        self.returns = rng.normal(0.0003, 0.02, (len(self.days), n_stocks))
+        self.returns[rng.random(self.returns.shape) < 0.05] = 0
+        self.close = np.maximum(np.round(
+            rng.integers(1000, 100000, n_stocks) * np.cumprod(1 + self.returns, axis=0)
+        ), 1).astype(np.int64)
+        self.shares = rng.integers(10 ** 6, 10 ** 8, n_stocks)
+        self.is_listed = rng.random(self.returns.shape) > 0.01
+
+    def is_monthend(self, date):
+        i = self.day_to_loc[date]
+        return i + 1 == len(self.days) or self.days[i + 1].month != date.month
+
+    def stock_price_records(self, date):
+        i = self.day_to_loc.get(date)
+        if i is None:
+            return list()
+        strdt = date.strftime('%Y%m%d')
+        return [{
+            'basDt': strdt,
+            'srtnCd': code,
+            'isinCd': f"KR{code}",
+            'mrktCtg': self.markets[j],
+            'itmsNm': f"stock{j}",
+            'clpr': str(self.close[i, j]),
+            'vs': '0',
+            'fltRt': f"{self.returns[i, j] * 100:.2f}",
+            'mkp': str(self.close[i, j]),
+            'hipr': str(self.close[i, j]),
+            'lopr': str(self.close[i, j]),
+            'trqu': '1000',
+            'trPrc': str(self.close[i, j] * 1000),
+            'lstgStCnt': str(self.shares[j]),
+            'mrktTotAmt': str(self.close[i, j] * self.shares[j]),
+        } for j, code in enumerate(self.stock_codes) if self.is_listed[i, j]]
+
+    def corp_list_records(self, date):
+        i = self.day_to_loc.get(date)
+        if i is None:
+            return list()
+        strdt = date.strftime('%Y%m%d')
+        return [{
+            'basDt': strdt,
+            'srtnCd': f"A{code}",
+            'isinCd': f"KR{code}",
+            'mrktCtg': self.markets[j],
+            'itmsNm': f"stock{j}",
+            'crno': f"{j:013d}",
+            'corpNm': f"corp{j}",
+        } for j, code in enumerate(self.stock_codes) if self.is_listed[i, j]]
+
+
+class SyntheticOpendart:
+    # quarterly consolidated statements of the market's stocks, one zipfile per (quarter, fs_div)
+    RPT_DIVS = {
+        'BS': '재무상태표, 유동/비유동법-연결재무제표',
+        'PL': '손익계산서, 기능별 분류 - 연결재무제표',
+    }
+    RPT_TYPES = {1: '1분기보고서', 2: '반기보고서', 3: '3분기보고서', 4: '사업보고서'}
+    MARKET_LABELS = {'KOSPI': '유가증권시장상장법인', 'KOSDAQ': '코스닥시장상장법인'}
+
+    def __init__(self, market, account_configs, seed=0):
+        rng = np.random.default_rng(seed + 1)
+        self.market = market
+        self.account_configs = account_configs
+        self.sizes = rng.lognormal(23, 1.5, len(market.stock_codes))
+        self.weights = {conf['name']: rng.uniform(0.05, 1) for conf in account_configs}
+        self.rng = rng
+        self.zipfiles = dict()
+        first = market.days[0]
+        quarter_end = datetime.date(first.year, 3, 31)
+        while quarter_end + datetime.timedelta(days=60) <= market.days[-1]:
+            for fs_div in self.RPT_DIVS.keys():
+                self.add_zipfile(quarter_end, fs_div)
+            quarter_end = quarter_end + relativedelta(months=3, day=31)
+
+    def add_zipfile(self, quarter_end, fs_div):
+        q = quarter_end.month // 3
+        identifier = f"{quarter_end.year}_{q}Q_{fs_div}"
+        last_update = datetime.datetime.combine(quarter_end + datetime.timedelta(days=60), datetime.time(9))
+        text_filename = f"{identifier}_연결_{last_update.strftime('%Y%m%d')}.txt"
+        value_header = constants.OPENDART_TEXTFILE_VALUE_HEADER_MAP['4Q' if q == 4 else f"{q}Q_{fs_div}"]
+        header = list(constants.OPENDART_TEXTFILE_HEADER_INFO.keys()) + [value_header]
+        lines = ['\t'.join(header)]
+        for j, code in enumerate(self.market.stock_codes):
+            for conf in self.account_configs:
+                if conf['fs_div'] != fs_div:
+                    continue
+                value = self.sizes[j] * self.weights[conf['name']] * self.rng.uniform(0.9, 1.1)
+                if fs_div == 'PL':
+                    value = value / 4 * (4 if q == 4 else 1)
+                lines.append('\t'.join([
+                    self.RPT_DIVS[fs_div],
+                    f"[{code}]",
+                    f"corp{j}",
+                    self.MARKET_LABELS[self.market.markets[j]],
+                    '000',
+                    'industry',
+                    '12',
+                    quarter_end.strftime('%Y-%m-%d'),
+                    self.RPT_TYPES[q],
+                    'KRW',
+                    f"ifrs-full_{''.join([x.capitalize() for x in conf['name'].split('_')])}",
+                    conf['name'],
+                    f"{int(value):,}",
+                ]))
+        content = '\r\n'.join(lines + ['']).encode('cp949')
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            # opendart zips file names in cp949 without the utf-8 flag
+            zf.writestr(text_filename.encode('cp949').decode('cp437'), content)
+        self.zipfiles[f"{identifier}_{last_update.strftime('%Y%m%d%H%M%S')}.zip"] = buffer.getvalue()
+
+
+class SourceStub:
+    # local http server answering as data.go.kr and opendart.fss.or.kr,
+    # archives answer Range requests and the first response of each is cut
+    # after drop_ratio of its body if drop_ratio is given, so that downloads resume
+    def __init__(self, market, opendart, drop_ratio=0):
+        self.market = market
+        self.opendart = opendart
+        self.drop_ratio = drop_ratio
+        self.dropped = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.get_handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                if parsed.path.endswith('getStockPriceInfo'):
+                    self.send(stub.openapi_response(stub.market.stock_price_records, params), 'application/json')
+                elif parsed.path.endswith('getItemInfo'):
+                    self.send(stub.openapi_response(stub.market.corp_list_records, params), 'application/json')
+                elif parsed.path.endswith('list.do'):
+                    self.send(stub.opendart_list().encode('utf-8'), 'text/html')
+                elif parsed.path.endswith('downloadFnlttZip.do') and params.get('fl_nm') in stub.opendart.zipfiles:
+                    self.send_archive(params['fl_nm'], stub.opendart.zipfiles[params['fl_nm']])
+                else:
+                    self.send_error(404)
+
+            def send_archive(self, name, body):
+                # result looks like 'bytes=1024-'
+                start = int(self.headers['Range'].split('=')[1].split('-')[0]) if self.headers['Range'] else 0
+                if start >= len(body):
+                    self.send_error(416)
+                    return
+                self.send_response(206 if start > 0 else 200)
+                self.send_header('Content-Type', 'application/zip')
+                self.send_header('Content-Length', str(len(body) - start))
+                if start > 0:
+                    self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+                self.end_headers()
+                with stub.lock:
+                    is_dropped = stub.drop_ratio > 0 and name not in stub.dropped
+                    stub.dropped.add(name)
+                if is_dropped:
+                    self.wfile.write(body[start:start + int((len(body) - start) * stub.drop_ratio)])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body[start:])
+
+            def send(self, body, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                return
+
+        return Handler
+
+    def openapi_response(self, get_records, params):
+        records = get_records(datetime.datetime.strptime(params['basDt'], '%Y%m%d').date())
+        page, rows = int(params.get('pageNo', 1)), int(params.get('numOfRows', 10))
+        return json.dumps({'response': {
+            'header': {'resultCode': '00', 'resultMsg': 'NORMAL SERVICE.'},
+            'body': {
+                'numOfRows': rows,
+                'pageNo': page,
+                'totalCount': len(records),
+                'items': {'item': records[(page - 1) * rows:page * rows]},
+            },
+        }}).encode('utf-8')
+
+    def opendart_list(self):
+        rows = ''.join([
+            f"<tr><td><a href=\"#\" onclick=\"fnDownload('{i}', 'fnltt', '{name}')\">{name}</a></td></tr>"
+            for i, name in enumerate(self.opendart.zipfiles.keys())
+        ])
+        return f"<html><body><table class=\"tb01\">{rows}</table></body></html>"
+
+
+class ApiServer:
+    # local threaded wsgi server of the django application, e.g. the data api
+    def __init__(self):
+        class Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        class Handler(WSGIRequestHandler):
+            def log_message(self, *args):
+                return
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.set_app(WSGIHandler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Cases run in order, each on the outputs of the previous ones.
+
+def load_prices(market, until):
+    spmodel = apps.get_model('api', 'StockPrice')
+    clmodel = apps.get_model('api', 'CorpList')
+    days = [dt for dt in market.days if dt <= until]
+    spmodel.objects.bulk_create([
+        spmodel(date=dt, records=market.stock_price_records(dt), is_monthend=market.is_monthend(dt))
+        for dt in days
+    ], batch_size=100)
+    clmodel.objects.bulk_create([
+        clmodel(date=dt, records=market.corp_list_records(dt))
+        for dt in days
+    ], batch_size=100)
+    apps.get_model('api', 'StockDaily').objects.backfill()
+
+def run_openapi(context):
+    for model_name in ['StockPrice', 'CorpList']:
+        apps.get_model('api', model_name).objects.bulk_sync()
+    wait_for_uploads()
+
+def run_opendart(context):
+    apps.get_model('api', 'OpendartZipfile').objects.bulk_sync(return_status=False)
+    wait_for_uploads()
+
+def run_text_parsing(context):
+    for tf in apps.get_model('api', 'OpendartTextfile').objects.all():
+        tf.get_records()
+
+def run_single_accounts(context):
+    for client in apps.get_model('api', 'SingleAccountClient').objects.all():
+        client.sync_to_sources()
+    wait_for_uploads()
+    for client in apps.get_model('api', 'SingleAccountClient').objects.all():
+        client.query()
+
+def run_variables(context):
+    from .managers import VariableManager
+    VariableManager().bulk_sync(opendart_changed=True)
+    wait_for_uploads()
+
+def run_backtests(context):
+    apps.get_model('api', 'Backtester').objects.bulk_sync(processes=context['processes'])
+    wait_for_uploads()
+
+def run_exports(context):
+    from .managers import VariableManager
+    for var in VariableManager().list():
+        var.file_checksum = None
+        var.write_file()
+    for backtester in apps.get_model('api', 'Backtester').objects.all():
+        backtester.file_checksum = None
+        backtester.write_file()
+    wait_for_uploads()
+
+def time_queries(querysets, repeat=3):
+    started = time.perf_counter()
+    for i in range(repeat):
+        for qs in querysets:
+            list(qs.values_list('id', flat=True))
+    return time.perf_counter() - started
+
+def run_lookups(context):
+    # hot lookups against their former unindexed forms, with query plans
+    from .managers import VariableManager
+    vdmodel = apps.get_model('api', 'VariableData')
+    variables = VariableManager().list()
+    legacy = [vdmodel.objects.filter(variable=var.address) for var in variables]
+    indexed = [var.queryset for var in variables]
+    for backtester in apps.get_model('api', 'Backtester').objects.all():
+        for factor in backtester.list_evaluated_factors():
+            for rbdt in backtester.list_rebalancing_dates():
+                _date = rbdt - relativedelta(months=factor['lookback'])
+                months = 1 if factor['variable']._meta.model.__name__ in ['Size', 'Momentum'] else 3
+                legacy.append(vdmodel.objects.filter(
+                    variable = factor['variable'].address,
+                    date__year = _date.year,
+                    date__month__gt = _date.month - months,
+                    date__month__lte = _date.month
+                ))
+                indexed.append(backtester.get_factor_queryset_formed_on(factor, rbdt))
+    print(f"legacy plan: {legacy[-1].explain()}")
+    print(f"indexed plan: {indexed[-1].explain()}")
+    legacy_seconds = time_queries(legacy)
+    indexed_seconds = time_queries(indexed)
+    print(
+        f"{len(indexed)} lookups, legacy {legacy_seconds:.3f}s, indexed {indexed_seconds:.3f}s "
+        f"({legacy_seconds / max(indexed_seconds, 1e-9):.1f}x faster)"
+    )
+    return {'legacy_seconds': round(legacy_seconds, 4), 'indexed_seconds': round(indexed_seconds, 4)}
+
+def list_api_paths(n_stocks=5):
+    sdmodel = apps.get_model('api', 'StockDaily')
+    stock_codes = list(sdmodel.objects.order_by('stock_code').values_list('stock_code', flat=True).distinct()[:n_stocks])
+    dates = sdmodel.objects.order_by('date').values_list('date', flat=True).distinct()
+    end = dates.last()
+    start = end - relativedelta(years=1)
+    ranges = f"start={start.strftime('%Y%m%d')}&end={end.strftime('%Y%m%d')}"
+    paths = [f"/api/prices?{ranges}&stock_codes={c}" for c in stock_codes]
+    paths.append(f"/api/prices?{ranges}&fields=close,mktcap&format=csv")
+    for model_name in ['Size', 'Momentum', 'AccountRatio', 'PriceRatio']:
+        for var in apps.get_model('api', model_name).objects.all():
+            paths.append(f"/api/variables/{model_name}/{var.id}?{ranges}")
+    for client in apps.get_model('api', 'SingleAccountClient').objects.all()[:2]:
+        paths.append(f"/api/single-accounts/{client.id}?stock_codes={','.join(stock_codes)}")
+    for backtester in apps.get_model('api', 'Backtester').objects.all():
+        paths.append(f"/api/backtesters/{backtester.id}/returns?{ranges}&format=csv")
+    return paths
+
+def run_api(context):
+    # concurrent requests on the data api, cold, served from the response cache and revalidated by etags
+    paths = list_api_paths()
+    n_requests = context.get('api_requests', 200)
+    concurrency = context.get('api_concurrency', 8)
+    caches['api'].clear()
+    measures = dict()
+    with ApiServer() as server, requests.Session() as session:
+        etags = dict()
+
+        def get(path, revalidate):
+            headers = {'If-None-Match': etags[path]} if revalidate else dict()
+            started = time.perf_counter()
+            r = session.get(f"{server.url}{path}", headers=headers)
+            if r.status_code not in [200, 304]:
+                raise Exception(f"{path} answered {r.status_code}.")
+            etags[path] = r.headers['ETag']
+            return time.perf_counter() - started, len(r.content)
+
+        for name, ls_path, revalidate in [
+            ('cold', paths, False),
+            ('cached', [paths[i % len(paths)] for i in range(n_requests)], False),
+            ('revalidated', [paths[i % len(paths)] for i in range(n_requests)], True),
+        ]:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(lambda path: get(path, revalidate), ls_path))
+            seconds = time.perf_counter() - started
+            latencies = np.array([r[0] for r in results]) * 1000
+            measures[f"{name}_rps"] = round(len(results) / seconds, 1)
+            measures[f"{name}_p95_ms"] = round(float(np.percentile(latencies, 95)), 1)
+            print(
+                f"{name:<12} {len(results):>5} requests {len(results) / seconds:>8.1f}/s "
+                f"p50 {np.percentile(latencies, 50):>7.1f}ms p95 {np.percentile(latencies, 95):>7.1f}ms "
+                f"{sum([r[1] for r in results]) / 1e6:>8.2f}MB"
+            )
+    return measures
+
+CASES = [
+    ('openapi', run_openapi),
+    ('opendart', run_opendart),
+    ('text_parsing', run_text_parsing),
+    ('single_accounts', run_single_accounts),
+    ('variables', run_variables),
+    ('backtests', run_backtests),
+    ('exports', run_exports),
+    ('lookups', run_lookups),
+    ('api', run_api),
+]
+
+# Query budgets of cases as (base, per_year, per_openapi_day), whatever the number of stocks,
+# so that queries run per stock, e.g. N+1 lookups in loops, go over budget.
+# Sources grow with years of history and openapi syncs grow with days,
+# and price ratios are written a year at a time.
+QUERY_BUDGETS = {
+    'openapi': (10, 0, 20),
+    'opendart': (50, 80, 0),
+    'text_parsing': (10, 8, 0),
+    'single_accounts': (60, 0, 0),
+    'variables': (500, 12, 0),
+    'backtests': (230, 0, 0),
+    'exports': (200, 0, 0),
+    'lookups': (560, 0, 0),
+    'api': (20, 0, 0),
+}
+
+def get_query_budget(name, years, openapi_days):
+    base, per_year, per_day = QUERY_BUDGETS[name]
+    return base + per_year * years + per_day * openapi_days
+
+def run_benchmarks(n_stocks, years, seed=0, cases=None, **kwargs):
+    # result looks like [{'case', 'seconds', 'queries', 'query_time', ...}, ...]
+    cases = cases or [name for name, func in CASES]
+    openapi_days = kwargs.get('openapi_days', 1)
+    today = datetime.date.today()
+    starts_on = today - relativedelta(years=years)
+    # backtests form portfolios since Backtester.DEFAULT_STARTS_ON on 12 months of prior prices
+    required = apps.get_model('api', 'Backtester')().DEFAULT_STARTS_ON - relativedelta(months=18)
+    if starts_on > required:
+        raise ValueError(f"history should start on {required} at the latest, use more years.")
+    market = SyntheticMarket(n_stocks, starts_on, today, seed=seed)
+    account_configs = VARIABLE_CONFIGS['single_account']
+    opendart = SyntheticOpendart(market, account_configs, seed=seed)
+
+    # prices are preloaded up to the days left for the openapi case
+    preloaded_until = market.days[-openapi_days - 1] if 'openapi' in cases else market.days[-1]
+    load_prices(market, preloaded_until)
+    samodel = apps.get_model('api', 'SingleAccountClient')
+    for conf in account_configs:
+        samodel.objects.get_or_create(
+            fs_div = conf['fs_div'],
+            name = conf['name'],
+            cfs = conf['cfs'],
+            label_en = conf['name'].replace('_', ' '),
+            label_kr = conf['name'],
+        )
+
+    results = list()
+    context = {
+        'processes': kwargs.get('processes', 1),
+        'api_requests': kwargs.get('api_requests', 200),
+        'api_concurrency': kwargs.get('api_concurrency', 8),
+    }
+    # labels prompted on creation of variables are answered by their names
+    answer = lambda prompt: prompt.split(' for ')[-1].rstrip(': ')
+    with SourceStub(market, opendart, drop_ratio=kwargs.get('opendart_drop', 0)) as stub, mock.patch('builtins.input', answer):
+        settings.OPENAPI_URL = stub.url
+        settings.OPENDART_URL = stub.url
+        for name, func in CASES:
+            if name == 'openapi' and name not in cases:
+                continue
+            tracer = Tracer()
+            started = time.perf_counter()
+            # every case resolves variables once, as a batch does
+            with connection.execute_wrapper(tracer.count_query), tracer.span(name) as span, resolving():
+                measures = func(context) or dict()
+            seconds = time.perf_counter() - started
+            if name not in cases:
+                continue
+            results.append({
+                'case': name,
+                'seconds': round(seconds, 4),
+                'queries': span['queries'],
+                'query_time': round(span['query_time'], 4),
+                'query_budget': get_query_budget(name, years, openapi_days),
+                'stocks': n_stocks,
+                'years': years,
+                'seed': seed,
+                **measures,
+            })
+            budget = results[-1]['query_budget']
+            over = f" over budget of {budget}" if span['queries'] > budget else ''
+            print(f"{name:<16} {seconds:>9.3f}s {span['queries']:>8} queries{over}")
+    return results
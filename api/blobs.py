@@ -0,0 +1,98 @@
+import json
+import numpy as np
+import zlib
+
+
+# Compact binary representation of records.
+# A blob is zlib-compressed bytes of a 4-byte header length, a json header
+# describing the columns and the raw little-endian arrays of the columns.
+# String columns are dictionary-encoded: labels in the header, int32 codes in the body,
+# with None kept as a null label after the sorted labels.
+# Float columns keep missing values as nan, int columns with None are masked
+# and their mask follows the values in the body.
+
+def columns_of_records(records):
+    if len(records) == 0:
+        return dict()
+    columns = dict()
+    for name in records[0].keys():
+        values = [r[name] for r in records]
+        is_null = [v is None for v in values]
+        observed = [v for v in values if v is not None]
+        if len(observed) > 0 and all(isinstance(v, str) for v in observed):
+            columns[name] = np.array(values, dtype=object if any(is_null) else str)
+        elif len(observed) > 0 and all(isinstance(v, int) and not isinstance(v, bool) for v in observed):
+            array = np.array([0 if v is None else v for v in values], dtype=np.int64)
+            columns[name] = np.ma.array(array, mask=is_null) if any(is_null) else array
+        else:
+            columns[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return columns
+
+def labels_of(array):
+    is_null = np.array([v is None for v in array], dtype=bool)
+    labels, codes = np.unique(array[~is_null].astype(str), return_inverse=True)
+    labels = labels.tolist()
+    all_codes = np.full(len(array), len(labels), dtype=np.int32)
+    all_codes[~is_null] = codes
+    if is_null.any():
+        labels.append(None)
+    return labels, all_codes
+
+def encode_columns(columns):
+    specs = list()
+    body = list()
+    length = 0
+    for name, array in columns.items():
+        length = len(array)
+        if array.dtype.kind in 'UO':
+            labels, codes = labels_of(array)
+            specs.append({'name': name, 'dtype': '<i4', 'labels': labels})
+            body.append(codes.astype('<i4').tobytes())
+        elif np.ma.is_masked(array):
+            dtype = array.dtype.newbyteorder('<').str
+            specs.append({'name': name, 'dtype': dtype, 'masked': True})
+            body.append(array.filled(0).astype(dtype).tobytes())
+            body.append(np.ma.getmaskarray(array).astype(np.uint8).tobytes())
+        else:
+            dtype = array.dtype.newbyteorder('<').str
+            specs.append({'name': name, 'dtype': dtype})
+            body.append(array.astype(dtype).tobytes())
+    header = json.dumps({'length': length, 'columns': specs}).encode('utf-8')
+    return zlib.compress(len(header).to_bytes(4, 'little') + header + b''.join(body))
+
+def decode_columns(blob):
+    # result looks like {name: np.ndarray, ...}
+    raw = zlib.decompress(blob)
+    header_size = int.from_bytes(raw[:4], 'little')
+    header = json.loads(raw[4:4 + header_size])
+    offset = 4 + header_size
+    columns = dict()
+    for spec in header['columns']:
+        dtype = np.dtype(spec['dtype'])
+        array = np.frombuffer(raw, dtype=dtype, count=header['length'], offset=offset)
+        offset += dtype.itemsize * header['length']
+        if 'labels' in spec:
+            labels = spec['labels']
+            array = np.array(labels, dtype=object if None in labels else str)[array]
+        if spec.get('masked'):
+            mask = np.frombuffer(raw, dtype=np.uint8, count=header['length'], offset=offset)
+            offset += header['length']
+            array = np.ma.array(array, mask=mask.astype(bool))
+        columns[spec['name']] = array
+    return columns
+
+def encode_records(records):
+    return encode_columns(columns_of_records(records))
+
+def decode_records(blob):
+    columns = decode_columns(blob)
+    if len(columns) == 0:
+        return list()
+    values_by_name = dict()
+    for name, array in columns.items():
+        values = array.tolist()
+        if array.dtype.kind == 'f':
+            values = [None if v != v else v for v in values]
+        values_by_name[name] = values
+    names = list(values_by_name.keys())
+    return [dict(zip(names, row)) for row in zip(*values_by_name.values())]
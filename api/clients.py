@@ -1,3 +1,6 @@
+from .instrumentation import traced
+from .responses import get_response_cache
+from .src import constants
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
@@ -5,9 +8,14 @@ from json.decoder import JSONDecodeError
 from time import sleep
 
 import datetime
+import os
+import random
 import requests
+import time
 import xml.etree.ElementTree as XmlParser
 import json
+import zipfile
+import zlib
 
 # Api clients for data.go.kr
 class OpenApiClient:
@@ -41,38 +49,87 @@ class OpenApiClient:
         self.service_key_type = alternative
         return alternative
 
+    @traced
     def query(self, params):
-        res = self.requests(params, total=True)
-        try:
-            d = self.parse_response(res)
-        except OpenApiResponsesXmlError:
-            print('Fail to querying data from open api. Waiting for 5 minutes to try again...')
-            sleep(300)
-            self.query(params)
-        sleep(10)
+        d = self.get_json(self.append_total_count(params))
         return self.get_records(d)
 
     def get_records(self, d):
         return d.get('response').get('body').get('items').get('item')
 
-    def requests(self, params, total=True):
-        if total:
-            _params = self.append_total_count(params)
-            return requests.get(self.endpoint, {**self.base_parameters, **_params})
-        return requests.get(self.endpoint, {**self.base_parameters, **params})
+    def requests(self, params):
+        return requests.get(
+            self.endpoint,
+            {**self.base_parameters, **params},
+            timeout = settings.OPENAPI_TIMEOUT
+        )
+
+    def get_json(self, params):
+        # Transient errors are retried with exponential backoff and jitter until the deadline,
+        # a service key error switches the key type once and other errors fail fast.
+        cache = get_response_cache()
+        d = cache.get(self.name, params)
+        if d is not None:
+            return d
+        breaker = get_circuit_breaker(self.endpoint)
+        deadline = time.monotonic() + settings.OPENAPI_DEADLINE
+        is_switched = False
+        attempt = 0
+        while True:
+            breaker.check()
+            try:
+                res = self.requests(params)
+                if res.status_code >= 500:
+                    raise OpenApiTransientError(res.status_code, res.reason)
+                d = self.parse_response(res)
+            except OpenApiServiceKeyError:
+                if is_switched:
+                    raise
+                is_switched = True
+                print(f"Service key of {self.name} was switched to {self.switch_service_key_type()}.")
+                continue
+            except (OpenApiTransientError, requests.ConnectionError, requests.Timeout) as e:
+                breaker.record_failure()
+                wait = min(settings.OPENAPI_BACKOFF * 2 ** attempt, settings.OPENAPI_BACKOFF_MAX)
+                wait = wait * random.uniform(0.5, 1)
+                attempt += 1
+                if attempt > settings.OPENAPI_RETRIES or time.monotonic() + wait > deadline:
+                    raise
+                print(f"Querying {self.name} failed ({e}), retrying in {wait:.1f}s.")
+                sleep(wait)
+                continue
+            breaker.record_success()
+            cache.put(self.name, params, d)
+            return d
 
     def parse_response(self, response):
         try:
-            return response.json()
+            d = response.json()
         except JSONDecodeError:
-            xml_data = XmlParser.fromstring(response.text)
-            msg = XmlParser.dump(xml_data)
-            raise OpenApiResponsesXmlError(msg)
+            raise self.parse_error(response.text)
+        code = d.get('response', {}).get('header', {}).get('resultCode', '00')
+        kind = constants.OPENAPI_RESULT_CODE_TO_KIND_MAP.get(code, 'fatal')
+        if kind != 'normal':
+            raise OPENAPI_ERROR_CLASSES[kind](code, d['response']['header'].get('resultMsg'))
+        return d
+
+    def parse_error(self, text):
+        # data.go.kr answers errors as xml even if json was requested
+        try:
+            xml_data = XmlParser.fromstring(text)
+        except XmlParser.ParseError:
+            return OpenApiResponsesXmlError(text[:200])
+        code = xml_data.findtext('.//returnReasonCode')
+        if code is None:
+            return OpenApiResponsesXmlError(XmlParser.tostring(xml_data, encoding='unicode'))
+        code = code.strip().zfill(2)
+        msg = xml_data.findtext('.//returnAuthMsg') or xml_data.findtext('.//errMsg')
+        kind = constants.OPENAPI_RESULT_CODE_TO_KIND_MAP.get(code, 'fatal')
+        return OPENAPI_ERROR_CLASSES.get(kind, OpenApiError)(code, msg)
 
     def append_total_count(self, params):
-        _params = {**self.base_parameters, **params, 'pageNo': 1, 'numOfRows': 1}
-        res = self.requests(_params, total=False)
-        d = self.parse_response(res)
+        _params = {**params, 'pageNo': 1, 'numOfRows': 1}
+        d = self.get_json(_params)
         total_count = d.get('response').get('body').get('totalCount')
         return {**params, 'pageNo': 1, 'numOfRows': total_count}
 
@@ -81,13 +138,11 @@ class OpenApiClient:
         dt = today
         while True:
             verifying_params = {
-                **self.base_parameters,
                 'pageNo': 1,
                 'numOfRows': 1,
                 'basDt': dt.strftime('%Y%m%d')
             }
-            res = self.requests(verifying_params, total=False)
-            d = self.parse_response(res)
+            d = self.get_json(verifying_params)
             total_count = d.get('response').get('body').get('totalCount')
             if total_count > 0:
                 break
@@ -98,13 +153,11 @@ class OpenApiClient:
         dt = real_monthend
         while True:
             verifying_params = {
-                **self.base_parameters,
                 'pageNo': 1,
                 'numOfRows': 1,
                 'basDt': dt.strftime('%Y%m%d')
             }
-            res = self.requests(verifying_params, total=False)
-            d = self.parse_response(res)
+            d = self.get_json(verifying_params)
             total_count = d.get('response').get('body').get('totalCount')
             if total_count > 0:
                 break
@@ -116,22 +169,202 @@ class CorpListApiClient(OpenApiClient):
     def __init__(self):
         super().__init__(
             name = 'corp_list',
-            endpoint = 'http://apis.data.go.kr/1160100/service/GetKrxListedInfoService/getItemInfo'
+            endpoint = f"{settings.OPENAPI_URL}/1160100/service/GetKrxListedInfoService/getItemInfo"
         )
 
 class StockPriceApiClient(OpenApiClient):
     def __init__(self):
         super().__init__(
             name = 'stock_prices',
-            endpoint = 'http://apis.data.go.kr/1160100/service/GetStockSecuritiesInfoService/getStockPriceInfo'
+            endpoint = f"{settings.OPENAPI_URL}/1160100/service/GetStockSecuritiesInfoService/getStockPriceInfo"
         )
 
-class OpenApiResponsesXmlError(Exception):
-    def __init__(self, msg):
+class OpenApiError(Exception):
+    def __init__(self, code, msg):
+        self.code = code
         self.msg = msg
 
+    def __str__(self):
+        return f"OpenApi responses {self.code}: {self.msg}"
+
+class OpenApiTransientError(OpenApiError):
+    pass
+
+class OpenApiQuotaError(OpenApiError):
+    pass
+
+class OpenApiServiceKeyError(OpenApiError):
+    pass
+
+class OpenApiCircuitOpenError(OpenApiError):
+    def __str__(self):
+        return f"OpenApi circuit is open: {self.msg}"
+
+class OpenApiResponsesXmlError(OpenApiTransientError):
+    def __init__(self, msg):
+        super().__init__(None, msg)
+
     def __str__(self):
         return f'''
             OpenApi responses the following as xml while requested json:
             {self.msg}
         '''
+
+OPENAPI_ERROR_CLASSES = {
+    'transient': OpenApiTransientError,
+    'quota': OpenApiQuotaError,
+    'service_key': OpenApiServiceKeyError,
+    'fatal': OpenApiError,
+}
+
+
+# Failures of an endpoint are counted across queries,
+# so that an endpoint down for long fails fast until the cooldown is over.
+
+class CircuitBreaker:
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.cooldown:
+            raise OpenApiCircuitOpenError(None, f"{self.name} failed {self.failures} times in a row.")
+        # half open, a trial request decides whether to close again
+        self.opened_at = None
+        self.failures = self.threshold - 1
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+_CIRCUIT_BREAKERS = dict()
+
+def get_circuit_breaker(endpoint):
+    if endpoint not in _CIRCUIT_BREAKERS:
+        _CIRCUIT_BREAKERS[endpoint] = CircuitBreaker(
+            name = endpoint,
+            threshold = settings.OPENAPI_CIRCUIT_THRESHOLD,
+            cooldown = settings.OPENAPI_CIRCUIT_COOLDOWN
+        )
+    return _CIRCUIT_BREAKERS[endpoint]
+
+
+# Downloads of archives of opendart.fss.or.kr.
+# Bodies are streamed in chunks to a partial file named by the archive, whose name changes
+# with its last update, so that a dropped connection or a later run resumes
+# from the bytes received with a Range request instead of from zero.
+# Completed archives are verified by their length and the CRCs of their members.
+
+class OpendartDownloadError(Exception):
+    def __init__(self, filename, msg):
+        self.filename = filename
+        self.msg = msg
+
+    def __str__(self):
+        return f"Downloading {self.filename} failed: {self.msg}"
+
+class OpendartTransientDownloadError(OpendartDownloadError):
+    pass
+
+
+class OpendartDownloader:
+    def __init__(self):
+        self.endpoint = f"{settings.OPENDART_URL}/cmm/downloadFnlttZip.do"
+        self.headers = {
+            'Referer': f"{settings.OPENDART_URL}/disclosureinfo/fnltt/dwld/main.do",
+            'User-Agent':'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.51 Safari/537.36',
+        }
+
+    @traced
+    def download(self, filename):
+        # result is the path of the verified archive
+        os.makedirs(settings.OPENDART_DOWNLOAD_DIR, exist_ok=True)
+        path = os.path.join(settings.OPENDART_DOWNLOAD_DIR, filename)
+        if os.path.exists(path):
+            # verified by a run that stopped before using it
+            return path
+        partial = f"{path}.part"
+        attempt = 0
+        while True:
+            try:
+                self.fetch(filename, partial)
+                break
+            except (
+                OpendartTransientDownloadError,
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError
+            ) as e:
+                wait = min(settings.OPENDART_BACKOFF * 2 ** attempt, settings.OPENDART_BACKOFF_MAX)
+                attempt += 1
+                if attempt > settings.OPENDART_DOWNLOAD_RETRIES:
+                    raise
+                print(f"Downloading {filename} stopped at {self.get_size(partial)} bytes ({e}), resuming in {wait:.1f}s.")
+                sleep(wait)
+        self.verify(filename, partial)
+        os.replace(partial, path)
+        return path
+
+    def fetch(self, filename, partial):
+        received = self.get_size(partial)
+        headers = self.headers.copy()
+        if received > 0:
+            headers['Range'] = f"bytes={received}-"
+        with requests.get(
+            self.endpoint,
+            {'fl_nm': filename},
+            headers = headers,
+            stream = True,
+            timeout = settings.OPENDART_TIMEOUT
+        ) as r:
+            if r.status_code == 416:
+                # nothing left to receive, the partial file is verified as it is
+                return
+            if r.status_code >= 500:
+                raise OpendartTransientDownloadError(filename, f"{r.status_code} {r.reason}")
+            if r.status_code != 200 and r.status_code != 206:
+                raise OpendartDownloadError(filename, f"{r.status_code} {r.reason}")
+            if r.status_code == 206:
+                # result looks like 'bytes 1024-4095/4096'
+                content_range = r.headers.get('Content-Range', '')
+                start = int(content_range.split(' ')[-1].split('-')[0])
+                if start != received:
+                    raise OpendartDownloadError(filename, f"range {content_range} does not follow {received} bytes")
+                total = int(content_range.split('/')[-1])
+                mode = 'ab'
+            else:
+                # ranges are not supported, restarts from zero
+                total = int(r.headers.get('Content-Length', 0))
+                mode = 'wb'
+            with open(partial, mode) as f:
+                for chunk in r.iter_content(chunk_size=settings.OPENDART_DOWNLOAD_CHUNK):
+                    f.write(chunk)
+        # a dropped connection may end a body early without errors
+        if total and self.get_size(partial) < total:
+            raise OpendartTransientDownloadError(filename, f"received {self.get_size(partial)} of {total} bytes")
+
+    def verify(self, filename, partial):
+        try:
+            with zipfile.ZipFile(partial) as zf:
+                bad = zf.testzip()
+        except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+            # members whose compressed data are corrupt fail to decompress instead of their crc
+            bad = str(e)
+        if bad is not None:
+            # corrupt bytes can not be resumed from
+            os.remove(partial)
+            raise OpendartDownloadError(filename, f"archive is corrupt ({bad})")
+
+    def get_size(self, path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
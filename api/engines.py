@@ -0,0 +1,516 @@
+from .src import constants
+
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from dateutil.relativedelta import relativedelta
+
+import datetime
+import multiprocessing
+import numpy as np
+import pandas as pd
+import warnings
+
+
+# Matrix representations of price data used by backtesters.
+# A panel holds one (days x stocks) array per field,
+# with missing observations stored as np.nan.
+# Markets are kept as (days x stocks) int8 codes of market_names, -1 if missing.
+
+class PricePanel:
+    def __init__(self, dates, stock_codes, values, markets=None, market_names=None):
+        self.dates = dates
+        self.stock_codes = stock_codes
+        self.values = values
+        self.markets = markets
+        self.market_names = market_names
+        self.code_to_loc = {c: i for i, c in enumerate(stock_codes)}
+
+    @classmethod
+    def from_price_data(cls, qs_prc, fields):
+        source_names = {v: k for k, v in constants.STOCK_PRICE_DATA_RENAME_MAP.items()}
+        code_key = source_names['stock_code']
+        market_key = source_names['market']
+        objs = sorted(qs_prc, key=lambda obj: obj.date)
+        code_to_loc = dict()
+        market_to_code = dict()
+        columns = list()
+        for obj in objs:
+            locs = [code_to_loc.setdefault(r[code_key], len(code_to_loc)) for r in obj.records]
+            columns.append((locs, obj.records))
+
+        values = dict()
+        for field in fields:
+            key = source_names[field]
+            matrix = np.full((len(objs), len(code_to_loc)), np.nan)
+            for i, (locs, records) in enumerate(columns):
+                matrix[i, locs] = [float(r[key]) for r in records]
+            values[field] = matrix
+        markets = np.full((len(objs), len(code_to_loc)), -1, dtype=np.int8)
+        for i, (locs, records) in enumerate(columns):
+            markets[i, locs] = [
+                market_to_code.setdefault(r[market_key], len(market_to_code))
+                for r in records
+            ]
+        stock_codes = np.array(list(code_to_loc.keys()), dtype=str)
+        market_names = list(market_to_code.keys())
+        return cls([obj.date for obj in objs], stock_codes, values, markets, market_names)
+
+    @classmethod
+    def from_daily_rows(cls, dates, rows, fields):
+        # rows look like [(date, stock_code, market, *fields), ...] ordered by date,
+        # locs of stocks and markets follow their first appearance as in from_price_data
+        date_to_loc = {dt: i for i, dt in enumerate(dates)}
+        code_to_loc = dict()
+        market_to_code = dict()
+        date_locs = list()
+        code_locs = list()
+        market_codes = list()
+        observed = list()
+        for r in rows:
+            date_locs.append(date_to_loc[r[0]])
+            code_locs.append(code_to_loc.setdefault(r[1], len(code_to_loc)))
+            market_codes.append(market_to_code.setdefault(r[2], len(market_to_code)))
+            observed.append(r[3:])
+        observed = np.array(observed, dtype=float).reshape(len(date_locs), len(fields))
+
+        values = dict()
+        for k, field in enumerate(fields):
+            matrix = np.full((len(dates), len(code_to_loc)), np.nan)
+            matrix[date_locs, code_locs] = observed[:, k]
+            values[field] = matrix
+        markets = np.full((len(dates), len(code_to_loc)), -1, dtype=np.int8)
+        markets[date_locs, code_locs] = market_codes
+        stock_codes = np.array(list(code_to_loc.keys()), dtype=str)
+        return cls(list(dates), stock_codes, values, markets, list(market_to_code.keys()))
+
+    def between(self, start_dt, end_dt):
+        i = bisect_left(self.dates, start_dt)
+        j = bisect_right(self.dates, end_dt)
+        values = {k: v[i:j] for k, v in self.values.items()}
+        markets = self.markets[i:j] if self.markets is not None else None
+        return PricePanel(self.dates[i:j], self.stock_codes, values, markets, self.market_names)
+
+    def keep_listed(self, listed_by_date):
+        # drops observations missing in {date: set((stock_code, market), ...)}
+        for i, date in enumerate(self.dates):
+            listed = listed_by_date.get(date, set())
+            is_listed = np.array([
+                m >= 0 and (c, self.market_names[m]) in listed
+                for c, m in zip(self.stock_codes, self.markets[i])
+            ], dtype=bool)
+            for matrix in self.values.values():
+                matrix[i, ~is_listed] = np.nan
+            self.markets[i, ~is_listed] = -1
+        return self
+
+    def lookup(self, field, months, stock_codes, markets, lag=0):
+        # as-of join on integer month keys: the value observed at the
+        # month-end `lag` months after each month, nan if unmatched
+        if len(self.dates) == 0:
+            return np.full(len(months), np.nan)
+        panel_months = np.array([month_key(dt) for dt in self.dates], dtype=np.int64)
+        targets = np.asarray(months, dtype=np.int64) + lag
+        rows = np.minimum(np.searchsorted(panel_months, targets), len(panel_months) - 1)
+        cols = np.array([self.code_to_loc.get(c, -1) for c in stock_codes], dtype=np.int64)
+        market_to_code = {m: i for i, m in enumerate(self.market_names)}
+        market_codes = np.array([market_to_code.get(m, -2) for m in markets], dtype=np.int64)
+        is_matched = cols >= 0
+        is_matched &= panel_months[rows] == targets
+        values = np.full(len(targets), np.nan)
+        rows, cols = rows[is_matched], cols[is_matched]
+        values[is_matched] = np.where(
+            self.markets[rows, cols] == market_codes[is_matched],
+            self.values[field][rows, cols],
+            np.nan
+        )
+        return values
+
+    def locate(self, stock_codes):
+        locs = [self.code_to_loc.get(c) for c in stock_codes]
+        return np.array([loc for loc in locs if loc is not None], dtype=np.int64)
+
+    def membership_matrix(self, entries_by_label, labels):
+        # (stocks x labels) indicator matrix
+        membership = np.zeros((len(self.stock_codes), len(labels)))
+        for j, label in enumerate(labels):
+            membership[self.locate(entries_by_label.get(label, [])), j] = 1
+        return membership
+
+
+# Portfolio formation.
+# Quantile locations are returned as a (stocks x factors) int8 array.
+
+def assign_quantile_locs(ls_records, ls_factors):
+    ls_s = list()
+    for i, (records, factor) in enumerate(zip(ls_records, ls_factors)):
+        data = list(filter(lambda r: r['market'] != 'KONEX', records))
+        dff = pd.DataFrame.from_records(data)
+        dff[i] = pd.qcut(
+            x = dff.value,
+            q = factor['quantiles'],
+            labels = list(range(len(factor['labels'])))
+        )
+        ls_s.append(dff.set_index(['stock_code', 'market'])[i])
+    df = pd.concat(ls_s, axis=1).reset_index().dropna()
+    valcols = list(range(len(ls_s)))
+    for c in valcols:
+        df[c] = df[c].astype(int)
+    return df.stock_code.to_numpy(dtype=str), df[valcols].to_numpy(dtype=np.int8)
+
+
+def group_entries_by_quantile_locs(stock_codes, qlocs):
+    # {qloc: [entry, ...]} for a single factor, {(qloc, ...): [entry, ...]} for more
+    keys, inverse = np.unique(qlocs, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    entries_by_portfolio = dict()
+    for k, key in enumerate(keys):
+        qloc = int(key[0]) if len(key) == 1 else tuple(int(x) for x in key)
+        entries_by_portfolio[qloc] = stock_codes[inverse == k].tolist()
+    return entries_by_portfolio
+
+
+# Inputs shared by forked workers; filled right before the pool starts
+# so that records are inherited instead of pickled for every task.
+_SHARED_INPUTS = dict()
+
+def _assign_quantile_locs_on_shared_inputs(task):
+    key, ls_ids, ls_factors = task
+    records_by_id = _SHARED_INPUTS['records_by_id']
+    ls_records = [
+        [r for id in ids for r in records_by_id[id]]
+        for ids in ls_ids
+    ]
+    return key, assign_quantile_locs(ls_records, ls_factors)
+
+
+def assign_quantile_locs_in_parallel(tasks, records_by_id, processes):
+    # tasks look like [(key, [[variable_data_id, ...], ...], factors), ...]
+    _SHARED_INPUTS['records_by_id'] = records_by_id
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=processes, mp_context=ctx) as executor:
+            return dict(executor.map(_assign_quantile_locs_on_shared_inputs, tasks))
+    finally:
+        _SHARED_INPUTS.clear()
+
+
+# Momentum over a dense (months x stocks) price matrix.
+# Every window is a difference of one cumulative sum of log returns,
+# and a window touching a missing month is missing.
+
+def momentum_values(prices, windows):
+    # result looks like {(near, far): (months x stocks) gross return
+    # from the end of month t-far to the end of month t-near+1}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ln_prices = np.log(prices)
+    ln_ri = np.full(prices.shape, np.nan)
+    ln_ri[1:] = ln_prices[1:] - ln_prices[:-1]
+    is_valid = ~np.isnan(ln_ri)
+    zeros = np.zeros((1, prices.shape[1]))
+    cum_ln_ri = np.vstack([zeros, np.cumsum(np.where(is_valid, ln_ri, 0), axis=0)])
+    cum_count = np.vstack([zeros, np.cumsum(is_valid, axis=0)])
+
+    result = dict()
+    for near, far in windows:
+        values = np.full(prices.shape, np.nan)
+        t = np.arange(far - 1, prices.shape[0])
+        hi = t - near + 2
+        lo = t - far + 1
+        is_full = (cum_count[hi] - cum_count[lo]) == (far - near + 1)
+        values[t] = np.where(is_full, np.exp(cum_ln_ri[hi] - cum_ln_ri[lo]), np.nan)
+        values[np.isnan(prices)] = np.nan
+        result[(near, far)] = values
+    return result
+
+
+# Factor panels and parametric sweeps.
+# Months are addressed by integer keys (year * 12 + month - 1).
+
+def month_key(date):
+    return date.year * 12 + date.month - 1
+
+
+def month_keys_of_strdates(strdates):
+    # 'YYYYMMDD' strings to month keys without parsing dates
+    d = np.asarray(strdates).astype(np.int64)
+    return (d // 10000) * 12 + (d // 100 % 100) - 1
+
+
+class FactorPanel:
+    def __init__(self, months, stock_codes, values):
+        self.months = months
+        self.stock_codes = stock_codes
+        self.values = values
+
+    @classmethod
+    def from_variable_data(cls, qs_data):
+        objs = sorted(qs_data, key=lambda obj: obj.date)
+        if len(objs) == 0:
+            return cls(np.array([], dtype=np.int64), np.array([], dtype=str), np.empty((0, 0)))
+        first = month_key(objs[0].date)
+        months = np.arange(first, month_key(objs[-1].date) + 1)
+        code_to_loc = dict()
+        cells = list()
+        for obj in objs:
+            columns = obj.get_columns()
+            if len(columns) == 0:
+                continue
+            values = columns['value'].astype(float)
+            is_valid = (columns['market'] != 'KONEX') & ~np.isnan(values)
+            locs = [code_to_loc.setdefault(c, len(code_to_loc)) for c in columns['stock_code'][is_valid].tolist()]
+            cells.append((month_key(obj.date) - first, locs, values[is_valid]))
+        values = np.full((len(months), len(code_to_loc)), np.nan)
+        for i, locs, v in cells:
+            values[i, locs] = v
+        return cls(months, np.array(list(code_to_loc.keys()), dtype=str), values)
+
+    def lagged(self, lookback, window=1):
+        # values observed lookback months before each month,
+        # taking the latest one within the window
+        lagged = np.full(self.values.shape, np.nan)
+        for w in reversed(range(window)):
+            shift = lookback + w
+            if shift >= len(self.months):
+                continue
+            shifted = self.values[:len(self.months) - shift]
+            target = lagged[shift:]
+            lagged[shift:] = np.where(np.isnan(shifted), target, shifted)
+        return lagged
+
+
+def assign_buckets(values, quantiles):
+    # pd.qcut along each row: (a, b] intervals, -1 where missing
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        edges = np.nanquantile(values, quantiles[1:-1], axis=1).T
+    buckets = (values[:, :, None] > edges[:, None, :]).sum(axis=2).astype(np.int8)
+    buckets[np.isnan(values)] = -1
+    return buckets
+
+
+def holding_period_returns(panel, day_locs, membership, weighting='value'):
+    # Daily returns of buy-and-hold portfolios over a holding period.
+    # Stock returns come from ri (%). Start-of-period weights are the
+    # previous-close mktcap ('value') or ones ('equal'), and drift with
+    # the cumulative return of each stock.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ri = panel.values['ri'][day_locs] / 100
+        is_quoted = ~np.isnan(ri)
+        if weighting == 'value':
+            implied = panel.values['mktcap'][day_locs] / (1 + ri)
+            weights = pd.DataFrame(implied).bfill().iloc[0].to_numpy()
+        else:
+            weights = np.where(is_quoted.any(axis=0), 1.0, np.nan)
+        growth = np.cumprod(np.where(is_quoted, 1 + ri, 1), axis=0)
+        growth = np.vstack([np.ones((1, growth.shape[1])), growth[:-1]])
+        weights = np.nan_to_num(weights) * growth
+        num = np.where(is_quoted, weights * ri, 0) @ membership
+        den = np.where(is_quoted, weights, 0) @ membership
+        return num / den
+
+
+def list_rebalancing_dates(starts_on, ends_on, rebalancing_frequency):
+    ls_dt = list()
+    dt = starts_on
+    while dt <= ends_on:
+        ls_dt.append(dt)
+        dt += relativedelta(months=rebalancing_frequency)
+    return ls_dt
+
+
+def sweep_backtests(price_panel, factor_panel, quantiles_grid, lookbacks, rebalancing_frequencies, starts_on, **kwargs):
+    # Evaluates every (quantiles, lookback, rebalancing_frequency, weighting)
+    # variant of a univariate backtest on the same panels.
+    data_starts_on = kwargs.get('data_starts_on', starts_on)
+    window = kwargs.get('window', 1)
+    weightings = kwargs.get('weightings', ['value', 'equal'])
+    ends_on = price_panel.dates[-1]
+    code_locs = price_panel.locate(factor_panel.stock_codes)
+    is_quoted = np.isin(factor_panel.stock_codes, price_panel.stock_codes)
+
+    series = list()
+    for lookback in lookbacks:
+        lagged = factor_panel.lagged(lookback, window=window)[:, is_quoted]
+        for quantiles in quantiles_grid:
+            buckets = assign_buckets(lagged, quantiles)
+            labels = [f"p{i + 1}" for i in range(len(quantiles) - 1)]
+            for freq in rebalancing_frequencies:
+                for rbdt in list_rebalancing_dates(starts_on, ends_on, freq):
+                    i = month_key(rbdt) - factor_panel.months[0]
+                    if i < 0 or i >= len(factor_panel.months):
+                        continue
+                    end_dt = rbdt + relativedelta(months=freq)
+                    start_dt = max(rbdt + relativedelta(days=1), data_starts_on)
+                    lo = bisect_left(price_panel.dates, start_dt)
+                    hi = bisect_right(price_panel.dates, end_dt)
+                    if lo >= hi:
+                        continue
+                    membership = np.zeros((len(price_panel.stock_codes), len(labels)))
+                    members = buckets[i] >= 0
+                    membership[code_locs[members], buckets[i][members]] = 1
+                    for weighting in weightings:
+                        returns = holding_period_returns(price_panel, range(lo, hi), membership, weighting)
+                        for k, label in enumerate(labels):
+                            series.append(pd.DataFrame({
+                                'quantiles': '/'.join([str(q) for q in quantiles]),
+                                'lookback': lookback,
+                                'rebalancing_frequency': freq,
+                                'weighting': weighting,
+                                'label': label,
+                                'date': price_panel.dates[lo:hi],
+                                'value': returns[:, k] * 100,
+                            }))
+    returns = pd.concat(series, axis=0, ignore_index=True)
+    keys = ['quantiles', 'lookback', 'rebalancing_frequency', 'weighting', 'label']
+    returns = returns.sort_values(keys + ['date']).reset_index(drop=True)
+    grouped = returns.groupby(keys).value
+    summary = pd.DataFrame({
+        'n_days': grouped.count(),
+        'mean': grouped.mean(),
+        'std': grouped.std(),
+        'cumulative': grouped.apply(lambda s: (np.prod(1 + s.dropna() / 100) - 1) * 100),
+    }).reset_index()
+    return summary, returns
+
+
+# Columnar account variables.
+# Rows are kept sorted by (stock_code, date, market) as one int64 key built from
+# int32 stock codes of a shared vocabulary, int32 YYYYMMDD dates and int8 markets,
+# so that joins and coalescing never go back to Python objects.
+
+class ColumnVocabulary:
+    def __init__(self):
+        self.stock_codes = dict()
+        self.markets = dict()
+
+    def encode(self, labels, mapping):
+        return np.array([mapping.setdefault(l, len(mapping)) for l in labels], dtype=np.int32)
+
+    def decode(self, locs, mapping):
+        labels = np.array(list(mapping.keys()), dtype=object)
+        return labels[locs]
+
+
+class VariableColumns:
+    def __init__(self, dates, codes, markets, values, vocabulary):
+        self.dates = dates
+        self.codes = codes
+        self.markets = markets
+        self.values = values
+        self.vocabulary = vocabulary
+
+    @classmethod
+    def from_records(cls, records, vocabulary):
+        dates = np.array([r['date'] for r in records], dtype=np.int64).astype(np.int32)
+        codes = vocabulary.encode([r['stock_code'] for r in records], vocabulary.stock_codes)
+        markets = vocabulary.encode([r['market'] for r in records], vocabulary.markets).astype(np.int8)
+        values = np.array([r['value'] for r in records])
+        if values.dtype == object:
+            values = values.astype(float)
+        obj = cls(dates, codes, markets, values, vocabulary)
+        # keeps the first of duplicated keys
+        keys, locs = np.unique(obj.keys, return_index=True)
+        return obj.take(locs)
+
+    @property
+    def keys(self):
+        return self.stock_date_keys << np.int64(8) | self.markets.astype(np.int64)
+
+    @property
+    def stock_date_keys(self):
+        return self.codes.astype(np.int64) << np.int64(25) | self.dates.astype(np.int64)
+
+    def take(self, locs):
+        return VariableColumns(
+            self.dates[locs],
+            self.codes[locs],
+            self.markets[locs],
+            self.values[locs],
+            self.vocabulary
+        )
+
+    def divide(self, other):
+        # inner join on sorted keys
+        keys, other_keys = self.keys, other.keys
+        locs = np.searchsorted(other_keys, keys)
+        locs = np.minimum(locs, max(len(other_keys) - 1, 0))
+        is_matched = (len(other_keys) > 0) & (other_keys[locs] == keys)
+        matched = self.take(np.flatnonzero(is_matched))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            matched.values = matched.values / other.values[locs[is_matched]]
+        return matched.take(np.flatnonzero(~np.isnan(matched.values)))
+
+    @classmethod
+    def coalesce(cls, ls_columns):
+        # The first of ls_columns wins on each (stock_code, date). Inputs are
+        # sorted runs, so the stable sort only merges them.
+        vocabulary = ls_columns[0].vocabulary
+        concatenated = cls(
+            np.concatenate([c.dates for c in ls_columns]),
+            np.concatenate([c.codes for c in ls_columns]),
+            np.concatenate([c.markets for c in ls_columns]),
+            np.concatenate([c.values for c in ls_columns]),
+            vocabulary
+        )
+        sorted_ = concatenated.take(np.argsort(concatenated.stock_date_keys, kind='stable'))
+        stock_date_keys = sorted_.stock_date_keys
+        is_first = np.ones(len(stock_date_keys), dtype=bool)
+        is_first[1:] = stock_date_keys[1:] != stock_date_keys[:-1]
+        coalesced = sorted_.take(np.flatnonzero(is_first))
+        return coalesced.take(np.argsort(coalesced.keys, kind='stable'))
+
+    def to_records(self):
+        strdates = self.dates.astype(str)
+        codes = self.vocabulary.decode(self.codes, self.vocabulary.stock_codes)
+        markets = self.vocabulary.decode(self.markets, self.vocabulary.markets)
+        return [{
+            'date': d,
+            'stock_code': c,
+            'market': m,
+            'value': v
+        } for d, c, m, v in zip(strdates.tolist(), codes.tolist(), markets.tolist(), self.values.tolist())]
+
+    def to_nested_records(self):
+        # result looks like {date: [{'stock_code', 'market', 'value'}, ...], ...}
+        by_date = self.take(np.argsort(self.dates, kind='stable'))
+        codes = by_date.vocabulary.decode(by_date.codes, by_date.vocabulary.stock_codes).tolist()
+        markets = by_date.vocabulary.decode(by_date.markets, by_date.vocabulary.markets).tolist()
+        values = by_date.values.tolist()
+        unique_dates, starts = np.unique(by_date.dates, return_index=True)
+        ends = np.append(starts[1:], len(by_date.dates))
+        nested = dict()
+        for d, i, j in zip(unique_dates.tolist(), starts, ends):
+            dt = datetime.date(d // 10000, d // 100 % 100, d % 100)
+            nested[dt] = [{
+                'stock_code': codes[k],
+                'market': markets[k],
+                'value': values[k]
+            } for k in range(i, j)]
+        return nested
+
+
+# Security ids.
+# Stock codes come as 'A005930' from CorpList, '005930' from StockPrice
+# and '[005930]' from OPENDART, and are mapped to int32 ids of the security master.
+
+def normalize_stock_codes(codes):
+    s = pd.Series(codes, dtype=object).str.strip('[]')
+    is_prefixed = (s.str.len() == 7) & s.str.startswith('A', na=False)
+    return s.mask(is_prefixed, s.str[1:]).to_numpy()
+
+
+class SecurityMapper:
+    def __init__(self, stock_codes, ids):
+        stock_codes = np.asarray(stock_codes, dtype=str)
+        order = np.argsort(stock_codes)
+        self.stock_codes = stock_codes[order]
+        self.ids = np.asarray(ids, dtype=np.int32)[order]
+
+    def map(self, stock_codes):
+        # ids of codes in any of the source formats, -1 if unknown
+        codes = normalize_stock_codes(stock_codes).astype(str)
+        if len(self.stock_codes) == 0:
+            return np.full(len(codes), -1, dtype=np.int32)
+        locs = np.clip(np.searchsorted(self.stock_codes, codes), 0, len(self.stock_codes) - 1)
+        is_found = self.stock_codes[locs] == codes
+        return np.where(is_found, self.ids[locs], -1).astype(np.int32)
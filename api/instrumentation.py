@@ -0,0 +1,118 @@
+from contextlib import contextmanager
+from django.db import connection
+from functools import wraps
+
+import cProfile
+import json
+import os
+import threading
+import time
+
+
+# Opt-in tracing of the batch.
+# Spans are recorded as complete events of the Chrome trace format
+# (chrome://tracing, Perfetto) only while a tracer is active,
+# and every span counts the queries run on the tracing thread while it is open.
+
+class Tracer:
+    def __init__(self):
+        self.events = list()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    @property
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = list()
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, category='function', **args):
+        span = {'queries': 0, 'query_time': 0.0, **args}
+        self.stack.append(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            ended = time.perf_counter()
+            self.stack.pop()
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (started - self.origin) * 1e6,
+                'dur': (ended - started) * 1e6,
+                'pid': self.pid,
+                'tid': threading.get_ident(),
+                'args': span,
+            })
+
+    def count_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            for span in self.stack:
+                span['queries'] += 1
+                span['query_time'] += elapsed
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+_TRACER = None
+
+@contextmanager
+def tracing(path):
+    # writes the trace of the block on path, does nothing if path is None
+    global _TRACER
+    if path is None:
+        yield None
+        return
+    _TRACER = Tracer()
+    try:
+        with connection.execute_wrapper(_TRACER.count_query):
+            with _TRACER.span('batch', category='batch'):
+                yield _TRACER
+    finally:
+        _TRACER.dump(path)
+        print(f"trace was written on {path}.")
+        _TRACER = None
+
+@contextmanager
+def trace(name, category='function', **args):
+    if _TRACER is None:
+        yield None
+        return
+    with _TRACER.span(name, category, **args) as span:
+        yield span
+
+def traced(func):
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _TRACER is None:
+            return func(*args, **kwargs)
+        with _TRACER.span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def profiling(path):
+    # dumps cProfile stats of the block on path, does nothing if path is None
+    if path is None:
+        yield None
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        print(f"profile was written on {path}.")
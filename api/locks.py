@@ -0,0 +1,113 @@
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+import fcntl
+import functools
+import hashlib
+import os
+import threading
+import time
+
+
+# Named advisory locks of resources written by the batch,
+# so that overlapping runs and workers do not sync the same resource at once.
+# MySQL locks are GET_LOCK of the connection and are released if the process dies,
+# other backends, e.g. sqlite of benchmarks, lock files of ADVISORY_LOCK_DIR on the host.
+# Locks are reentrant within a thread.
+
+class AdvisoryLockTimeout(Exception):
+    def __init__(self, name, timeout):
+        self.name = name
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"advisory lock {self.name} was not acquired in {self.timeout}s."
+
+
+_HELD = threading.local()
+
+def get_lock_name(name):
+    # mysql limits names to 64 characters
+    name = f"marketdata:{name}"
+    if len(name) > 64:
+        name = f"marketdata:{hashlib.sha1(name.encode('utf-8')).hexdigest()}"
+    return name
+
+@contextmanager
+def advisory_lock(name, timeout=None, using=DEFAULT_DB_ALIAS):
+    if timeout is None:
+        timeout = settings.ADVISORY_LOCK_TIMEOUT
+    name = get_lock_name(name)
+    held = getattr(_HELD, 'counts', None)
+    if held is None:
+        held = _HELD.counts = dict()
+    if held.get(name):
+        held[name] += 1
+        try:
+            yield
+        finally:
+            held[name] -= 1
+        return
+
+    connection = connections[using]
+    if connection.vendor == 'mysql':
+        release = acquire_mysql_lock(connection, name, timeout)
+    else:
+        release = acquire_file_lock(name, timeout)
+    held[name] = 1
+    try:
+        yield
+    finally:
+        held[name] = 0
+        release()
+
+@contextmanager
+def advisory_locks(names, timeout=None, using=DEFAULT_DB_ALIAS):
+    # sorted so that holders of several locks do not deadlock each other
+    with ExitStack() as stack:
+        for name in sorted(set(names)):
+            stack.enter_context(advisory_lock(name, timeout=timeout, using=using))
+        yield
+
+def locked(name_of):
+    # locks methods on a resource named by name_of(self)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with advisory_lock(name_of(self)):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def acquire_mysql_lock(connection, name, timeout):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT GET_LOCK(%s, %s)', [name, timeout])
+        acquired = cursor.fetchone()[0]
+    if acquired != 1:
+        raise AdvisoryLockTimeout(name, timeout)
+
+    def release():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', [name])
+    return release
+
+def acquire_file_lock(name, timeout):
+    os.makedirs(settings.ADVISORY_LOCK_DIR, exist_ok=True)
+    path = os.path.join(settings.ADVISORY_LOCK_DIR, f"{name.replace(':', '_').replace('/', '_')}.lock")
+    f = open(path, 'w')
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if time.monotonic() > deadline:
+                f.close()
+                raise AdvisoryLockTimeout(name, timeout)
+            time.sleep(0.1)
+
+    def release():
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+    return release
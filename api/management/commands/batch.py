@@ -1,9 +1,69 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from api.instrumentation import tracing
+from api.models import BatchRun
+from api.pipeline import RunInProgress, Worker
+from api.registry import resolving
 from api.tasks import sync_to_latest
 
 class Command(BaseCommand):
-    help = 'test'
+    help = 'sync sources and products to latest, resuming a failed batch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-resume', action='store_true', help='start a new run instead of resuming a failed one')
+        parser.add_argument('--force', action='store_true', help='run stages even if their inputs are unchanged')
+        parser.add_argument('--stages', nargs='+', help='names of stages to run, e.g. variables backtesters')
+        parser.add_argument('--status', action='store_true', help='print stages of the latest run and exit')
+        parser.add_argument('--trace', help='path of a chrome trace json of timings and query counts')
+        parser.add_argument('--profile', help='directory of cProfile dumps per stage')
+        parser.add_argument('--worker', action='store_true', help='lease and run units of the current run together with other workers')
+        parser.add_argument('--lease-seconds', type=int, default=600, help='lease of a unit, extended by heartbeats while it runs')
+        parser.add_argument('--poll-seconds', type=int, default=5, help='wait of a worker while no unit is ready')
+        parser.add_argument('--max-attempts', type=int, default=3, help='attempts of a unit before the run fails')
 
     def handle(self, *args, **kwargs):
-        sync_to_latest()
+        if kwargs['status']:
+            self.print_status(BatchRun.objects.order_by('id').last())
+            return
+        # variables resolved by addresses are fetched once for the batch
+        with tracing(kwargs['trace']), resolving():
+            try:
+                run = self.run(**kwargs)
+            except RunInProgress as e:
+                raise CommandError(str(e))
+        self.print_status(run)
+        if run.status == 'failed':
+            raise CommandError(f"{run} failed, see units of the run.")
         print('batch complete.')
+
+    def run(self, **kwargs):
+        if kwargs['worker']:
+            return Worker(
+                lease_seconds = kwargs['lease_seconds'],
+                poll_seconds = kwargs['poll_seconds'],
+                max_attempts = kwargs['max_attempts'],
+            ).run(
+                force = kwargs['force'],
+                stages = kwargs['stages'],
+            )
+        return sync_to_latest(
+            resume = not kwargs['no_resume'],
+            force = kwargs['force'],
+            stages = kwargs['stages'],
+            profile_dir = kwargs['profile'],
+        )
+
+    def print_status(self, run):
+        if run is None:
+            print('no batch has been run.')
+            return
+        print(run.__str__())
+        if run.selected_stages:
+            print(f"  selected stages: {' '.join(run.selected_stages)}")
+        for stage in run.stages.order_by('id'):
+            print(
+                f"  {stage.name:<16} {stage.status:<10} {stage.wall_time:>9.1f}s "
+                f"{stage.rows:>9} rows {stage.bytes / 1e6:>9.2f}MB "
+                f"{stage.checkpoints.count():>5} checkpoints"
+            )
+        for unit in run.units.exclude(status='completed').order_by('id'):
+            print(f"  {unit.__str__()} attempts {unit.attempts} owner {unit.owner}")
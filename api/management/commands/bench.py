@@ -0,0 +1,79 @@
+from api.benchmarks import CASES, run_benchmarks
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+import datetime
+import json
+import os
+import subprocess
+
+class Command(BaseCommand):
+    help = 'run offline benchmarks of the batch on synthetic sources and record results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stocks', type=int, default=200)
+        parser.add_argument('--years', type=int, default=6, help='years of history until today, backtests need history since 2021')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--cases', nargs='+', choices=[name for name, func in CASES], help='names of cases to record, all by default')
+        parser.add_argument('--openapi-days', type=int, default=1, help='number of days synced from the stub in the openapi case')
+        parser.add_argument('--api-requests', type=int, default=200, help='number of requests of each round in the api case')
+        parser.add_argument('--api-concurrency', type=int, default=8, help='number of concurrent clients in the api case')
+        parser.add_argument('--opendart-drop', type=float, default=0, help='ratio of each archive after which its first download is cut, 0 for none')
+        parser.add_argument('--output', default='benchmarks.jsonl', help='jsonl file results are appended to')
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != 'sqlite':
+            raise CommandError('bench flushes the database, run it with DJANGO_SETTINGS_MODULE=config.bench_settings.')
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        call_command('migrate', run_syncdb=True, verbosity=0)
+        call_command('flush', interactive=False, verbosity=0)
+
+        results = run_benchmarks(
+            kwargs['stocks'],
+            kwargs['years'],
+            seed = kwargs['seed'],
+            cases = kwargs['cases'],
+            openapi_days = kwargs['openapi_days'],
+            api_requests = kwargs['api_requests'],
+            api_concurrency = kwargs['api_concurrency'],
+            opendart_drop = kwargs['opendart_drop'],
+        )
+        previous = self.read_previous(kwargs['output'])
+        commit = self.get_commit()
+        recorded_at = datetime.datetime.now().isoformat(timespec='seconds')
+        with open(kwargs['output'], 'a') as f:
+            for r in results:
+                last = previous.get((r['case'], r['stocks'], r['years'], r['seed']))
+                if last:
+                    print(
+                        f"{r['case']:<16} {r['seconds'] / max(last['seconds'], 1e-9) - 1:>+8.1%} time "
+                        f"{r['queries'] - last['queries']:>+8} queries since {last['commit']}"
+                    )
+                f.write(json.dumps({**r, 'commit': commit, 'recorded_at': recorded_at}) + '\n')
+        print(f"results were appended to {kwargs['output']}.")
+        over = [r['case'] for r in results if r['queries'] > r['query_budget']]
+        if len(over) > 0:
+            raise CommandError(f"queries of {', '.join(over)} went over their budgets, see benchmarks.QUERY_BUDGETS.")
+
+    def read_previous(self, path):
+        previous = dict()
+        if not os.path.exists(path):
+            return previous
+        with open(path) as f:
+            for line in f:
+                r = json.loads(line)
+                previous[(r['case'], r['stocks'], r['years'], r['seed'])] = r
+        return previous
+
+    def get_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output = True,
+                text = True,
+                cwd = settings.BASE_DIR,
+            ).stdout.strip() or None
+        except OSError:
+            return None
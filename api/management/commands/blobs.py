@@ -0,0 +1,85 @@
+from api.blobs import decode_columns, encode_records
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+import json
+import time
+
+class Command(BaseCommand):
+    help = 'encode json records of VariableData into blobs and report storage size and load speed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true', help='encode VariableData still stored as json records')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **kwargs):
+        vdmodel = apps.get_model('api', 'VariableData')
+        if kwargs['convert']:
+            qs = vdmodel.objects.filter(blob__isnull=True)
+            converted = 0
+            while True:
+                batch = list(qs.order_by('id')[:kwargs['batch_size']])
+                if len(batch) == 0:
+                    break
+                for obj in batch:
+                    obj.set_records(obj.records)
+                vdmodel.objects.bulk_update(batch, ['records', 'blob'])
+                converted += len(batch)
+            print(f"{converted} number of VariableData were encoded into blobs.")
+        self.report_variable_data(vdmodel)
+        self.report_factor_portfolio_data(apps.get_model('api', 'FactorPortfolioData'))
+
+    def report_variable_data(self, vdmodel):
+        json_size = blob_size = 0
+        json_time = blob_time = 0
+        n = 0
+        for obj in vdmodel.objects.iterator():
+            records = obj.get_records()
+            serialized = json.dumps(records)
+            blob = bytes(obj.blob) if obj.blob is not None else encode_records(records)
+            json_size += len(serialized.encode('utf-8'))
+            blob_size += len(blob)
+            t = time.perf_counter()
+            json.loads(serialized)
+            json_time += time.perf_counter() - t
+            t = time.perf_counter()
+            decode_columns(blob)
+            blob_time += time.perf_counter() - t
+            n += 1
+        self.print_report('VariableData', n, json_size, blob_size, json_time, blob_time)
+
+    def report_factor_portfolio_data(self, fpdmodel):
+        # compared with json rows of {'portfolio', 'date', 'value_vw', 'value_ew'} per day
+        json_size = blob_size = 0
+        json_time = blob_time = 0
+        n = 0
+        for obj in fpdmodel.objects.filter(blob__isnull=False).iterator():
+            blob = bytes(obj.blob)
+            columns = decode_columns(blob)
+            serialized = json.dumps([{
+                'portfolio': obj.portfolio_id,
+                'date': str(d),
+                'value_vw': vw,
+                'value_ew': ew,
+            } for d, vw, ew in zip(columns['date'].tolist(), columns['value_vw'].tolist(), columns['value_ew'].tolist())])
+            json_size += len(serialized.encode('utf-8'))
+            blob_size += len(blob)
+            t = time.perf_counter()
+            json.loads(serialized)
+            json_time += time.perf_counter() - t
+            t = time.perf_counter()
+            decode_columns(blob)
+            blob_time += time.perf_counter() - t
+            n += 1
+        self.print_report('FactorPortfolioData', n, json_size, blob_size, json_time, blob_time)
+
+    def print_report(self, name, n, json_size, blob_size, json_time, blob_time):
+        if n == 0:
+            print(f"{name}: no rows.")
+            return
+        print(
+            f"{name}: {n} rows, "
+            f"json {json_size / 1e6:.2f}MB in {json_time:.3f}s, "
+            f"blob {blob_size / 1e6:.2f}MB in {blob_time:.3f}s "
+            f"({json_size / max(blob_size, 1):.1f}x smaller, {json_time / max(blob_time, 1e-9):.1f}x faster)"
+        )
@@ -0,0 +1,13 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = 'load json records of StockPrice into the StockDaily table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days-per-batch', type=int, default=20)
+
+    def handle(self, *args, **kwargs):
+        sdmodel = apps.get_model('api', 'StockDaily')
+        loaded = sdmodel.objects.backfill(days_per_batch=kwargs['days_per_batch'])
+        print(f"{loaded} number of StockDaily rows were loaded.")
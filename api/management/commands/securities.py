@@ -0,0 +1,38 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = 'build the security master from CorpList and StockPrice and link StockDaily rows to it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **kwargs):
+        scmodel = apps.get_model('api', 'Security')
+        for model_name in ['CorpList', 'StockPrice']:
+            model = apps.get_model('api', model_name)
+            for date in model.objects.order_by('date').values_list('date', flat=True):
+                obj = model.objects.only('date', 'records').get(date=date)
+                scmodel.objects.register(obj.date, obj.records)
+        print(f"{scmodel.objects.count()} number of Security were registered.")
+
+        sdmodel = apps.get_model('api', 'StockDaily')
+        mapper = scmodel.objects.get_mapper()
+        qs = sdmodel.objects.filter(security__isnull=True).only('id', 'stock_code')
+        linked = 0
+        last_id = 0
+        while True:
+            batch = list(qs.filter(id__gt=last_id).order_by('id')[:kwargs['batch_size']])
+            if len(batch) == 0:
+                break
+            last_id = batch[-1].id
+            security_ids = mapper.map([obj.stock_code for obj in batch])
+            matched = list()
+            for obj, security_id in zip(batch, security_ids.tolist()):
+                if security_id < 0:
+                    continue
+                obj.security_id = security_id
+                matched.append(obj)
+            sdmodel.objects.bulk_update(matched, ['security'])
+            linked += len(matched)
+        print(f"security of {linked} number of StockDaily were linked.")
@@ -0,0 +1,17 @@
+from api.registry import VARIABLE_MODEL_NAMES
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = 'build per-stock series of variables from their date-keyed VariableData'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', nargs='+', default=VARIABLE_MODEL_NAMES)
+
+    def handle(self, *args, **kwargs):
+        ssmodel = apps.get_model('api', 'StockSeries')
+        for model_name in kwargs['models']:
+            for var in apps.get_model('api', model_name).objects.all():
+                data = var.queryset.order_by('date').only('date', 'records', 'blob').iterator(chunk_size=50)
+                merged = ssmodel.objects.merge(var.address_key, data)
+                print(f"{merged} number of StockSeries for {var} were merged.")
@@ -0,0 +1,77 @@
+from api.engines import FactorPanel, PricePanel, sweep_backtests
+from api.registry import get_registry
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from types import SimpleNamespace
+
+import datetime
+import gzip
+import json
+
+class Command(BaseCommand):
+    help = 'sweep univariate backtests over quantiles, lookbacks and rebalancing frequencies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--variable', help='model_name:id of a variable, e.g. Size:1')
+        parser.add_argument('--factor-fixture', help='json(.gz) list of {"date", "records"} of the factor')
+        parser.add_argument('--price-fixture', help='json(.gz) list of {"date", "records"} of stock prices')
+        parser.add_argument('--quantiles', nargs='+', default=['0,.3,.7,1'])
+        parser.add_argument('--lookbacks', nargs='+', type=int, default=[6])
+        parser.add_argument('--frequencies', nargs='+', type=int, default=[12])
+        parser.add_argument('--weightings', nargs='+', default=['value', 'equal'])
+        parser.add_argument('--window', type=int, help='months to look back for the latest factor value')
+        parser.add_argument('--starts-on', default='20220630')
+        parser.add_argument('--output', default='sweep')
+
+    def handle(self, *args, **kwargs):
+        data_starts_on = settings.PORTFOLIO_DATA_STARTS_ON
+        if kwargs['price_fixture']:
+            price_panel = PricePanel.from_price_data(self.load_fixture(kwargs['price_fixture']), fields=['mktcap', 'ri'])
+        else:
+            spmodel = apps.get_model('api', 'StockPrice')
+            price_panel = spmodel.objects.get_panel(
+                start_dt = data_starts_on,
+                end_dt = datetime.date.today(),
+                fields = ['mktcap', 'ri']
+            )
+
+        window = kwargs['window']
+        if kwargs['factor_fixture']:
+            vdmodel = apps.get_model('api', 'VariableData')
+            factor_panel = FactorPanel.from_variable_data([
+                vdmodel(date=obj.date, records=obj.records)
+                for obj in self.load_fixture(kwargs['factor_fixture'])
+            ])
+        else:
+            model_name, id = kwargs['variable'].split(':')
+            variable = get_registry().resolve({'model_name': model_name, 'id': int(id)})
+            factor_panel = FactorPanel.from_variable_data(variable.queryset)
+            if not window:
+                window = 1 if model_name in ['Size', 'Momentum'] else 3
+
+        summary, returns = sweep_backtests(
+            price_panel = price_panel,
+            factor_panel = factor_panel,
+            quantiles_grid = [[float(q) for q in s.split(',')] for s in kwargs['quantiles']],
+            lookbacks = kwargs['lookbacks'],
+            rebalancing_frequencies = kwargs['frequencies'],
+            starts_on = datetime.datetime.strptime(kwargs['starts_on'], '%Y%m%d').date(),
+            data_starts_on = data_starts_on,
+            window = window or 1,
+            weightings = kwargs['weightings'],
+        )
+        summary.to_csv(f"{kwargs['output']}_summary.csv", index=False)
+        returns.to_csv(f"{kwargs['output']}_returns.csv.gz", index=False)
+        print(f"{len(summary)} portfolios of sweep were saved on {kwargs['output']}_*.")
+
+    def load_fixture(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            ls = json.load(f)
+        return [
+            SimpleNamespace(
+                date = datetime.datetime.strptime(d['date'], '%Y%m%d').date(),
+                records = d['records']
+            ) for d in ls
+        ]
@@ -1,48 +1,117 @@
+from .blobs import encode_columns
 from .clients import (
     CorpListApiClient,
     StockPriceApiClient,
     OpenApiResponsesXmlError,
 )
+from .engines import (
+    PricePanel,
+    SecurityMapper,
+    assign_quantile_locs_in_parallel,
+    group_entries_by_quantile_locs,
+    momentum_values,
+    month_key,
+    normalize_stock_codes,
+)
+from .instrumentation import traced
+from .locks import advisory_lock, advisory_locks
+from .registry import resolving
+from .src import constants
+from .tools import bulk_upsert
+from .uploads import upload_file
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 from django.apps import apps
 from django.conf import settings
-from django.db import models
-from django.db.models import Max
+from django.db import connections, models, transaction
+from django.db.models import Count, F, Max, Q
 import requests
 import datetime
+import hashlib
+import numpy as np
+import os
 import zipfile
 
 
 class OpendartZipfileManager(models.Manager):
+    @advisory_lock('opendart')
     def bulk_sync(self, return_status=True):
-        ls_source = self.list_source_filenames()
-        is_changed = False
-        for source_fnm in ls_source:
+        ls_changed = self.list_changed()
+        is_changed = len(ls_changed) > 0
+        if not is_changed:
+            print("OpendartZipfile has already been synced to sources.")
+        else:
+            # archives are locked as in sync_source_file, run by work units
+            with advisory_locks([f"opendart:{obj.identifier}" for obj, source_fnm, created in ls_changed]):
+                self.download_in_parallel(ls_changed)
+        if return_status:
+            return is_changed
+
+    def list_changed(self):
+        # result looks like [(obj, source_fnm, created), ...]
+        ls_changed = list()
+        for source_fnm in self.list_source_filenames():
             d = self.parse_filename(source_fnm)
             obj, created = self.get_or_create(
                 identifier = d['identifier']
             )
             updated = obj.last_update < d['last_update']
             if created or updated:
+                # saved once downloaded, so that a failed download is retried by the next sync
                 obj.last_update = d['last_update']
+                ls_changed.append((obj, source_fnm, created))
+        return ls_changed
+
+    @traced
+    def sync_source_file(self, source_fnm):
+        # an archive of the source listing, e.g. a work unit of the opendart stage
+        d = self.parse_filename(source_fnm)
+        with advisory_lock(f"opendart:{d['identifier']}"):
+            obj, created = self.get_or_create(
+                identifier = d['identifier']
+            )
+            if not created and obj.last_update >= d['last_update']:
+                print(f"OpendartZipfile {obj.__str__()} has already been synced to sources.")
+                return False
+            obj.last_update = d['last_update']
+            self.download_in_parallel([(obj, source_fnm, created)])
+        return True
+
+    @traced
+    def download_in_parallel(self, ls_changed):
+        # Archives are downloaded by a thread pool, and each completed one
+        # is uploaded in the background and parsed while the others are downloading.
+        with ThreadPoolExecutor(max_workers=settings.OPENDART_DOWNLOAD_WORKERS, thread_name_prefix='download') as executor:
+            futures = {
+                executor.submit(obj.download_from_source): (obj, source_fnm, created)
+                for obj, source_fnm, created in ls_changed
+            }
+            errors = list()
+            for future in as_completed(futures):
+                obj, source_fnm, created = futures[future]
+                if future.exception() is not None:
+                    # archives downloaded by the others are kept
+                    print(f"OpendartZipfile {obj.__str__()} was not downloaded ({future.exception()}).")
+                    errors.append(future.exception())
+                    continue
+                path = future.result()
                 obj.save()
-                f = obj.download_from_source()
-                obj.file.save(source_fnm, f)
-                obj.bootstrap_text_files()
+                # the file is closed by the upload queue once uploaded
+                upload_file(obj, source_fnm, open(path, 'rb'))
+                with open(path, 'rb') as f:
+                    obj.bootstrap_text_files(use_file=f)
+                os.remove(path)
                 if created:
                     print(f"OpendartZipfile {obj.__str__()} was created.")
-                if updated:
+                else:
                     print(f"OpendartZipfile {obj.__str__()} was updated.")
-            is_changed = is_changed or created or updated
-        if not is_changed:
-            print("OpendartZipfile has already been synced to sources.")
-        if return_status:
-            return is_changed
+        if len(errors) > 0:
+            raise errors[0]
 
     def list_source_filenames(self):
-        url = 'https://opendart.fss.or.kr/disclosureinfo/fnltt/dwld/list.do'
+        url = f"{settings.OPENDART_URL}/disclosureinfo/fnltt/dwld/list.do"
         r = requests.get(url)
         soup = BeautifulSoup(r.text, 'html.parser')
         atags = soup.find('table','tb01').find_all('a')
@@ -59,6 +128,7 @@ class OpendartZipfileManager(models.Manager):
 
 
 class CorpListManager(models.Manager):
+    @advisory_lock('openapi:CorpList')
     def bulk_sync(self, **kwargs):
         client = CorpListApiClient()
         if not self.exists():
@@ -88,14 +158,14 @@ class CorpListManager(models.Manager):
                 prev_dt = dt
                 dt += timedelta(days=1)
                 continue
-            obj = self.create(
-                date = dt,
-                records = records,
-            )
+            bulk_upsert(self, [self.model(date=dt, records=records)], ['date'], ['records'])
+            obj = self.get(date=dt)
+            apps.get_model('api', 'Security').objects.register(obj.date, obj.records)
             print(f"CorpList for {obj.__str__()} was created.")
             prev_dt = dt
             dt += timedelta(days=1)
 
+    @advisory_lock('openapi:CorpList')
     def init_table(self):
         client = CorpListApiClient()
         dt = client.MIN_DATE
@@ -106,10 +176,9 @@ class CorpListManager(models.Manager):
             real_me = dt + relativedelta(day=31)
             me = client.verify_trading_monthend(real_me)
             records = client.query(params={'basDt': me.strftime('%Y%m%d')})
-            obj = self.create(
-                date = me,
-                records = records,
-            )
+            bulk_upsert(self, [self.model(date=me, records=records)], ['date'], ['records'])
+            obj = self.get(date=me)
+            apps.get_model('api', 'Security').objects.register(obj.date, obj.records)
             print(f"CorpList for {obj.__str__()} was created.")
             prev_dt = dt
             dt += relativedelta(months=1)
@@ -117,8 +186,10 @@ class CorpListManager(models.Manager):
 
 
 class StockPriceManager(models.Manager):
+    @advisory_lock('openapi:StockPrice')
     def bulk_sync(self, **kwargs):
         client = StockPriceApiClient()
+        sdmodel = apps.get_model('api', 'StockDaily')
         if not self.exists():
             self.init_table()
             return
@@ -135,6 +206,7 @@ class StockPriceManager(models.Manager):
         dt = latest + timedelta(days=1)
         while True:
             if dt > new_latest:
+                self.update_monthends()
                 print('StockPrice was synced to sources successfully.')
                 break
             if dt.weekday() in [5, 6]:
@@ -146,21 +218,15 @@ class StockPriceManager(models.Manager):
                 prev_dt = dt
                 dt += timedelta(days=1)
                 continue
-            # current_latest = self.latest().date
-            current_latest = self.aggregate(Max('date'))['date__max']
-            obj = self.create(
-                date = dt,
-                records = records,
-            )
-            if current_latest.month < dt.month:
-                obj_monthend = self.get(date=current_latest)
-                obj_monthend.is_monthend = True
-                obj_monthend.save()
+            bulk_upsert(self, [self.model(date=dt, records=records)], ['date'], ['records'])
+            obj = self.get(date=dt)
+            sdmodel.objects.load([obj])
             obj.write_file()
             print(f"StockPrice for {obj.__str__()} was created.")
             prev_dt = dt
             dt += timedelta(days=1)
 
+    @advisory_lock('openapi:StockPrice')
     def init_table(self):
         client = StockPriceApiClient()
         dt = client.MIN_DATE
@@ -171,16 +237,287 @@ class StockPriceManager(models.Manager):
             real_me = dt + relativedelta(day=31)
             me = client.verify_trading_monthend(real_me)
             records = client.query(params={'basDt': me.strftime('%Y%m%d')})
-            obj = self.create(
-                date = me,
-                records = records,
-                is_monthend = True
+            bulk_upsert(
+                self,
+                [self.model(date=me, records=records, is_monthend=True)],
+                ['date'],
+                ['records', 'is_monthend']
             )
+            obj = self.get(date=me)
+            apps.get_model('api', 'StockDaily').objects.load([obj])
             print(f"StockPrice for {obj.__str__()} was created.")
             prev_dt = dt
             dt += relativedelta(months=1)
         self.bulk_sync(initiate=True)
 
+    def update_monthends(self):
+        # the last stored day of each month before the latest month is its month end,
+        # derived from all dates rather than the order days were synced in
+        last_by_month = dict()
+        for date in self.order_by('date').values_list('date', flat=True):
+            last_by_month[(date.year, date.month)] = date
+        if len(last_by_month) == 0:
+            return
+        latest_month = max(last_by_month.keys())
+        monthends = [date for month, date in last_by_month.items() if month < latest_month]
+        with transaction.atomic():
+            self.filter(is_monthend=True).exclude(date__in=monthends).update(is_monthend=False)
+            self.filter(is_monthend=False, date__in=monthends).update(is_monthend=True)
+
+    def get_panel(self, start_dt, end_dt, fields):
+        qs = self.filter(date__gte=start_dt, date__lte=end_dt)
+        return self.get_panel_of(qs, fields)
+
+    def get_panel_of(self, qs, fields):
+        # typed rows of StockDaily are read instead of json records once they are loaded
+        if qs.filter(is_normalized=False).exists():
+            return PricePanel.from_price_data(qs, fields=fields)
+        return apps.get_model('api', 'StockDaily').objects.get_panel(qs, fields)
+
+    def get_monthend_panel(self, fields):
+        # common stocks only, cached until month-end prices change
+        qs = self.filter(is_monthend=True)
+        version = qs.aggregate(Count('id'), Max('date'), Max('last_update'))
+        key = (tuple(fields), version['id__count'], version['date__max'], version['last_update__max'])
+        cache = getattr(self, '_monthend_panel_cache', dict())
+        if cache.get('key') != key:
+            panel = self.get_panel_of(qs, fields)
+            panel.keep_listed(self.list_listed_by_date(panel.dates))
+            self._monthend_panel_cache = {'key': key, 'panel': panel}
+        return self._monthend_panel_cache['panel']
+
+    def list_listed_by_date(self, dates):
+        # result looks like {date: set([(stock_code, market), ...]), ...}
+        clmodel = apps.get_model('api', 'CorpList')
+        listed_by_date = dict()
+        for obj in clmodel.objects.filter(date__in=dates):
+            stock_codes = normalize_stock_codes([r['srtnCd'] for r in obj.records])
+            listed_by_date[obj.date] = set(zip(stock_codes.tolist(), [r['mrktCtg'] for r in obj.records]))
+        for date in dates:
+            if listed_by_date.get(date):
+                continue
+            obj = self.get(date=date)
+            listed_by_date[date] = set([(r['stock_code'], r['market']) for r in obj.get_matched_corp_list()])
+        return listed_by_date
+
+
+class StockDailyManager(models.Manager):
+    def load(self, price_data, batch_size=5000):
+        # replaces rows on the dates of StockPrice objects with batched inserts
+        source_names = {v: k for k, v in constants.STOCK_PRICE_DATA_RENAME_MAP.items()}
+        fields = ['open', 'high', 'low', 'close', 'ri', 'vol_n', 'vol_m', 'n_listed', 'mktcap']
+        to_number = lambda v, tp: tp(v) if v not in [None, ''] else None
+        objs = list(price_data)
+        scmodel = apps.get_model('api', 'Security')
+        for obj in objs:
+            scmodel.objects.register(obj.date, obj.records)
+        mapper = scmodel.objects.get_mapper()
+        rows = list()
+        for obj in objs:
+            stock_codes = normalize_stock_codes([r[source_names['stock_code']] for r in obj.records])
+            security_ids = mapper.map(stock_codes)
+            for r, stock_code, security_id in zip(obj.records, stock_codes.tolist(), security_ids.tolist()):
+                rows.append(self.model(
+                    date = obj.date,
+                    security_id = security_id if security_id >= 0 else None,
+                    stock_code = stock_code,
+                    market = r[source_names['market']],
+                    **{f: to_number(r.get(source_names[f]), float if f == 'ri' else int) for f in fields}
+                ))
+        with transaction.atomic():
+            self.filter(date__in=[obj.date for obj in objs]).delete()
+            # rows inserted by a concurrent load of the same days are overwritten
+            bulk_upsert(
+                self,
+                rows,
+                ['date', 'stock_code', 'market'],
+                ['security', *fields],
+                batch_size = batch_size
+            )
+            spmodel = apps.get_model('api', 'StockPrice')
+            spmodel.objects.filter(id__in=[obj.id for obj in objs]).update(
+                is_normalized = True,
+                last_update = datetime.datetime.now()
+            )
+        return len(rows)
+
+    def backfill(self, days_per_batch=20):
+        # loads StockPrice days not loaded yet, e.g. those created before StockDaily
+        spmodel = apps.get_model('api', 'StockPrice')
+        qs = spmodel.objects.filter(is_normalized=False).order_by('date')
+        loaded = 0
+        while True:
+            objs = list(qs[:days_per_batch])
+            if len(objs) == 0:
+                break
+            loaded += self.load(objs)
+        return loaded
+
+    def get_panel(self, qs_prc, fields):
+        dates = sorted(qs_prc.values_list('date', flat=True))
+        rows = self.filter(
+            date__in = qs_prc.values('date')
+        ).order_by('date', 'id').values_list('date', 'stock_code', 'market', *fields)
+        return PricePanel.from_daily_rows(dates, rows.iterator(chunk_size=10000), fields)
+
+    def get_history(self, stock_code, start_dt=None, end_dt=None):
+        qs = self.filter(stock_code=stock_code)
+        if start_dt:
+            qs = qs.filter(date__gte=start_dt)
+        if end_dt:
+            qs = qs.filter(date__lte=end_dt)
+        return qs.order_by('date')
+
+
+class SecurityManager(models.Manager):
+    @advisory_lock('securities')
+    def register(self, date, records):
+        # records are raw items of CorpList or StockPrice, keyed by source names
+        source_names = {v: k for k, v in constants.CORP_LIST_DATA_RENAME_MAP.items()}
+        stock_codes = normalize_stock_codes([r[source_names['stock_code']] for r in records])
+        # only securities of the records are fetched
+        codes = sorted(set(stock_codes.tolist()))
+        existing = dict()
+        for i in range(0, len(codes), 1000):
+            existing.update({obj.stock_code: obj for obj in self.filter(stock_code__in=codes[i:i + 1000])})
+        to_create = dict()
+        to_update = dict()
+        for r, stock_code in zip(records, stock_codes.tolist()):
+            market = r.get(source_names['market']) or ''
+            name = r.get(source_names['name']) or ''
+            obj = existing.get(stock_code) or to_create.get(stock_code)
+            if obj is None:
+                to_create[stock_code] = self.model(
+                    stock_code = stock_code,
+                    isin_code = r.get(source_names['isin_code']),
+                    crno = r.get(source_names['crno']),
+                    market = market,
+                    name = name,
+                    history = [{'date': date.isoformat(), 'market': market, 'name': name}],
+                    first_date = date,
+                    last_date = date,
+                )
+                continue
+            # rows of a date already registered are flagged only on actual changes
+            is_changed = False
+            if date < obj.first_date:
+                obj.first_date = date
+                is_changed = True
+            if date >= obj.last_date:
+                if date > obj.last_date:
+                    obj.last_date = date
+                    is_changed = True
+                if (obj.market, obj.name) != (market, name):
+                    obj.market = market
+                    obj.name = name
+                    obj.history.append({'date': date.isoformat(), 'market': market, 'name': name})
+                    is_changed = True
+                if obj.crno is None and r.get(source_names['crno']):
+                    obj.crno = r.get(source_names['crno'])
+                    is_changed = True
+            if is_changed and obj.pk:
+                to_update[stock_code] = obj
+        self.bulk_create(to_create.values(), batch_size=1000)
+        self.bulk_update(
+            to_update.values(),
+            ['market', 'name', 'history', 'crno', 'first_date', 'last_date'],
+            batch_size = 1000
+        )
+        return len(to_create), len(to_update)
+
+    def get_mapper(self):
+        rows = list(self.values_list('stock_code', 'id'))
+        stock_codes, ids = zip(*rows) if len(rows) > 0 else ([], [])
+        return SecurityMapper(stock_codes, ids)
+
+
+class StockSeriesManager(models.Manager):
+    @traced
+    def merge(self, series_key, data):
+        # Data are VariableData of a source, whose values replace those of their dates
+        # in every series of the source, including series of stocks missing on the dates.
+        synced_dates = np.array(sorted(set([int(obj.date.strftime('%Y%m%d')) for obj in data])), dtype=np.int32)
+        if len(synced_dates) == 0:
+            return 0
+        ls_codes, ls_dates, ls_values = list(), list(), list()
+        for obj in data:
+            cols = obj.get_columns()
+            if len(cols) == 0:
+                continue
+            ls_codes.append(cols['stock_code'])
+            ls_dates.append(np.full(len(cols['stock_code']), int(obj.date.strftime('%Y%m%d')), dtype=np.int32))
+            ls_values.append(cols['value'])
+        new_by_code = dict()
+        if len(ls_codes) > 0:
+            stock_codes = np.concatenate(ls_codes)
+            dates = np.concatenate(ls_dates)
+            values = np.concatenate(ls_values)
+            order = np.lexsort((dates, stock_codes))
+            stock_codes, dates, values = stock_codes[order], dates[order], values[order]
+            codes, starts = np.unique(stock_codes, return_index=True)
+            ends = np.append(starts[1:], len(stock_codes))
+            for stock_code, start, end in zip(codes.tolist(), starts, ends):
+                new_by_code[stock_code] = (dates[start:end], values[start:end])
+
+        # series of other stocks are decoded only if they overlap the synced dates
+        first_date = datetime.datetime.strptime(str(synced_dates[0]), '%Y%m%d').date()
+        last_date = datetime.datetime.strptime(str(synced_dates[-1]), '%Y%m%d').date()
+        qs = self.filter(series_key=series_key)
+        existing = {
+            obj.stock_code: obj
+            for obj in qs.filter(
+                Q(first_date__lte=last_date, last_date__gte=first_date) | Q(stock_code__in=list(new_by_code.keys()))
+            )
+        }
+        mapper = apps.get_model('api', 'Security').objects.get_mapper()
+        codes = sorted(set(new_by_code.keys()) | set(existing.keys()))
+        security_ids = dict(zip(codes, mapper.map(np.array(codes, dtype=str)).tolist()))
+        objs = list()
+        emptied = list()
+        for stock_code in codes:
+            new_dates, new_values = new_by_code.get(stock_code, (np.array([], dtype=np.int32), np.array([])))
+            obj = existing.get(stock_code)
+            if obj is not None:
+                cols = obj.get_columns()
+                is_kept = ~np.isin(cols['date'], synced_dates)
+                if is_kept.all() and len(new_dates) == 0:
+                    continue
+                new_dates = np.concatenate([cols['date'][is_kept], new_dates])
+                new_values = np.concatenate([cols['value'][is_kept], new_values])
+                order = np.argsort(new_dates, kind='stable')
+                new_dates, new_values = new_dates[order], new_values[order]
+            if len(new_dates) == 0:
+                emptied.append(stock_code)
+                continue
+            blob = encode_columns({'date': new_dates.astype(np.int32), 'value': new_values})
+            objs.append(self.model(
+                stock_code = stock_code,
+                security_id = security_ids[stock_code] if security_ids[stock_code] >= 0 else None,
+                series_key = series_key,
+                first_date = datetime.datetime.strptime(str(new_dates[0]), '%Y%m%d').date(),
+                last_date = datetime.datetime.strptime(str(new_dates[-1]), '%Y%m%d').date(),
+                length = len(new_dates),
+                blob = blob,
+                checksum = hashlib.sha256(blob).hexdigest()
+            ))
+        bulk_upsert(
+            self,
+            objs,
+            ['stock_code', 'series_key'],
+            ['security', 'first_date', 'last_date', 'length', 'blob', 'checksum'],
+            batch_size = 1000
+        )
+        if len(emptied) > 0:
+            qs.filter(stock_code__in=emptied).delete()
+        return len(objs)
+
+    def get_history(self, stock_code, series_keys=None):
+        # result looks like {series_key: {'date': np.ndarray, 'value': np.ndarray}, ...}
+        qs = self.filter(stock_code=normalize_stock_codes([stock_code])[0])
+        if series_keys:
+            qs = qs.filter(series_key__in=series_keys)
+        return {obj.series_key: obj.get_columns() for obj in qs}
+
 
 class SingleAccountClientManager(models.Manager):
     def get_or_create_using_conf(self, conf):
@@ -207,8 +544,9 @@ class SingleAccountClientManager(models.Manager):
         if len(ls_outdated) == 0:
             print('No outdated single account data.')
             return
-        classified = self.classify_outdated_by_sources(ls_outdated)
-        self.update_outdated(classified)
+        with advisory_locks([f"single_account_client:{obj.id}" for obj in ls_outdated]):
+            classified = self.classify_outdated_by_sources(ls_outdated)
+            self.update_outdated(classified)
 
     def list_outdated(self):
         ls = list()
@@ -236,12 +574,14 @@ class SingleAccountClientManager(models.Manager):
         nstd_records = list()
         zfmodel = apps.get_model('api', 'OpendartZipfile')
         tfmodel = apps.get_model('api', 'OpendartTextfile')
+        zfobjs = zfmodel.objects.in_bulk(list(classified.keys()))
+        tfobjs = tfmodel.objects.in_bulk([tfid for d in classified.values() for tfid in d.keys()])
         for zfid, d in classified.items():
-            zfobj = zfmodel.objects.get(pk=zfid)
+            zfobj = zfobjs[zfid]
             zf = zfobj.get_file()
             for tfid, ls_obj in d.items():
                 acnt_nm_to_obj_map = {obj.name: obj for obj in ls_obj}
-                tfobj = tfmodel.objects.get(pk=tfid)
+                tfobj = tfobjs[tfid]
                 tfnm = tfobj.get_dirty_filename()
                 tf = zf.open(tfnm)
                 records = tfobj.get_records(use_file=tf)
@@ -272,7 +612,7 @@ class SingleAccountClientManager(models.Manager):
             records += matched_nstd_records
             obj.write_file(use_records=records)
             obj.last_update = obj.get_last_update_of_sources()
-            obj.save()
+            obj.save(update_fields=['last_update'])
             print(f"SingleAccountClient {obj.__str__()} was updated.")
 
 
@@ -285,30 +625,38 @@ class VariableManager:
         is_changed = False
         opendart_changed = kwargs.get('opendart_changed')
         ls = list()
-        for tp, ls_conf in self.configs.items():
-            for conf in ls_conf:
-                model = apps.get_model('api', conf['model_name'])
-                if tp == 'etc':
-                    var, created = model.objects.get_or_create(
-                        name = conf['name'],
-                        label_en = conf['label_en'],
-                        label_kr = conf['label_kr'],
-                    )
-                else:
-                    var, created = model.objects.get_or_create_using_conf(conf)
-                if not (created or opendart_changed):
-                    ls.append(var)
-                    continue
-                var.bulk_sync_data()
-                if created:
-                    print(f"{var} was created.")
-                is_changed = is_changed or created or opendart_changed
+        for tp, conf in self.list_configs():
+            var, synced = self.sync_using_conf(tp, conf, opendart_changed=opendart_changed)
+            if not synced:
+                ls.append(var)
+            is_changed = is_changed or synced
         if not is_changed:
             print("Variable models have already been synced to sources.")
         return_list = kwargs.get('return_list')
         if return_list:
             return ls
 
+    def list_configs(self):
+        return [(tp, conf) for tp, ls_conf in self.configs.items() for conf in ls_conf]
+
+    def sync_using_conf(self, tp, conf, **kwargs):
+        model = apps.get_model('api', conf['model_name'])
+        with advisory_lock('variable_configs'):
+            if tp == 'etc':
+                var, created = model.objects.get_or_create(
+                    name = conf['name'],
+                    label_en = conf['label_en'],
+                    label_kr = conf['label_kr'],
+                )
+            else:
+                var, created = model.objects.get_or_create_using_conf(conf)
+        if not (created or kwargs.get('opendart_changed')):
+            return var, False
+        var.bulk_sync_data()
+        if created:
+            print(f"{var} was created.")
+        return var, True
+
     def list(self):
         return self.bulk_sync(return_list=True)
 
@@ -388,6 +736,7 @@ class PriceRatioManager(models.Manager):
         obj, created = self.get_or_create(
             name = conf['name'],
             numerator = numerator,
+            reporting_lag = conf.get('reporting_lag', 0),
         )
         if obj.label_en == None:
             obj.label_en = conf['name'].replace('_', ' ')
@@ -414,21 +763,118 @@ class MomentumManager(models.Manager):
             obj.save()
         return obj, created
 
+    def get_values(self, near, far):
+        # Values of every momentum window are computed in one pass
+        # and cached along with the month-end panel they came from.
+        spmodel = apps.get_model('api', 'StockPrice')
+        panel = spmodel.objects.get_monthend_panel(fields=['mktcap'])
+        windows = set(self.values_list('near', 'far')) | set([(near, far)])
+        cache = getattr(self, '_values_cache', dict())
+        if cache.get('panel') is not panel or not windows <= cache['values'].keys():
+            locs = [month_key(dt) - month_key(panel.dates[0]) for dt in panel.dates]
+            prices = np.full((locs[-1] + 1, len(panel.stock_codes)), np.nan)
+            prices[locs] = panel.values['mktcap']
+            values = momentum_values(prices, windows)
+            self._values_cache = {
+                'panel': panel,
+                'values': {k: v[locs] for k, v in values.items()},
+            }
+        return panel, self._values_cache['values'][(near, far)]
+
 
 class BacktesterManager(models.Manager):
-    def bulk_sync(self):
+    def bulk_sync(self, **kwargs):
+        processes = kwargs.get('processes', settings.BACKTESTER_PROCESSES)
+        with resolving() as registry:
+            backtesters = self.get_or_create_all_using_confs()
+            # factors of every backtester in one query per model
+            registry.resolve_many([factor for backtester in backtesters for factor in backtester.factors])
+            if processes > 1:
+                self.bulk_sync_in_parallel(backtesters, processes)
+                return
+            for backtester in backtesters:
+                backtester.bulk_sync_data()
+
+    @advisory_lock('backtester_configs')
+    def get_or_create_all_using_confs(self):
         from api.src.backtester_configs import UNIVARIATE_BACKTESTER_CONFIGS
         from api.src.backtester_configs import MULTIVARIATE_BACKTESTER_CONFIGS
+        backtesters = list()
         for conf in UNIVARIATE_BACKTESTER_CONFIGS:
             backtester, created = self.get_or_create_univariate_using_conf(conf)
             if not backtester.portfolios.exists():
                 portfolios, created = backtester.get_or_create_portfolios()
-            backtester.bulk_sync_data()
+            backtesters.append(backtester)
         for conf in MULTIVARIATE_BACKTESTER_CONFIGS:
             backtester, created = self.get_or_create_multivariate_using_conf(conf)
             if not backtester.portfolios.exists():
                 portfolios, created = backtester.get_or_create_portfolios()
-            backtester.bulk_sync_data()
+            backtesters.append(backtester)
+        return backtesters
+
+    @traced
+    def bulk_sync_in_parallel(self, backtesters, processes):
+        # Factor records and prices are loaded once for all backtesters,
+        # formations are fanned out to a process pool and
+        # portfolio data are persisted together.
+        vdmodel = apps.get_model('api', 'VariableData')
+
+        # locked before outdated formations are listed, so that they are not synced meanwhile
+        with advisory_locks([f"backtester:{backtester.id}" for backtester in backtesters]):
+            tasks = list()
+            for i, backtester in enumerate(backtesters):
+                outdated = backtester.list_outdated_formations()
+                for rbdt_str, ls_ids in outdated.items():
+                    tasks.append(((i, rbdt_str), ls_ids, backtester.factors))
+            ids = set([id for key, ls_ids, factors in tasks for ids in ls_ids for id in ids])
+            records_by_id = {
+                obj.id: obj.get_records()
+                for obj in vdmodel.objects.filter(id__in=ids).only('id', 'records', 'blob')
+            }
+            # Forked workers compute on inherited records only and exit without
+            # closing the inherited connection, which keeps holding the mysql locks.
+            results = assign_quantile_locs_in_parallel(tasks, records_by_id, processes)
+            self.save_formed_in_parallel(backtesters, results)
+
+    def save_formed_in_parallel(self, backtesters, results):
+        spmodel = apps.get_model('api', 'StockPrice')
+        fpdmodel = apps.get_model('api', 'FactorPortfolioData')
+        ls_periods = list()
+        for i, backtester in enumerate(backtesters):
+            formed = {
+                rbdt_str: backtester.label_entries(group_entries_by_quantile_locs(*arrays))
+                for (j, rbdt_str), arrays in results.items() if j == i
+            }
+            changed_history, history = backtester.merge_formations(formed)
+            ls_periods.append(backtester.list_outdated_periods(changed_history, history))
+
+        periods = [p for ps in ls_periods for p in ps]
+        if len(periods) == 0:
+            print("PortfolioData have already been synced to sources.")
+            return
+        panel = spmodel.objects.get_panel(
+            start_dt = min([p[0] for p in periods]),
+            end_dt = max([p[1] for p in periods]),
+            fields = ['mktcap', 'ri']
+        )
+        created = []
+        updated = []
+        synced = []
+        for backtester, periods in zip(backtesters, ls_periods):
+            if len(periods) == 0:
+                print(f"PortfolioData for {backtester} has already been synced to sources.")
+                continue
+            _created, _updated = backtester.collect_updated_data_from_price_panel(panel, periods)
+            created += _created
+            updated += _updated
+            synced.append(backtester)
+        if len(created) > 0:
+            bulk_upsert(fpdmodel.objects, created, ['portfolio', 'date'], ['last_date', 'blob'])
+        if len(updated) > 0:
+            fpdmodel.objects.bulk_update(updated, ['last_date', 'blob'])
+        for backtester in synced:
+            backtester.write_file()
+            print(f"PortfolioData for {backtester} was synced to sources successfully.")
 
     def get_or_create_univariate_using_conf(self, conf):
         factor_conf = conf.copy()
@@ -484,3 +930,77 @@ class BacktesterManager(models.Manager):
             rebalancing_frequency = conf['rebalancing_frequency']
         )
         return obj, created
+
+
+class WorkUnitManager(models.Manager):
+    def enqueue(self, run, stage, keys, depends_on=None, params=None):
+        self.bulk_create([
+            self.model(
+                run = run,
+                stage = stage,
+                key = key,
+                depends_on = depends_on or list(),
+                params = params or dict()
+            ) for key in keys
+        ], ignore_conflicts=True)
+
+    def get_leasable(self, run):
+        # pending units and units of crashed workers whose leases expired
+        now = datetime.datetime.now()
+        return self.filter(run=run).filter(Q(status='pending') | Q(status='leased', leased_until__lt=now))
+
+    def list_ready(self, run):
+        blocking = set(self.filter(run=run).exclude(status='completed').values_list('stage', flat=True))
+        qs = self.get_leasable(run).order_by('id').only('id', 'depends_on', 'status', 'leased_until', 'attempts')
+        return [unit for unit in qs if len(blocking & set(unit.depends_on)) == 0]
+
+    def lease(self, run, owner, lease_seconds, max_attempts):
+        skip_locked = connections[self.db].features.has_select_for_update_skip_locked
+        for unit in self.list_ready(run):
+            with transaction.atomic():
+                qs = self.get_leasable(run).filter(id=unit.id)
+                if skip_locked and len(qs.select_for_update(skip_locked=True)) == 0:
+                    continue
+                # compare-and-set on the read status, which is the only guard on sqlite
+                qs = qs.filter(status=unit.status, leased_until=unit.leased_until)
+                if unit.attempts >= max_attempts:
+                    qs.update(
+                        status = 'failed',
+                        error = f"lease expired after {unit.attempts} attempts.",
+                        ended_at = datetime.datetime.now()
+                    )
+                    continue
+                leased = qs.update(
+                    status = 'leased',
+                    owner = owner,
+                    leased_until = datetime.datetime.now() + timedelta(seconds=lease_seconds),
+                    attempts = F('attempts') + 1
+                )
+            if leased == 1:
+                return self.get(id=unit.id)
+        return None
+
+    def heartbeat(self, unit, lease_seconds):
+        return self.filter(id=unit.id, owner=unit.owner, status='leased').update(
+            leased_until = datetime.datetime.now() + timedelta(seconds=lease_seconds)
+        ) == 1
+
+    def complete(self, unit, wall_time):
+        return self.filter(id=unit.id, owner=unit.owner, status='leased').update(
+            status = 'completed',
+            wall_time = F('wall_time') + wall_time,
+            error = None,
+            ended_at = datetime.datetime.now()
+        ) == 1
+
+    def fail(self, unit, error, wall_time, max_attempts):
+        return self.filter(id=unit.id, owner=unit.owner, status='leased').update(
+            status = 'pending' if unit.attempts < max_attempts else 'failed',
+            owner = None,
+            leased_until = None,
+            wall_time = F('wall_time') + wall_time,
+            error = error
+        ) == 1
+
+    def retry_failed(self, run):
+        return self.filter(run=run, status='failed').update(status='pending', attempts=0, ended_at=None)
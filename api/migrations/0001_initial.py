@@ -0,0 +1,229 @@
+# Generated by Django 4.1.5 on 2026-10-20 05:15
+
+import api.models
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountRatio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('label_en', models.CharField(blank=True, max_length=128, null=True)),
+                ('label_kr', models.CharField(blank=True, max_length=128, null=True)),
+                ('file', models.FileField(upload_to='products/variables')),
+                ('url', models.TextField(null=True)),
+                ('last_update', models.DateField(auto_now=True)),
+                ('numerator', models.JSONField(default=api.models.DEFAULT_DICT)),
+                ('denominator', models.JSONField(default=api.models.DEFAULT_DICT)),
+            ],
+            options={
+                'db_table': 'account_ratio',
+            },
+        ),
+        migrations.CreateModel(
+            name='Backtester',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('factors', models.JSONField(default=api.models.DEFAULT_LIST)),
+                ('rebalancing_frequency', models.IntegerField(default=12)),
+                ('rebalancing_history', models.JSONField(default=api.models.DEFAULT_DICT)),
+                ('file', models.FileField(upload_to='products/factor-portfolios')),
+                ('url', models.TextField(null=True)),
+            ],
+            options={
+                'db_table': 'backtester',
+            },
+        ),
+        migrations.CreateModel(
+            name='CorpList',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('records', models.JSONField(default=api.models.DEFAULT_LIST)),
+            ],
+            options={
+                'db_table': 'corp_list',
+            },
+        ),
+        migrations.CreateModel(
+            name='FactorPortfolio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantile_locs', models.JSONField(default=api.models.DEFAULT_LIST)),
+                ('backtester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='portfolios', to='api.backtester')),
+            ],
+            options={
+                'db_table': 'factor_portfolio',
+            },
+        ),
+        migrations.CreateModel(
+            name='MixedAccount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('label_en', models.CharField(blank=True, max_length=128, null=True)),
+                ('label_kr', models.CharField(blank=True, max_length=128, null=True)),
+                ('file', models.FileField(upload_to='products/variables')),
+                ('url', models.TextField(null=True)),
+                ('last_update', models.DateField(auto_now=True)),
+                ('ordered_single_accounts', models.JSONField(default=api.models.DEFAULT_LIST)),
+            ],
+            options={
+                'db_table': 'mixed_account',
+            },
+        ),
+        migrations.CreateModel(
+            name='Momentum',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('label_en', models.CharField(blank=True, max_length=128, null=True)),
+                ('label_kr', models.CharField(blank=True, max_length=128, null=True)),
+                ('file', models.FileField(upload_to='products/variables')),
+                ('url', models.TextField(null=True)),
+                ('last_update', models.DateField(auto_now=True)),
+                ('near', models.IntegerField()),
+                ('far', models.IntegerField()),
+            ],
+            options={
+                'db_table': 'momentum',
+            },
+        ),
+        migrations.CreateModel(
+            name='OpendartZipfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(max_length=128)),
+                ('last_update', models.DateTimeField(default=datetime.datetime(1, 1, 1, 0, 0))),
+                ('file', models.FileField(null=True, upload_to='opendart-financial-statements-clone')),
+            ],
+            options={
+                'db_table': 'source_opendart_zipfile',
+            },
+        ),
+        migrations.CreateModel(
+            name='PriceRatio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('label_en', models.CharField(blank=True, max_length=128, null=True)),
+                ('label_kr', models.CharField(blank=True, max_length=128, null=True)),
+                ('file', models.FileField(upload_to='products/variables')),
+                ('url', models.TextField(null=True)),
+                ('last_update', models.DateField(auto_now=True)),
+                ('numerator', models.JSONField(default=api.models.DEFAULT_DICT)),
+            ],
+            options={
+                'db_table': 'price_ratio',
+            },
+        ),
+        migrations.CreateModel(
+            name='SingleAccountClient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('label_en', models.CharField(blank=True, max_length=128, null=True)),
+                ('label_kr', models.CharField(blank=True, max_length=128, null=True)),
+                ('fs_div', models.CharField(choices=[('BS', 'balance sheet'), ('PL', 'income statement'), ('CF', 'cashflow statement')], max_length=2)),
+                ('cfs', models.BooleanField(default=True)),
+                ('file', models.FileField(null=True, upload_to='opendart-account-panel')),
+                ('last_update', models.DateField(default=datetime.date(1, 1, 1))),
+            ],
+            options={
+                'db_table': 'source_single_account_client',
+            },
+        ),
+        migrations.CreateModel(
+            name='Size',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('label_en', models.CharField(blank=True, max_length=128, null=True)),
+                ('label_kr', models.CharField(blank=True, max_length=128, null=True)),
+                ('file', models.FileField(upload_to='products/variables')),
+                ('url', models.TextField(null=True)),
+                ('last_update', models.DateField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'size',
+            },
+        ),
+        migrations.CreateModel(
+            name='StockPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('records', models.JSONField(default=api.models.DEFAULT_LIST)),
+                ('is_monthend', models.BooleanField(default=False)),
+                ('file', models.FileField(null=True, upload_to='openapi-stock-prices-clone')),
+                ('url', models.TextField(null=True)),
+            ],
+            options={
+                'db_table': 'stock_price',
+            },
+        ),
+        migrations.CreateModel(
+            name='VariableData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variable', models.JSONField(verbose_name=api.models.DEFAULT_DICT)),
+                ('date', models.DateField()),
+                ('records', models.JSONField(verbose_name=api.models.DEFAULT_LIST)),
+            ],
+            options={
+                'db_table': 'variable_data',
+            },
+        ),
+        migrations.CreateModel(
+            name='SingleAccount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('label_en', models.CharField(blank=True, max_length=128, null=True)),
+                ('label_kr', models.CharField(blank=True, max_length=128, null=True)),
+                ('file', models.FileField(upload_to='products/variables')),
+                ('url', models.TextField(null=True)),
+                ('last_update', models.DateField(auto_now=True)),
+                ('client', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='variable', to='api.singleaccountclient')),
+            ],
+            options={
+                'db_table': 'single_account',
+            },
+        ),
+        migrations.CreateModel(
+            name='OpendartTextfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(max_length=128)),
+                ('last_update', models.DateField(default=datetime.date.today)),
+                ('contains', models.JSONField(default=api.models.DEFAULT_LIST)),
+                ('is_in', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='text_files', to='api.opendartzipfile')),
+            ],
+            options={
+                'db_table': 'source_opendart_textfile',
+            },
+        ),
+        migrations.CreateModel(
+            name='FactorPortfolioData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('mktcap', models.BigIntegerField()),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='data', to='api.factorportfolio')),
+            ],
+            options={
+                'db_table': 'factor_portfolio_data',
+            },
+        ),
+    ]
@@ -0,0 +1,306 @@
+# Generated by Django 4.1.5 on 2026-10-20 05:15
+
+import api.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=256)),
+                ('completed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'batch_checkpoint',
+            },
+        ),
+        migrations.CreateModel(
+            name='BatchRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'running'), ('completed', 'completed'), ('partial', 'partial'), ('failed', 'failed')], default='running', max_length=16)),
+                ('selected_stages', models.JSONField(null=True)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('ended_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'db_table': 'batch_run',
+            },
+        ),
+        migrations.CreateModel(
+            name='BatchStage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('running', 'running'), ('completed', 'completed'), ('skipped', 'skipped'), ('failed', 'failed')], default='running', max_length=16)),
+                ('fingerprint', models.JSONField(default=api.models.DEFAULT_DICT)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('ended_at', models.DateTimeField(null=True)),
+                ('wall_time', models.FloatField(default=0)),
+                ('rows', models.IntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('error', models.TextField(null=True)),
+            ],
+            options={
+                'db_table': 'batch_stage',
+            },
+        ),
+        migrations.CreateModel(
+            name='Security',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stock_code', models.CharField(max_length=16, unique=True)),
+                ('isin_code', models.CharField(max_length=16, null=True)),
+                ('crno', models.CharField(max_length=16, null=True)),
+                ('market', models.CharField(max_length=16)),
+                ('name', models.CharField(max_length=128)),
+                ('history', models.JSONField(default=api.models.DEFAULT_LIST)),
+                ('first_date', models.DateField()),
+                ('last_date', models.DateField()),
+            ],
+            options={
+                'db_table': 'security',
+            },
+        ),
+        migrations.CreateModel(
+            name='StockDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('stock_code', models.CharField(max_length=16)),
+                ('market', models.CharField(max_length=16)),
+                ('open', models.BigIntegerField(null=True)),
+                ('high', models.BigIntegerField(null=True)),
+                ('low', models.BigIntegerField(null=True)),
+                ('close', models.BigIntegerField(null=True)),
+                ('ri', models.FloatField(null=True)),
+                ('vol_n', models.BigIntegerField(null=True)),
+                ('vol_m', models.BigIntegerField(null=True)),
+                ('n_listed', models.BigIntegerField(null=True)),
+                ('mktcap', models.BigIntegerField(null=True)),
+            ],
+            options={
+                'db_table': 'stock_daily',
+            },
+        ),
+        migrations.CreateModel(
+            name='StockSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stock_code', models.CharField(max_length=16)),
+                ('series_key', models.CharField(max_length=64)),
+                ('first_date', models.DateField()),
+                ('last_date', models.DateField()),
+                ('length', models.IntegerField()),
+                ('blob', models.BinaryField()),
+                ('checksum', models.CharField(max_length=64)),
+            ],
+            options={
+                'db_table': 'stock_series',
+            },
+        ),
+        migrations.CreateModel(
+            name='WorkUnit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=64)),
+                ('key', models.CharField(max_length=256)),
+                ('depends_on', models.JSONField(default=api.models.DEFAULT_LIST)),
+                ('params', models.JSONField(default=api.models.DEFAULT_DICT)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('leased', 'leased'), ('completed', 'completed'), ('failed', 'failed')], default='pending', max_length=16)),
+                ('owner', models.CharField(max_length=128, null=True)),
+                ('leased_until', models.DateTimeField(null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('wall_time', models.FloatField(default=0)),
+                ('error', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('ended_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'db_table': 'work_unit',
+            },
+        ),
+        migrations.RemoveField(
+            model_name='factorportfoliodata',
+            name='mktcap',
+        ),
+        migrations.AddField(
+            model_name='accountratio',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='backtester',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='backtester',
+            name='formation_fingerprints',
+            field=models.JSONField(default=api.models.DEFAULT_DICT),
+        ),
+        migrations.AddField(
+            model_name='factorportfolio',
+            name='quantile_key',
+            field=models.CharField(max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='factorportfoliodata',
+            name='blob',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='factorportfoliodata',
+            name='last_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='mixedaccount',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='momentum',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='opendartzipfile',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='priceratio',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='priceratio',
+            name='reporting_lag',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='singleaccount',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='singleaccountclient',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='size',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='stockprice',
+            name='file_checksum',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='stockprice',
+            name='is_normalized',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='variabledata',
+            name='blob',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='variabledata',
+            name='checksum',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='variabledata',
+            name='variable_key',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='corplist',
+            name='date',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='stockprice',
+            name='date',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='stockprice',
+            index=models.Index(fields=['is_monthend', 'date'], name='stock_price_monthend_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='factorportfoliodata',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'date'), name='factor_portfolio_data_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='opendarttextfile',
+            constraint=models.UniqueConstraint(fields=('is_in', 'identifier'), name='opendart_textfile_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='opendartzipfile',
+            constraint=models.UniqueConstraint(fields=('identifier',), name='opendart_zipfile_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='singleaccountclient',
+            constraint=models.UniqueConstraint(fields=('fs_div', 'name', 'cfs'), name='single_account_client_uniq'),
+        ),
+        migrations.AddField(
+            model_name='workunit',
+            name='run',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='units', to='api.batchrun'),
+        ),
+        migrations.AddField(
+            model_name='stockseries',
+            name='security',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='series', to='api.security'),
+        ),
+        migrations.AddField(
+            model_name='stockdaily',
+            name='security',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='daily', to='api.security'),
+        ),
+        migrations.AddField(
+            model_name='batchstage',
+            name='run',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='api.batchrun'),
+        ),
+        migrations.AddField(
+            model_name='batchcheckpoint',
+            name='stage',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='api.batchstage'),
+        ),
+        migrations.AddIndex(
+            model_name='workunit',
+            index=models.Index(fields=['run', 'status'], name='work_unit_status_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='workunit',
+            constraint=models.UniqueConstraint(fields=('run', 'stage', 'key'), name='work_unit_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='stockseries',
+            constraint=models.UniqueConstraint(fields=('stock_code', 'series_key'), name='stock_series_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='stockdaily',
+            index=models.Index(fields=['stock_code', 'date'], name='stock_daily_stock_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='stockdaily',
+            constraint=models.UniqueConstraint(fields=('date', 'stock_code', 'market'), name='stock_daily_uniq'),
+        ),
+    ]
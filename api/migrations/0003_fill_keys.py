@@ -0,0 +1,57 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+# Key columns of rows created before the keys were added are filled in
+# before they become not null and unique, see 0004.
+# Rows that were synced again while their keys were null are duplicates
+# of the same (variable_key, date), the latest row of each is kept.
+
+BATCH_SIZE = 1000
+
+def fill_variable_keys(apps, schema_editor):
+    vdmodel = apps.get_model('api', 'VariableData')
+    qs = vdmodel.objects.filter(variable_key__isnull=True).only('id', 'variable').order_by('id')
+    filled = 0
+    while True:
+        batch = list(qs[:BATCH_SIZE])
+        if len(batch) == 0:
+            break
+        for obj in batch:
+            obj.variable_key = f"{obj.variable['model_name']}:{obj.variable['id']}"
+        vdmodel.objects.bulk_update(batch, ['variable_key'])
+        filled += len(batch)
+
+    duplicated = vdmodel.objects.values('variable_key', 'date').annotate(
+        n = Count('id'),
+        last_id = Max('id')
+    ).filter(n__gt=1)
+    removed = 0
+    for d in duplicated:
+        removed += vdmodel.objects.filter(
+            variable_key = d['variable_key'],
+            date = d['date']
+        ).exclude(id=d['last_id']).delete()[0]
+    if filled > 0:
+        print(f"variable_key of {filled} number of VariableData were filled, {removed} duplicates were removed.")
+
+def fill_quantile_keys(apps, schema_editor):
+    fpmodel = apps.get_model('api', 'FactorPortfolio')
+    ls = list(fpmodel.objects.filter(quantile_key__isnull=True).only('id', 'quantile_locs'))
+    for obj in ls:
+        obj.quantile_key = '_'.join([str(loc) for loc in obj.quantile_locs])
+    fpmodel.objects.bulk_update(ls, ['quantile_key'], batch_size=BATCH_SIZE)
+    if len(ls) > 0:
+        print(f"quantile_key of {len(ls)} number of FactorPortfolio were filled.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_schema'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_variable_keys, migrations.RunPython.noop),
+        migrations.RunPython(fill_quantile_keys, migrations.RunPython.noop),
+    ]
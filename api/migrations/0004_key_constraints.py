@@ -0,0 +1,31 @@
+# Generated by Django 4.1.5 on 2026-10-20 05:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_fill_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='factorportfolio',
+            name='quantile_key',
+            field=models.CharField(max_length=32),
+        ),
+        migrations.AlterField(
+            model_name='variabledata',
+            name='variable_key',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='factorportfolio',
+            constraint=models.UniqueConstraint(fields=('backtester', 'quantile_key'), name='factor_portfolio_key_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='variabledata',
+            constraint=models.UniqueConstraint(fields=('variable_key', 'date'), name='variable_data_key_date_uniq'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+# Dates of price and corp list data become unique, see 0006.
+# Dates synced more than once by overlapping runs keep their latest row.
+
+def dedupe_dates(apps, schema_editor):
+    for model_name in ['StockPrice', 'CorpList']:
+        model = apps.get_model('api', model_name)
+        duplicated = model.objects.values('date').annotate(
+            n = Count('id'),
+            last_id = Max('id')
+        ).filter(n__gt=1)
+        removed = 0
+        for d in duplicated:
+            removed += model.objects.filter(date=d['date']).exclude(id=d['last_id']).delete()[0]
+        if removed > 0:
+            print(f"{removed} duplicated {model_name} were removed.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_key_constraints'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_dates, migrations.RunPython.noop),
+    ]
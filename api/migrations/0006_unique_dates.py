@@ -0,0 +1,23 @@
+# Generated by Django 4.1.5 on 2026-10-20 05:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_dedupe_dates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='corplist',
+            name='date',
+            field=models.DateField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='stockprice',
+            name='date',
+            field=models.DateField(unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-20 05:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_unique_dates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stockprice',
+            name='last_update',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
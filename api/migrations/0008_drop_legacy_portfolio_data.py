@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+# FactorPortfolioData used to be a row per day with the mktcap and returns of the day,
+# since 0002 it is a row per holding period whose returns are encoded into blob.
+# Rows of the former schema have no blob and no last_date, they are removed and
+# their backtesters forget their formations, so that the next sync forms
+# and writes every holding period again.
+
+def drop_legacy_portfolio_data(apps, schema_editor):
+    fpdmodel = apps.get_model('api', 'FactorPortfolioData')
+    btmodel = apps.get_model('api', 'Backtester')
+    legacy = fpdmodel.objects.filter(blob__isnull=True)
+    backtester_ids = list(legacy.values_list('portfolio__backtester_id', flat=True).distinct())
+    removed = legacy.delete()[0]
+    btmodel.objects.filter(id__in=backtester_ids).update(
+        rebalancing_history = dict(),
+        formation_fingerprints = dict()
+    )
+    if removed > 0:
+        print(f"{removed} number of legacy FactorPortfolioData were removed, {len(backtester_ids)} backtesters will be synced again.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_stock_price_last_update'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_legacy_portfolio_data, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,9 @@
 from .managers import (
     OpendartZipfileManager,
     StockPriceManager,
+    StockDailyManager,
+    SecurityManager,
+    StockSeriesManager,
     CorpListManager,
     SingleAccountClientManager,
     SingleAccountManager,
@@ -9,10 +12,35 @@ from .managers import (
     PriceRatioManager,
     MomentumManager,
     BacktesterManager,
+    WorkUnitManager,
 )
+from .clients import OpendartDownloader
+from .blobs import (
+    decode_columns,
+    decode_records,
+    encode_columns,
+    encode_records,
+    columns_of_records,
+)
+from .engines import (
+    ColumnVocabulary,
+    VariableColumns,
+    assign_quantile_locs,
+    group_entries_by_quantile_locs,
+    holding_period_returns,
+    list_rebalancing_dates,
+    month_keys_of_strdates,
+    normalize_stock_codes,
+)
+from .instrumentation import traced
+from .locks import locked
+from .registry import get_registry
+from .uploads import upload_file, wait_for_upload
 from .tools import (
+    bulk_upsert,
     convert_records_to_csv,
     create_zipfile,
+    hash_records,
 )
 from .src import constants
 
@@ -24,11 +52,10 @@ from django.conf import settings
 from django.core.files.base import ContentFile
 from functools import reduce
 from io import BytesIO
-from itertools import product, zip_longest
+from itertools import groupby, product, zip_longest
 
 import datetime
 import json
-import requests
 import numpy as np
 import pandas as pd
 import zipfile
@@ -50,33 +77,36 @@ class OpendartFile(models.Model):
 class OpendartZipfile(OpendartFile):
     last_update = models.DateTimeField(default=datetime.datetime.min)
     file = models.FileField(upload_to='opendart-financial-statements-clone', null=True)
+    file_checksum = models.CharField(max_length=64, null=True)
     objects = OpendartZipfileManager()
 
     class Meta:
         db_table = 'source_opendart_zipfile'
+        constraints = [
+            models.UniqueConstraint(fields=['identifier'], name='opendart_zipfile_uniq'),
+        ]
 
     def __str__(self):
         return f"{self.identifier}_{self.last_update.strftime('%Y%m%d%H%M%S')}.zip"
 
     def download_from_source(self):
-        url = 'https://opendart.fss.or.kr/cmm/downloadFnlttZip.do'
-        payload = {'fl_nm': self.__str__()}
-        headers = {
-            'Referer':'https://opendart.fss.or.kr/disclosureinfo/fnltt/dwld/main.do',
-            'User-Agent':'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.51 Safari/537.36',
-        }
-        r = requests.get(url, payload, headers=headers)
-        return BytesIO(r.content)
+        # result is the path of the downloaded archive
+        return OpendartDownloader().download(self.__str__())
 
     def get_file(self):
+        wait_for_upload(self)
         self.file.seek(0)
         return zipfile.ZipFile(BytesIO(self.file.read()))
 
     def get_clean_text_filename(self, text_filename):
         return text_filename.encode('cp437').decode('cp949')
 
-    def bootstrap_text_files(self):
-        zf = self.get_file()
+    def bootstrap_text_files(self, **kwargs):
+        use_file = kwargs.get('use_file')
+        if use_file:
+            zf = zipfile.ZipFile(use_file)
+        else:
+            zf = self.get_file()
         for tfnm in zf.namelist():
             clean_tfnm = self.get_clean_text_filename(tfnm)
             d = self.parse_text_filename(clean_tfnm)
@@ -111,6 +141,9 @@ class OpendartTextfile(OpendartFile):
 
     class Meta:
         db_table = 'source_opendart_textfile'
+        constraints = [
+            models.UniqueConstraint(fields=['is_in', 'identifier'], name='opendart_textfile_uniq'),
+        ]
 
     def __str__(self):
         return f"{self.identifier}_{self.last_update.strftime('%Y%m%d')}.txt"
@@ -124,6 +157,7 @@ class OpendartTextfile(OpendartFile):
         self.save()
         return self.contains
 
+    @traced
     def get_records(self, **kwargs):
         f = kwargs.get('use_file')
         if not f:
@@ -144,6 +178,7 @@ class OpendartTextfile(OpendartFile):
             v['label_en']: r[k] for k, v in self.HEADERS.items()
         } for r in records]
 
+    @traced
     def get_dataframe(self, **kwargs):
         f = kwargs.get('use_file')
         if f:
@@ -162,7 +197,7 @@ class OpendartTextfile(OpendartFile):
                 if c == 'value':
                     df[c] = df[c].str.replace(',', '').replace('', None).astype(tp)
                 elif c == 'stock_code':
-                    df[c] = df[c].str[1:-1]
+                    df[c] = normalize_stock_codes(df[c])
                 else:
                     df[c] = df[c].astype(tp)
         return df
@@ -219,11 +254,15 @@ class SingleAccountClient(models.Model):
     fs_div = models.CharField(max_length=2, choices=FS_DIV_CHOICES)
     cfs = models.BooleanField(default=True)
     file = models.FileField(upload_to='opendart-account-panel', null=True)
+    file_checksum = models.CharField(max_length=64, null=True)
     last_update = models.DateField(default=datetime.date.min)
     objects = SingleAccountClientManager()
 
     class Meta:
         db_table = 'source_single_account_client'
+        constraints = [
+            models.UniqueConstraint(fields=['fs_div', 'name', 'cfs'], name='single_account_client_uniq'),
+        ]
 
     def __str__(self):
         return f"{self.fs_div}_{self.capitalized_name}_{self.oc_label}"
@@ -237,6 +276,7 @@ class SingleAccountClient(models.Model):
         return ''.join([x.capitalize() for x in self.name.split('_')])
 
 
+    @locked(lambda self: f"single_account_client:{self.id}")
     def sync_to_sources(self):
         last_update = self.get_last_update_of_sources()
         if self.last_update >= last_update:
@@ -244,21 +284,21 @@ class SingleAccountClient(models.Model):
             return
         self.write_file()
         self.last_update = last_update
-        self.save()
+        # file fields are saved by the pending upload
+        self.save(update_fields=['last_update'])
 
     def get_file(self):
+        wait_for_upload(self)
         self.file.seek(0)
         return zipfile.ZipFile(BytesIO(self.file.read()))
 
     def get_records_from_sources(self):
-        d_sources = self.list_sources(to_dict=True)
         std_records = []
         nstd_records = []
-        for zf_id, ls_tf_id in d_sources.items():
-            zf = OpendartZipfile.objects.get(id=zf_id)
-            _zf = zf.get_file()
-            for tf_id in ls_tf_id:
-                tf = OpendartTextfile.objects.get(id=tf_id)
+        for zf_id, ls_tf in groupby(self.list_source_textfiles(), key=lambda tf: tf.is_in_id):
+            ls_tf = list(ls_tf)
+            _zf = ls_tf[0].is_in.get_file()
+            for tf in ls_tf:
                 tfnm = tf.get_dirty_filename()
                 _tf = _zf.open(tfnm)
                 records = tf.get_records(use_file=_tf)
@@ -292,6 +332,7 @@ class SingleAccountClient(models.Model):
     def ZIP_FILENAME(self):
         return f"{self.__str__()}.zip"
 
+    @traced
     def write_file(self, return_file=False, **kwargs):
         use_records = kwargs.get('use_records')
         if use_records:
@@ -304,27 +345,32 @@ class SingleAccountClient(models.Model):
             'file': convert_records_to_csv(records)
         }]
         zf = create_zipfile(files_to_zip)
-        self.file.save(self.ZIP_FILENAME, zf)
-        print(f"{self.__str__()}.zip was saved on cloud storage.")
+        upload_file(self, self.ZIP_FILENAME, zf)
         if return_file:
-            return self.get_file()
+            return zipfile.ZipFile(zf)
+
+    def list_source_textfiles(self):
+        # text files of every zipfile in one query, along with their zipfiles
+        qs_tf = OpendartTextfile.objects.filter(
+            is_in__identifier__contains = self.fs_div
+        ).select_related('is_in').order_by('is_in_id', 'id')
+        if self.cfs:
+            qs_tf = qs_tf.filter(identifier__contains='연결')
+        else:
+            qs_tf = qs_tf.exclude(identifier__contains='연결')
+        return [
+            tf for tf in qs_tf
+            if any([x['acnt_nm'] == self.capitalized_name for x in tf.contains])
+        ]
 
     def list_sources(self, file_name=False, to_dict=False):
-        qs_zf = OpendartZipfile.objects.filter(identifier__contains=self.fs_div)
         ls_sources = []
-        for zf in qs_zf:
-            if self.cfs:
-                qs_tf = zf.text_files.filter(identifier__contains='연결')
+        for tf in self.list_source_textfiles():
+            if file_name:
+                s = (tf.is_in.__str__(), tf.__str__())
             else:
-                qs_tf = zf.text_files.exclude(identifier__contains='연결')
-
-            for tf in qs_tf:
-                if any([x['acnt_nm'] == self.capitalized_name for x in tf.contains]):
-                    if file_name:
-                        s = (zf.__str__(), tf.__str__())
-                    else:
-                        s = (zf.id, tf.id)
-                    ls_sources.append(s)
+                s = (tf.is_in.id, tf.id)
+            ls_sources.append(s)
         if not to_dict:
             return ls_sources
         d = {}
@@ -349,6 +395,7 @@ class SingleAccountClient(models.Model):
                 dt_max = dt
         return dt_max
 
+    @traced
     def get_dataframe(self):
         zf = self.get_file()
         df = pd.read_csv(zf.open(self.CSV_FILENAME))
@@ -363,7 +410,7 @@ class SingleAccountClient(models.Model):
     def _clean_dataframe(self, df):
         df['sj_div'] = df.rpt_div.replace(self.RPTDIV_TO_SJDIV_MAP)
         df = df.loc[df.currency=='KRW'].copy()
-        df.stock_code = df.stock_code.str[1:-1]
+        df.stock_code = normalize_stock_codes(df.stock_code)
         df.market = df.market.replace(self.MARKET_LABEL_KR_TO_EN_MAP)
         df.date = pd.to_datetime(df.date)
         df.fye = df.fye.astype(int)
@@ -440,6 +487,7 @@ class SingleAccountClient(models.Model):
         df = self.get_dataframe()
         return df.to_dict(orient='records')
 
+    @traced
     def query(self, **kwargs):
         params = kwargs.get('params')
         filtered = self.get_dataframe()[self.RESPONSE_PARAMETERS]
@@ -480,7 +528,7 @@ class SingleAccountClient(models.Model):
 
 
 class OpenApiData(models.Model):
-    date = models.DateField()
+    date = models.DateField(unique=True)
     records = models.JSONField(default=DEFAULT_LIST)
 
     class Meta:
@@ -532,20 +580,27 @@ class CorpList(OpenApiData):
 
 class StockPrice(OpenApiData):
     is_monthend = models.BooleanField(default=False)
+    # whether records are loaded into StockDaily, and when they were last loaded
+    is_normalized = models.BooleanField(default=False)
+    last_update = models.DateTimeField(null=True)
     objects = StockPriceManager()
 
     #
     file = models.FileField(upload_to='openapi-stock-prices-clone', null=True)
+    file_checksum = models.CharField(max_length=64, null=True)
     url = models.TextField(null=True)
 
     class Meta:
         db_table = 'stock_price'
+        indexes = [
+            models.Index(fields=['is_monthend', 'date'], name='stock_price_monthend_idx'),
+        ]
 
     @property
     def INDEX_COLUMNS(self):
         return ['date', 'market', 'stock_code']
 
-    def select_columns(self, columns, include_preferred_stocks=False):
+    def select_columns(self, columns, include_preferred_stocks=False, corp_list=None):
         clean_records = self.get_clean_records()
         selected_records = [{
             **{c: r[c] for c in self.INDEX_COLUMNS},
@@ -553,23 +608,26 @@ class StockPrice(OpenApiData):
         } for r in clean_records]
         if include_preferred_stocks:
             return selected_records
-        return self.keep_common_stocks_only(selected_records)
+        return self.keep_common_stocks_only(selected_records, corp_list=corp_list)
 
-    def get_matched_corp_list(self):
-        matched_cl, created = CorpList.objects.get_or_create(date=self.date)
+    def get_matched_corp_list(self, corp_list=None):
+        # corp_list is the CorpList of the date if it was already read
+        matched_cl = corp_list
+        if matched_cl is None:
+            matched_cl, created = CorpList.objects.get_or_create(date=self.date)
         if len(matched_cl.records) == 0:
             matched_cl.write_records()
         records_cl = matched_cl.get_clean_records()
-        index_columns_for_cl = ['date', 'market', 'stock_code']
-        records_cl = [{
-            nm: r[nm] if nm != 'stock_code' else r[nm][1:]
-            for nm in index_columns_for_cl
-        } for r in records_cl]
-        return records_cl
-
-    def keep_common_stocks_only(self, cleaned_records):
+        stock_codes = normalize_stock_codes([r['stock_code'] for r in records_cl])
+        return [{
+            'date': r['date'],
+            'market': r['market'],
+            'stock_code': c,
+        } for r, c in zip(records_cl, stock_codes.tolist())]
+
+    def keep_common_stocks_only(self, cleaned_records, corp_list=None):
         df = pd.DataFrame.from_records(cleaned_records)
-        df_cl = pd.DataFrame.from_records(self.get_matched_corp_list())
+        df_cl = pd.DataFrame.from_records(self.get_matched_corp_list(corp_list=corp_list))
         return df.merge(df_cl, on=['date', 'stock_code', 'market']).to_dict(orient='records')
 
     @property
@@ -597,6 +655,7 @@ class StockPrice(OpenApiData):
             } for nm, rnm in self.RENAME_MAP.items()
         }
 
+    @traced
     def write_file(self):
         filename = f"stock_price_{self.date.strftime('%Y%m%d')}"
         # csv_filename = f"stock_price_{self.date.strftime('%Y%m%d')}.csv"
@@ -605,20 +664,103 @@ class StockPrice(OpenApiData):
             'file': convert_records_to_csv(self.records)
         }]
         zf = create_zipfile(files_to_zip)
-        self.file.save(f"{filename}.zip", zf)
-        # csv_buffer = convert_records_to_csv(self.records)
-        # csv_file = ContentFile(csv_buffer.getvalue().encode('utf-8'))
-        # self.file.save(filename, csv_file)
-        self.url = self.file.url.split('?')[0]
-        self.save()
+        upload_file(self, f"{filename}.zip", zf)
         return None
 
 
+class Security(models.Model):
+    # security master of listed items, built from CorpList records
+    stock_code = models.CharField(max_length=16, unique=True)
+    isin_code = models.CharField(max_length=16, null=True)
+    crno = models.CharField(max_length=16, null=True)
+    market = models.CharField(max_length=16)
+    name = models.CharField(max_length=128)
+    # result looks like [{'date', 'market', 'name'}, ...], appended on changes
+    history = models.JSONField(default=DEFAULT_LIST)
+    first_date = models.DateField()
+    last_date = models.DateField()
+    objects = SecurityManager()
+
+    class Meta:
+        db_table = 'security'
+
+    def __str__(self):
+        return f"{self.name} ({self.stock_code})"
+
+
+class StockDaily(models.Model):
+    # a row per stock and trading day, typed columns of StockPrice.records
+    date = models.DateField()
+    security = models.ForeignKey(
+        Security,
+        related_name = 'daily',
+        null = True,
+        on_delete = models.SET_NULL
+    )
+    stock_code = models.CharField(max_length=16)
+    market = models.CharField(max_length=16)
+    open = models.BigIntegerField(null=True)
+    high = models.BigIntegerField(null=True)
+    low = models.BigIntegerField(null=True)
+    close = models.BigIntegerField(null=True)
+    ri = models.FloatField(null=True)
+    vol_n = models.BigIntegerField(null=True)
+    vol_m = models.BigIntegerField(null=True)
+    n_listed = models.BigIntegerField(null=True)
+    mktcap = models.BigIntegerField(null=True)
+    objects = StockDailyManager()
+
+    class Meta:
+        db_table = 'stock_daily'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'stock_code', 'market'], name='stock_daily_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['stock_code', 'date'], name='stock_daily_stock_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_code} {self.date.strftime('%Y-%m-%d')}"
+
+
+class StockSeries(models.Model):
+    # a series of one stock transposed from date-keyed data, so that a stock reads its own history only
+    stock_code = models.CharField(max_length=16)
+    security = models.ForeignKey(
+        Security,
+        related_name = 'series',
+        null = True,
+        on_delete = models.SET_NULL
+    )
+    # address key of the source, e.g. 'Size:1' of VariableData.key_of
+    series_key = models.CharField(max_length=64)
+    first_date = models.DateField()
+    last_date = models.DateField()
+    length = models.IntegerField()
+    # columns of date (YYYYMMDD int) and value ordered by date
+    blob = models.BinaryField()
+    checksum = models.CharField(max_length=64)
+    objects = StockSeriesManager()
+
+    class Meta:
+        db_table = 'stock_series'
+        constraints = [
+            models.UniqueConstraint(fields=['stock_code', 'series_key'], name='stock_series_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.series_key} of {self.stock_code}"
+
+    def get_columns(self):
+        return decode_columns(self.blob)
+
+
 class Variable(models.Model):
     name = models.CharField(max_length=128)
     label_en = models.CharField(max_length=128, null=True, blank=True)
     label_kr = models.CharField(max_length=128, null=True, blank=True)
     file = models.FileField(upload_to='products/variables')
+    file_checksum = models.CharField(max_length=64, null=True)
     url = models.TextField(null=True)
     last_update = models.DateField(auto_now=True)
 
@@ -629,32 +771,13 @@ class Variable(models.Model):
         return ''.join([x.capitalize() for x in self.name.split('_')])
 
     def import_variable_data(self, variable_config, to_dataframe=True):
-        model = eval(variable_config['model_name'])
-        obj = model.objects.get(id=variable_config['id'])
+        obj = get_registry().resolve(variable_config)
         if not to_dataframe:
             return obj.get_data()
         return pd.DataFrame.from_records(obj.get_data())
 
-    def append_mktcap_column(self, df):
-        df['ym'] = df.date.str[:-2]
-        s_strdt = df.date.unique()
-        prc_data = list()
-        for strdt in s_strdt:
-            dt = datetime.datetime.strptime(strdt, '%Y%m%d')
-            matched = StockPrice.objects.filter(
-                date__year = dt.year,
-                date__month = dt.month,
-                is_monthend = True
-            )
-            if matched.exists():
-                m = matched.first()
-                prc_data += m.select_columns(columns=['mktcap'])
-        df_prc = pd.DataFrame.from_records(prc_data)
-        df_prc['ym'] = df_prc.date.apply(lambda s: s.strftime('%Y%m'))
-        del df_prc['date']
-        df = df.merge(df_prc, on=['ym', 'stock_code', 'market'])
-        del df['ym']
-        return df
+    def get_columns(self, vocabulary):
+        return VariableColumns.from_records(self.get_data(), vocabulary)
 
     @property
     def INDEX_COLUMNS(self):
@@ -678,7 +801,12 @@ class Variable(models.Model):
             'id': self.id,
         }
 
-    def bulk_sync_data(self):
+    @property
+    def address_key(self):
+        return VariableData.key_of(self.address)
+
+    def get_nested_data(self):
+        # result looks like {date: [{'stock_code', 'market', 'value'}, ...], ...}
         data = self.get_data()
         nested = dict()
         for r in data:
@@ -687,58 +815,83 @@ class Variable(models.Model):
             if not nested.get(dt):
                 nested[dt] = list()
             nested[dt].append(r)
+        return nested
+
+    def iter_nested_data(self):
+        # chunks of nested data by dates, synced one after another
+        yield self.get_nested_data()
+
+    @traced
+    @locked(lambda self: f"variable:{self.address_key}")
+    def bulk_sync_data(self):
+        # checksums of every date in one query, records are left unloaded
+        existing = {obj.date: obj for obj in self.queryset.only('id', 'date', 'checksum')}
+        n_created, n_updated = 0, 0
+        # each chunk is written before the next one is computed
+        for nested in self.iter_nested_data():
+            created, updated = self.save_nested_data(nested, existing)
+            n_created += len(created)
+            n_updated += len(updated)
+        if n_created > 0:
+            print(f"{n_created} number of VariableData for {self} were created.")
+        if n_updated > 0:
+            print(f"{n_updated} number of VariableData for {self} were updated.")
+
+        # if self.address['model_name'] != 'SingleAccount':
+        self.write_file()
 
+    def save_nested_data(self, nested, existing):
+        # existing looks like {date: VariableData, ...}, dates of nested are popped once saved
         created = []
         updated = []
         for dt, records in nested.items():
-            matched = VariableData.objects.filter(
-                variable = self.address,
-                date = dt
-            )
-            if matched.exists():
-                m = matched.first()
-                m.records = records
+            checksum = hash_records(records)
+            m = existing.pop(dt, None)
+            if m:
+                if m.checksum == checksum:
+                    continue
+                m.set_records(records)
+                m.checksum = checksum
                 updated.append(m)
             else:
-                created.append(
-                    VariableData(
-                        variable = self.address,
-                        date = dt,
-                        records = records
-                    )
+                obj = VariableData(
+                    variable = self.address,
+                    variable_key = self.address_key,
+                    date = dt,
+                    checksum = checksum
                 )
+                obj.set_records(records)
+                created.append(obj)
         if len(created) > 0:
-            VariableData.objects.bulk_create(created)
-            print(f"{len(created)} number of VariableData for {self} were created.")
+            bulk_upsert(VariableData.objects, created, ['variable_key', 'date'], ['records', 'blob', 'checksum'])
         if len(updated) > 0:
-            VariableData.objects.bulk_update(updated, ['records'])
-            print(f"{len(updated)} number of VariableData for {self} were updated.")
-
-        # if self.address['model_name'] != 'SingleAccount':
-        self.write_file()
+            VariableData.objects.bulk_update(updated, ['records', 'blob', 'checksum'])
+        if len(created) + len(updated) > 0:
+            StockSeries.objects.merge(self.address_key, created + updated)
+        return created, updated
 
     @property
     def queryset(self):
-        return VariableData.objects.filter(variable=self.address) #.order_by('date')
+        return VariableData.objects.filter(variable_key=self.address_key) #.order_by('date')
 
+    @traced
     def write_file(self):
-        qs = self.queryset.all() #.order_by('date')
+        qs = self.queryset.only('date', 'records', 'blob').iterator(chunk_size=50)
         records = list()
         for obj in qs:
             records += [{
                 'date': obj.date.strftime('%Y%m%d'),
                 **r
-            } for r in obj.records]
+            } for r in obj.get_records()]
         records = sorted(records, key=lambda r: (r['date'], r['stock_code']))
         files_to_zip = [{
             'name': self.csvfile_name,
             'file': convert_records_to_csv(records)
         }]
         zf = create_zipfile(files_to_zip)
-        self.file.save(self.zipfile_name, zf)
-        self.url = self.file.url.split('?')[0]
-        self.save()
-        print(f"{self.zipfile_name} was saved on cloud storage.")
+        self.last_update = datetime.date.today()
+        type(self).objects.filter(pk=self.pk).update(last_update=self.last_update)
+        upload_file(self, self.zipfile_name, zf)
 
     @property
     def csvfile_name(self):
@@ -763,6 +916,7 @@ class SingleAccount(Variable):
     def __str__(self):
         return self.client.__str__()
 
+    @traced
     def get_data(self):
         value_column = 'value' if self.client.fs_div == 'BS' else 'value_y'
         data = list()
@@ -788,16 +942,16 @@ class MixedAccount(Variable):
     def __str__(self):
         return self.capitalize_name()
 
+    def get_columns(self, vocabulary):
+        variables = get_registry().resolve_many(self.ordered_single_accounts)
+        return VariableColumns.coalesce([var.get_columns(vocabulary) for var in variables])
+
+    @traced
     def get_data(self):
-        ls_dfa = list()
-        for i, vconf in enumerate(self.ordered_single_accounts):
-            dfa = self.import_variable_data(vconf)
-            dfa['priority'] = i
-            ls_dfa.append(dfa)
-        df = pd.concat(ls_dfa, axis=0)
-        df = df.sort_values(['stock_code', 'date', 'priority'])
-        df = df.drop_duplicates(['stock_code', 'date'])
-        return df[self.COLUMNS].to_dict(orient='records')
+        return self.get_columns(ColumnVocabulary()).to_records()
+
+    def get_nested_data(self):
+        return self.get_columns(ColumnVocabulary()).to_nested_records()
 
 
 class AccountRatio(Variable):
@@ -812,20 +966,25 @@ class AccountRatio(Variable):
     def __str__(self):
         return self.capitalize_name()
 
+    def get_columns(self, vocabulary):
+        numerator, denominator = [
+            var.get_columns(vocabulary)
+            for var in get_registry().resolve_many([self.numerator, self.denominator])
+        ]
+        return numerator.divide(denominator)
+
+    @traced
     def get_data(self):
-        df_num = self.import_variable_data(self.numerator)
-        df_num = df_num.rename(columns={'value': 'numerator'})
-        df_den = self.import_variable_data(self.denominator)
-        df_den = df_den.rename(columns={'value': 'denominator'})
-        df = df_num.merge(df_den, on=self.INDEX_COLUMNS)
-        df[self.VALUE_COLUMN] = df.numerator / df.denominator
-        df = df.copy().dropna(subset='value')
-        df = df.replace(np.nan, None)
-        return df[self.COLUMNS].to_dict(orient='records')
+        return self.get_columns(ColumnVocabulary()).to_records()
+
+    def get_nested_data(self):
+        return self.get_columns(ColumnVocabulary()).to_nested_records()
 
 
 class PriceRatio(Variable):
     numerator = models.JSONField(default=DEFAULT_DICT)
+    # months between the date of numerator and the month-end of prices
+    reporting_lag = models.IntegerField(default=0)
     objects = PriceRatioManager()
 
     class Meta:
@@ -834,15 +993,40 @@ class PriceRatio(Variable):
     def __str__(self):
         return self.capitalize_name()
 
+    @traced
     def get_data(self):
-        df = self.import_variable_data(self.numerator)
-        df = df.rename(columns={'value': 'numerator'})
-        df = self.append_mktcap_column(df)
-        df = df.rename(columns={'mktcap': 'denominator'})
-        df[self.VALUE_COLUMN] = df.numerator / df.denominator
-        df = df.copy().dropna(subset='value')
-        df = df.replace(np.nan, None)
-        return df[self.COLUMNS].to_dict(orient='records')
+        return [r for columns in self.iter_columns_by_year() for r in columns.to_records()]
+
+    def get_nested_data(self):
+        # the whole history, bulk_sync_data syncs a year at a time instead
+        nested = dict()
+        for columns in self.iter_columns_by_year():
+            nested.update(columns.to_nested_records())
+        return nested
+
+    def iter_nested_data(self):
+        for columns in self.iter_columns_by_year():
+            yield columns.to_nested_records()
+
+    def iter_columns_by_year(self):
+        # Month-end mktcap is loaded once, and the numerator is kept in columns
+        # and joined a year at a time on integer month keys.
+        panel = StockPrice.objects.get_monthend_panel(fields=['mktcap'])
+        numerator = get_registry().resolve(self.numerator).get_columns(ColumnVocabulary())
+        years = numerator.dates // 10000
+        for year in np.unique(years).tolist():
+            chunk = numerator.take(np.flatnonzero(years == year))
+            vocabulary = chunk.vocabulary
+            denominators = panel.lookup(
+                field = 'mktcap',
+                months = month_keys_of_strdates(chunk.dates),
+                stock_codes = vocabulary.decode(chunk.codes, vocabulary.stock_codes).tolist(),
+                markets = vocabulary.decode(chunk.markets, vocabulary.markets).tolist(),
+                lag = self.reporting_lag
+            )
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chunk.values = chunk.values / denominators
+            yield chunk.take(np.flatnonzero(~np.isnan(chunk.values)))
 
 
 class Momentum(Variable):
@@ -856,31 +1040,26 @@ class Momentum(Variable):
     def __str__(self):
         return f"{self.capitalize_name()} ({self.near}/{self.far})"
 
+    def get_nested_data(self):
+        panel, values = Momentum.objects.get_values(self.near, self.far)
+        nested = dict()
+        for i, dt in enumerate(panel.dates):
+            locs = np.flatnonzero(~np.isnan(values[i]))
+            if len(locs) == 0:
+                continue
+            nested[dt] = [{
+                'stock_code': str(panel.stock_codes[j]),
+                'market': panel.market_names[panel.markets[i, j]],
+                'value': float(values[i, j]),
+            } for j in locs]
+        return nested
+
+    @traced
     def get_data(self):
-        qs_prc = StockPrice.objects.filter(is_monthend=True) #.order_by('date')
-        mktcap_data = list()
-        for prc in qs_prc:
-            mktcap_data += prc.select_columns(columns=['mktcap'])
-        df = pd.DataFrame.from_records(mktcap_data)
-        df = df.sort_values(['stock_code', 'date']).reset_index(drop=True)
-        dt_1 = df.groupby('stock_code').date.shift(1)
-        is_big_gap = (df.date - dt_1) > '40 days'
-
-        ln_mktcap = np.log(df.mktcap) # pd.Series
-        ln_mktcap_1 = ln_mktcap.groupby(df.stock_code).shift(1)
-        ln_ri_m = ln_mktcap - ln_mktcap_1
-        ln_ri_m = (~is_big_gap).astype(int) * ln_ri_m
-        ln_ri_m = ln_ri_m.replace(0, np.nan)
-        win_size = self.far - self.near + 1
-        shift_size = self.near - 1
-
-        _value = ln_ri_m.groupby(df.stock_code).rolling(win_size).sum().values
-        _value = np.exp(_value)
-        df['value'] = pd.Series(_value).groupby(df.stock_code).shift(shift_size)
-        df = df.copy().dropna(subset='value')
-        df.date = df.date.apply(lambda s: s.strftime('%Y%m%d'))
-        return df[self.COLUMNS].to_dict(orient='records')
-        # PRICE_DATA_COLUMNS
+        return [{
+            'date': dt.strftime('%Y%m%d'),
+            **r
+        } for dt, records in self.get_nested_data().items() for r in records]
 
 
 class Size(Variable):
@@ -891,11 +1070,20 @@ class Size(Variable):
     def __str__(self):
         return self.capitalize_name()
 
+    @traced
     def get_data(self):
-        qs_prc = StockPrice.objects.filter(is_monthend=True) #.order_by('date')
+        # corp lists of month-ends are read along prices in one ordered query instead of one per date
+        qs_prc = StockPrice.objects.filter(is_monthend=True).order_by('date')
+        corp_lists = CorpList.objects.filter(
+            date__in = qs_prc.values('date')
+        ).order_by('date').iterator(chunk_size=10)
+        cl = next(corp_lists, None)
         data = list()
-        for prc in qs_prc:
-            data += prc.select_columns(columns=['mktcap'])
+        for prc in qs_prc.iterator(chunk_size=10):
+            while cl is not None and cl.date < prc.date:
+                cl = next(corp_lists, None)
+            matched_cl = cl if cl is not None and cl.date == prc.date else None
+            data += prc.select_columns(columns=['mktcap'], corp_list=matched_cl)
         for r in data:
             r['value'] = r.pop('mktcap')
             r['date'] = (r['date'] + relativedelta(day=31)).strftime('%Y%m%d')
@@ -904,18 +1092,52 @@ class Size(Variable):
 
 class VariableData(models.Model):
     variable = models.JSONField(DEFAULT_DICT)
+    # 'model_name:id' of variable, an indexable key of the json address
+    variable_key = models.CharField(max_length=64)
     date = models.DateField()
+    # json records are left empty once encoded into blob
     records = models.JSONField(DEFAULT_LIST)
+    blob = models.BinaryField(null=True)
+    checksum = models.CharField(max_length=40, null=True)
 
     class Meta:
         db_table = 'variable_data'
+        constraints = [
+            models.UniqueConstraint(fields=['variable_key', 'date'], name='variable_data_key_date_uniq'),
+        ]
+
+    @staticmethod
+    def key_of(address):
+        return f"{address['model_name']}:{address['id']}"
+
+    def save(self, *args, **kwargs):
+        if not self.variable_key and self.variable:
+            self.variable_key = self.key_of(self.variable)
+        super().save(*args, **kwargs)
+
+    def set_records(self, records):
+        self.blob = encode_records(records)
+        self.records = list()
+
+    def get_records(self):
+        if self.blob is None:
+            return self.records
+        return decode_records(self.blob)
+
+    def get_columns(self):
+        # result looks like {'stock_code': np.ndarray, 'market': np.ndarray, 'value': np.ndarray}
+        if self.blob is None:
+            return columns_of_records(self.records)
+        return decode_columns(self.blob)
 
 
 class Backtester(models.Model):
     factors = models.JSONField(default=DEFAULT_LIST)
     rebalancing_frequency = models.IntegerField(default=12)
     rebalancing_history = models.JSONField(default=DEFAULT_DICT)
+    formation_fingerprints = models.JSONField(default=DEFAULT_DICT)
     file = models.FileField(upload_to='products/factor-portfolios')
+    file_checksum = models.CharField(max_length=64, null=True)
     url = models.TextField(null=True)
     objects = BacktesterManager()
 
@@ -927,12 +1149,13 @@ class Backtester(models.Model):
         return ' x '.join([f['variable'].__str__() for f in ls])
 
     def list_evaluated_factors(self):
+        variables = get_registry().resolve_many(self.factors)
         ls = list()
-        for factor in self.factors:
+        for factor, variable in zip(self.factors, variables):
             factor_cp = factor.copy()
-            model_name = factor_cp.pop('model_name')
-            id = factor_cp.pop('id')
-            factor_cp['variable'] = eval(model_name).objects.get(id=id)
+            factor_cp.pop('model_name')
+            factor_cp.pop('id')
+            factor_cp['variable'] = variable
             ls.append(factor_cp)
         return ls
 
@@ -942,11 +1165,14 @@ class Backtester(models.Model):
         portfolios = list()
         ls_q = self.list_quantile_locs()
         for q in ls_q:
-            if isinstance(q, int):
-                portfolios.append(FactorPortfolio(backtester=self, quantile_locs=[q]))
-            elif isinstance(q, tuple):
-                portfolios.append(FactorPortfolio(backtester=self, quantile_locs=list(q)))
-        FactorPortfolio.objects.bulk_create(portfolios)
+            quantile_locs = [q] if isinstance(q, int) else list(q)
+            portfolios.append(FactorPortfolio(
+                backtester = self,
+                quantile_locs = quantile_locs,
+                quantile_key = FactorPortfolio.key_of(quantile_locs)
+            ))
+        # portfolios created by a concurrent run are kept
+        FactorPortfolio.objects.bulk_create(portfolios, ignore_conflicts=True)
         return self.portfolios.all(), True
 
     def list_quantile_locs(self):
@@ -971,67 +1197,75 @@ class Backtester(models.Model):
         }
 
     def list_rebalancing_dates(self):
-        ls_dt = list()
         max_dt = StockPrice.objects.aggregate(Max('date'))['date__max']
-
-        # max_dt = StockPrice.objects.latest().date
-        dt = self.DEFAULT_STARTS_ON - timedelta(days=1)
-        while True:
-            if dt > max_dt:
-                break
-            ls_dt.append(dt)
-            dt += relativedelta(months=self.rebalancing_frequency)
-        return ls_dt
+        return list_rebalancing_dates(
+            starts_on = self.DEFAULT_STARTS_ON - timedelta(days=1),
+            ends_on = max_dt,
+            rebalancing_frequency = self.rebalancing_frequency
+        )
 
     def get_portfolio_entries_formed_on(self, date, use_labels=False):
         ls_factors = self.list_evaluated_factors()
-        ls_dff = list()
+        ls_records = list()
         for factor in ls_factors:
-            _date = date - relativedelta(months=factor['lookback'])
-            is_price_var = factor['variable']._meta.model.__name__ in ['Size', 'Momentum']
-            if is_price_var:
-                qs = factor['variable'].queryset.filter(
-                    date__year = _date.year,
-                    date__month = _date.month,
-                )
-            else:
-                qs = factor['variable'].queryset.filter(
-                    date__year = _date.year,
-                    date__month__gt = _date.month - 3,
-                    date__month__lte = _date.month
-                )
-            data = reduce(lambda x,y: x+y, [obj.records for obj in qs])
-            data = list(filter(lambda r: r['market'] != 'KONEX', data))
-            dff = pd.DataFrame.from_records(data)
-            varnm = f"{factor['variable'].name}"
-            dff[varnm] = pd.qcut(
-                x = dff.value,
-                q = factor['quantiles'],
-                labels = list(range(len(factor['labels'])))
-            )
-            ls_dff.append(dff.set_index(['stock_code', 'market'])[varnm])
-        df = pd.concat(ls_dff, axis=1).reset_index().dropna()
-        valcols = [c for c in df.columns if c not in ['stock_code', 'market']]
-        for c in valcols:
-            df[c] = df[c].astype(int)
-        s_group = df.set_index(valcols).index
-        entries_by_portfolio = df.groupby(s_group).stock_code.apply(lambda s: s.tolist()).to_dict()
+            qs = self.get_factor_queryset_formed_on(factor, date).only('records', 'blob')
+            ls_records.append(reduce(lambda x,y: x+y, [obj.get_records() for obj in qs]))
+        return self.form_portfolio_entries(ls_records, use_labels=use_labels)
+
+    def form_portfolio_entries(self, ls_records, use_labels=False):
+        stock_codes, qlocs = assign_quantile_locs(ls_records, self.factors)
+        entries_by_portfolio = group_entries_by_quantile_locs(stock_codes, qlocs)
         if not use_labels:
             return entries_by_portfolio
-        ls_qlocs = list(entries_by_portfolio.keys())
+        return self.label_entries(entries_by_portfolio)
+
+    def label_entries(self, entries_by_portfolio):
         qlocs2label = self.quantile_locs_to_label_map
-        for qlocs in ls_qlocs:
-            label = qlocs2label[qlocs]
-            entries_by_portfolio[label] = entries_by_portfolio.pop(qlocs)
 
         # result looks like {pf: [entry, ...], ...}
-        return entries_by_portfolio
+        return {
+            qlocs2label[qlocs]: entries
+            for qlocs, entries in entries_by_portfolio.items()
+        }
+
+    def get_factor_queryset_formed_on(self, factor, date):
+        # date ranges instead of year and month lookups, which can not use indexes
+        _date = date - relativedelta(months=factor['lookback'])
+        month_starts_on = _date + relativedelta(day=1)
+        is_price_var = factor['variable']._meta.model.__name__ in ['Size', 'Momentum']
+        if is_price_var:
+            starts_on = month_starts_on
+        else:
+            # the last three months within the year
+            starts_on = max(month_starts_on - relativedelta(months=2), month_starts_on + relativedelta(month=1))
+        return factor['variable'].queryset.filter(
+            date__gte = starts_on,
+            date__lte = _date + relativedelta(day=31)
+        )
+
+    def get_formation_inputs(self, date):
+        # [[(variable_data_id, checksum), ...], ...] for each factor
+        ls_factors = self.list_evaluated_factors()
+        return [
+            sorted(self.get_factor_queryset_formed_on(factor, date).values_list('id', 'checksum'))
+            for factor in ls_factors
+        ]
+
+    def get_formation_fingerprint(self, inputs):
+        # identifies the factor inputs feeding the formation on the date
+        return hash_records([{**factor, 'data': data} for factor, data in zip(self.factors, inputs)])
+
+    def get_portfolios(self):
+        # portfolios are memoized on the instance for the run,
+        # and portfolios of the instance share it as their backtester
+        if not getattr(self, '_portfolios', None):
+            self._portfolios = list(self.portfolios.only('id', 'backtester_id', 'quantile_locs'))
+        return self._portfolios
 
     @property
     def quantile_locs_to_label_map(self):
         qlmap = dict()
-        portfolios = self.portfolios.all()
-        for pf in portfolios:
+        for pf in self.get_portfolios():
             if len(pf.quantile_locs) == 1:
                 qlmap[pf.quantile_locs[0]] = pf.label
             elif len(pf.quantile_locs) > 1:
@@ -1042,83 +1276,101 @@ class Backtester(models.Model):
     def label_to_quantile_locs_map(self):
         return {v: k for k, v in self.quantile_locs_to_label_map.items()}
 
+    @traced
+    @locked(lambda self: f"backtester:{self.id}")
     def bulk_sync_data(self):
-        changed_history = self.list_changes_in_rebalancing_history()
-        if changed_history == dict():
-            new_prices = self.detect_new_prices()
-            if new_prices.exists():
-                created = []
-                updated = []
-                for prc in new_prices:
-                    _created, _updated = self.collect_updated_data_from_price_data_object(prc)
-                    created += _created
-                    updated += _updated
-                self.save_updated_data(created=created, updated=updated)
-                self.write_file()
-                print(f"PortfolioData for {self} was synced to sources successfully.")
-                return True
+        changed_history, history = self.list_changes_in_rebalancing_history()
+        periods = self.list_outdated_periods(changed_history, history)
+        if len(periods) == 0:
             print(f"PortfolioData for {self} has already been synced to sources.")
             return False
-
-        self.rebalancing_history = self.get_rebalancing_history()
-        self.save()
-
-        qs_prc = StockPrice.objects.filter(date__gte=self.DATA_STARTS_ON) #.order_by('date')
-        created = []
-        updated = []
-        for rbdt_str, d in changed_history.items():
-            rbdt = datetime.datetime.strptime(rbdt_str, '%Y%m%d').date()
-            start_dt, end_dt = self.get_holding_period(rbdt)
-            subset = qs_prc.filter(date__gte=start_dt, date__lte=end_dt)
-            if not subset.exists():
-                continue
-            for prc in subset:
-                _created, _updated = self.collect_updated_data_from_price_data_object(
-                    prc, use_rebalancing_date = rbdt
-                )
-                created += _created
-                updated += _updated
+        panel = StockPrice.objects.get_panel(
+            start_dt = min([p[0] for p in periods]),
+            end_dt = max([p[1] for p in periods]),
+            fields = ['mktcap', 'ri']
+        )
+        created, updated = self.collect_updated_data_from_price_panel(panel, periods)
         self.save_updated_data(created=created, updated=updated)
         self.write_file()
         print(f"PortfolioData for {self} was synced to sources successfully.")
         return True
 
     def list_changes_in_rebalancing_history(self):
-        changed = False
-        data = dict()
+        outdated = self.list_outdated_formations()
+        formed = dict()
+        for rbdt_str in outdated.keys():
+            rbdt = datetime.datetime.strptime(rbdt_str, '%Y%m%d').date()
+            formed[rbdt_str] = self.get_portfolio_entries_formed_on(rbdt, use_labels=True)
+        return self.merge_formations(formed)
+
+    def list_outdated_formations(self):
+        # Formations are recomputed only on the dates whose factor inputs
+        # changed since the last sync.
+        # result looks like {rbdt_str: [[variable_data_id, ...], ...], ...}
+        outdated = dict()
+        fingerprints = dict()
+        for rbdt in self.list_rebalancing_dates():
+            rbdt_str = rbdt.strftime('%Y%m%d')
+            inputs = self.get_formation_inputs(rbdt)
+            fingerprint = self.get_formation_fingerprint(inputs)
+            fingerprints[rbdt_str] = fingerprint
+            is_formed = bool(self.rebalancing_history.get(rbdt_str))
+            if is_formed and self.formation_fingerprints.get(rbdt_str) == fingerprint:
+                continue
+            outdated[rbdt_str] = [[id for id, checksum in data] for data in inputs]
+        self.formation_fingerprints = fingerprints
+        return outdated
 
-        # calculate new history
+    def merge_formations(self, formed):
         # history = {rbdt_str: {label: [entry, ...], ...}, ...}
-        new_history = self.get_rebalancing_history()
-        label2qlocs = self.label_to_quantile_locs_map
-
-        # if the first time, list all
-        if self.rebalancing_history == dict():
-            return new_history
-
-        # else detect changes
+        history = dict()
         changed_history = dict()
-        for new_rbdt_str, d in new_history.items():
-            if not self.rebalancing_history.get(new_rbdt_str):
+        for rbdt_str in self.formation_fingerprints.keys():
+            old = self.rebalancing_history.get(rbdt_str)
+            new = formed.get(rbdt_str)
+            if new is None:
+                history[rbdt_str] = old
+                continue
+            history[rbdt_str] = new
+            if not old:
                 # [CHANGE DETECTED] new rebalancing might be implemented
-                changed_history[new_rbdt_str] = new_history[new_rbdt_str]
+                changed_history[rbdt_str] = new
                 continue
-            for label, new_entries in d.items():
-                old_entries = self.rebalancing_history[new_rbdt_str][label]
-                created = any([e for e in new_entries if e not in old_entries])
-                deleted = any([e for e in old_entries if e not in new_entries])
-                if created or deleted:
+            for label in set(new.keys()) | set(old.keys()):
+                new_entries = new.get(label, [])
+                if set(new_entries) != set(old.get(label, [])):
                     # [CHANGE DETECTED] there are new entries or deleted entries
-                    if not changed_history.get(new_rbdt_str):
-                        changed_history[new_rbdt_str] = dict()
-                    changed_history[new_rbdt_str][label] = new_entries
-        return changed_history
+                    if not changed_history.get(rbdt_str):
+                        changed_history[rbdt_str] = dict()
+                    changed_history[rbdt_str][label] = new_entries
+        return changed_history, history
+
+    def list_outdated_periods(self, changed_history, history):
+        # result looks like [(start_dt, end_dt, rbdt or None), ...]
+        # Buy-and-hold returns depend on the whole holding period,
+        # so new prices outdate every period they fall in.
+        if changed_history == dict():
+            self.save()
+            new_prices = self.detect_new_prices()
+            ls_dt = list(new_prices.values_list('date', flat=True))
+            ls_rbdt = sorted(set(self.get_matched_rebalancing_dates_on(sorted(ls_dt))))
+        else:
+            self.rebalancing_history = history
+            self.save()
+            ls_rbdt = [
+                datetime.datetime.strptime(rbdt_str, '%Y%m%d').date()
+                for rbdt_str in changed_history.keys()
+            ]
+        periods = list()
+        for rbdt in ls_rbdt:
+            start_dt, end_dt = self.get_holding_period(rbdt)
+            periods.append((max(start_dt, self.DATA_STARTS_ON), end_dt, rbdt))
+        return periods
 
     def detect_new_prices(self):
-        sample_data = self.portfolios.first().data
-        if sample_data.exists():
-            data_latest = sample_data.aggregate(Max('date'))['date__max']
-        else:
+        data_latest = self.get_portfolios()[0].data.aggregate(Max('last_date'))['last_date__max']
+        if data_latest is None:
+            # no periods yet, or rows of the former schema without last_date only
             data_latest = self.DATA_STARTS_ON
         prc_latest = StockPrice.objects.aggregate(Max('date'))['date__max']
         return StockPrice.objects.filter(date__gt=data_latest, date__lte=prc_latest) #.order_by('date')
@@ -1132,83 +1384,95 @@ class Backtester(models.Model):
     def DATA_STARTS_ON(self):
         return settings.PORTFOLIO_DATA_STARTS_ON
 
-    def collect_updated_data_from_price_data_object(self, prc, **kwargs):
+    def collect_updated_data_from_price_panel(self, panel, periods):
         created = []
         updated = []
-        rbdt = kwargs.get('use_rebalancing_date')
-        if not rbdt:
-            rbdt = self.get_matched_rebalancing_date_on(prc.date)
-        entries_by_portfolio = self.rebalancing_history[rbdt.strftime('%Y%m%d')]
-        label2qlocs = self.label_to_quantile_locs_map
-        mktcaps = prc.select_columns(columns=['mktcap'])
-        for label, entries in entries_by_portfolio.items():
-            mktcap_entries = list(filter(lambda r: r['stock_code'] in entries, mktcaps))
-            sum_mktcap_entries = sum(list(map(
-                lambda r: r['mktcap'], mktcap_entries
-            )))
-            qlocs = label2qlocs[label]
-            if isinstance(qlocs, int):
-                qlocs = [qlocs]
-            portfolio = self.portfolios.get(quantile_locs=qlocs)
-            matched_data = portfolio.data.filter(date=prc.date)
-            if matched_data.exists():
-                m = matched_data.first()
-                if m.mktcap != sum_mktcap_entries:
-                    m.mktcap = sum_mktcap_entries
-                    updated.append(m)
+        if len(panel.dates) == 0:
+            return created, updated
+        portfolio_by_label = {pf.label: pf for pf in self.get_portfolios()}
+        existing = {
+            (obj.portfolio_id, obj.date): obj
+            for obj in FactorPortfolioData.objects.filter(
+                portfolio__backtester = self,
+                date__in = [rbdt for start_dt, end_dt, rbdt in periods]
+            )
+        }
+        for start_dt, end_dt, rbdt in periods:
+            subpanel = panel.between(start_dt, end_dt)
+            if len(subpanel.dates) == 0:
                 continue
-            created.append(FactorPortfolioData(
-                portfolio = portfolio,
-                date = prc.date,
-                mktcap = sum_mktcap_entries
-            ))
+            entries_by_portfolio = self.rebalancing_history[rbdt.strftime('%Y%m%d')]
+            labels = list(entries_by_portfolio.keys())
+            membership = subpanel.membership_matrix(entries_by_portfolio, labels)
+            day_locs = range(len(subpanel.dates))
+            returns = {
+                weighting: np.round(holding_period_returns(subpanel, day_locs, membership, weighting) * 100, 6)
+                for weighting in ['value', 'equal']
+            }
+            dates = np.array([dt.year * 10000 + dt.month * 100 + dt.day for dt in subpanel.dates], dtype=np.int32)
+            for j, label in enumerate(labels):
+                portfolio = portfolio_by_label[label]
+                blob = encode_columns({
+                    'date': dates,
+                    'value_vw': returns['value'][:, j],
+                    'value_ew': returns['equal'][:, j],
+                })
+                m = existing.get((portfolio.id, rbdt))
+                if m:
+                    if m.blob is None or bytes(m.blob) != blob:
+                        m.last_date = subpanel.dates[-1]
+                        m.blob = blob
+                        updated.append(m)
+                    continue
+                created.append(FactorPortfolioData(
+                    portfolio = portfolio,
+                    date = rbdt,
+                    last_date = subpanel.dates[-1],
+                    blob = blob
+                ))
         return created, updated
 
-    def get_matched_rebalancing_date_on(self, date):
+    def get_matched_rebalancing_dates_on(self, dates):
         ls_dt = self.list_rebalancing_dates()
-        max_i = len(ls_dt) - 1
-        for i, dt in enumerate(ls_dt):
-            if (i+1) <= max_i:
-                dt_next = ls_dt[i+1]
-                if (date > dt) and (date <= dt_next):
-                    return dt
-        return ls_dt[-1]
+        # a date belongs to the latest rebalancing date strictly before it
+        locs = np.searchsorted(ls_dt, dates, side='left') - 1
+        locs = np.clip(locs, 0, len(ls_dt) - 1)
+        return [ls_dt[i] for i in locs]
 
     def save_updated_data(self, created, updated):
         if len(created) > 0:
-            FactorPortfolioData.objects.bulk_create(created)
+            bulk_upsert(FactorPortfolioData.objects, created, ['portfolio', 'date'], ['last_date', 'blob'])
         if len(updated) > 0:
-            FactorPortfolioData.objects.bulk_update(updated, ['mktcap'])
+            FactorPortfolioData.objects.bulk_update(updated, ['last_date', 'blob'])
 
+    @traced
     def write_file(self):
-        portfolios = self.portfolios.all()
-        _records = list()
-        for pf in portfolios:
-            qs = pf.data.all() #.order_by('date')
-            _records += [{
-                'date': obj.date.strftime('%Y%m%d'),
-                'label': pf.label,
-                'mktcap': obj.mktcap
-            } for obj in qs]
-        df = pd.DataFrame.from_records(_records)
-        df = df.sort_values(['label', 'date'])
-        df['value'] = (df.mktcap / df.groupby('label').mktcap.shift(1) - 1) * 100
-        df.value = round(df.value, 2)
-        df = df[['date', 'label', 'value']]
-        df = df.set_index(['date', 'label']).unstack('label').reset_index()
-        df.columns = [c[0] if c[0] == 'date' else c[1] for c in df.columns]
-        df = df.copy().dropna()
-        records = df.to_dict(orient='records')
-
-        files_to_zip = [{
-            'name': f"{self.filename}.csv",
-            'file': convert_records_to_csv(records)
-        }]
+        label_by_id = {pf.id: pf.label for pf in self.get_portfolios()}
+        qs = FactorPortfolioData.objects.filter(
+            portfolio__backtester = self
+        ).only('portfolio_id', 'blob').order_by('portfolio_id', 'id').iterator(chunk_size=100)
+        ls_df = list()
+        for obj in qs:
+            dfc = pd.DataFrame(obj.get_columns()).rename(columns={'value_vw': 'value'})
+            dfc['date'] = dfc.date.astype(str)
+            dfc['label'] = label_by_id[obj.portfolio_id]
+            ls_df.append(dfc)
+        df = pd.concat(ls_df, axis=0)
+        # factors are resolved once for the names of files
+        filename = self.filename
+        files_to_zip = list()
+        for suffix, value_column in [('', 'value'), ('_ew', 'value_ew')]:
+            dfw = df[['date', 'label', value_column]].rename(columns={value_column: 'value'})
+            dfw.value = round(dfw.value, 2) + 0.0 # drops negative zeros
+            dfw = dfw.set_index(['date', 'label']).unstack('label').reset_index()
+            dfw.columns = [c[0] if c[0] == 'date' else c[1] for c in dfw.columns]
+            dfw = dfw.sort_values('date').dropna()
+            files_to_zip.append({
+                'name': f"{filename}{suffix}.csv",
+                'file': convert_records_to_csv(dfw.to_dict(orient='records'))
+            })
         zf = create_zipfile(files_to_zip)
-        self.file.save(f"{self.filename}.zip", zf)
-        self.url = self.file.url.split('?')[0]
-        self.save()
-        print(f"{self.filename}.zip was saved on cloud storage.")
+        upload_file(self, f"{filename}.zip", zf)
 
     @property
     def filename(self):
@@ -1222,9 +1486,18 @@ class FactorPortfolio(models.Model):
         on_delete = models.CASCADE
     )
     quantile_locs = models.JSONField(default=DEFAULT_LIST)
+    # quantile_locs joined by '_', an indexable key of the json list
+    quantile_key = models.CharField(max_length=32)
 
     class Meta:
         db_table = 'factor_portfolio'
+        constraints = [
+            models.UniqueConstraint(fields=['backtester', 'quantile_key'], name='factor_portfolio_key_uniq'),
+        ]
+
+    @staticmethod
+    def key_of(quantile_locs):
+        return '_'.join([str(loc) for loc in quantile_locs])
 
     def __str__(self):
         return f"{self.backtester.__str__()} ({self.label.upper()})"
@@ -1247,11 +1520,132 @@ class FactorPortfolioData(models.Model):
         related_name = 'data',
         on_delete = models.CASCADE
     )
+    # rebalancing date of the holding period
     date = models.DateField()
-    mktcap = models.BigIntegerField()
+    last_date = models.DateField(null=True)
+    # columns of date (YYYYMMDD), value_vw and value_ew over the holding period,
+    # daily returns (%) of value- and equal-weighted portfolios
+    blob = models.BinaryField(null=True)
 
     class Meta:
         db_table = 'factor_portfolio_data'
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'date'], name='factor_portfolio_data_uniq'),
+        ]
+
+    def get_columns(self):
+        # rows of the former one-row-per-day schema have no blob, see migration 0008
+        if self.blob is None:
+            return {'date': np.array([], dtype=np.int32), 'value_vw': np.array([]), 'value_ew': np.array([])}
+        return decode_columns(self.blob)
 
     def __str__(self):
         return f"{self.portfolio.__str__()} {self.date.strftime('%Y-%m-%d')}"
+
+
+class BatchRun(models.Model):
+    STATUS_CHOICES = [
+        ('running', 'running'),
+        ('completed', 'completed'),
+        ('partial', 'partial'),
+        ('failed', 'failed'),
+    ]
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='running')
+    # names of stages selected by --stages, null if every stage was run
+    selected_stages = models.JSONField(null=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    ended_at = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'batch_run'
+
+    def __str__(self):
+        return f"BatchRun {self.id} ({self.status})"
+
+
+class BatchStage(models.Model):
+    STATUS_CHOICES = [
+        ('running', 'running'),
+        ('completed', 'completed'),
+        ('skipped', 'skipped'),
+        ('failed', 'failed'),
+    ]
+    run = models.ForeignKey(
+        BatchRun,
+        related_name = 'stages',
+        on_delete = models.CASCADE
+    )
+    name = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='running')
+    # {input_name: hash, ...} of inputs the stage was run on
+    fingerprint = models.JSONField(default=DEFAULT_DICT)
+    started_at = models.DateTimeField(auto_now_add=True)
+    ended_at = models.DateTimeField(null=True)
+    # accumulated over resumed attempts
+    wall_time = models.FloatField(default=0)
+    rows = models.IntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    error = models.TextField(null=True)
+
+    class Meta:
+        db_table = 'batch_stage'
+
+    def __str__(self):
+        return f"{self.name} of {self.run.__str__()} ({self.status})"
+
+
+class BatchCheckpoint(models.Model):
+    stage = models.ForeignKey(
+        BatchStage,
+        related_name = 'checkpoints',
+        on_delete = models.CASCADE
+    )
+    key = models.CharField(max_length=256)
+    completed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'batch_checkpoint'
+
+    def __str__(self):
+        return f"{self.key} of {self.stage.__str__()}"
+
+
+class WorkUnit(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'pending'),
+        ('leased', 'leased'),
+        ('completed', 'completed'),
+        ('failed', 'failed'),
+    ]
+    run = models.ForeignKey(
+        BatchRun,
+        related_name = 'units',
+        on_delete = models.CASCADE
+    )
+    stage = models.CharField(max_length=64)
+    # '' plans the stage and queues its items, other keys are items of the stage
+    key = models.CharField(max_length=256)
+    # names of stages whose units are completed before this one is leased
+    depends_on = models.JSONField(default=DEFAULT_LIST)
+    params = models.JSONField(default=DEFAULT_DICT)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='pending')
+    owner = models.CharField(max_length=128, null=True)
+    leased_until = models.DateTimeField(null=True)
+    attempts = models.IntegerField(default=0)
+    wall_time = models.FloatField(default=0)
+    error = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    ended_at = models.DateTimeField(null=True)
+    objects = WorkUnitManager()
+
+    class Meta:
+        db_table = 'work_unit'
+        constraints = [
+            models.UniqueConstraint(fields=['run', 'stage', 'key'], name='work_unit_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['run', 'status'], name='work_unit_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.stage}:{self.key or '*'} of {self.run.__str__()} ({self.status})"
@@ -0,0 +1,448 @@
+from .instrumentation import profiling, trace
+from .locks import AdvisoryLockTimeout, advisory_lock
+from .managers import VariableManager
+from .models import (
+    BatchCheckpoint,
+    BatchRun,
+    BatchStage,
+    Backtester,
+    OpendartZipfile,
+    SingleAccountClient,
+    StockPrice,
+    VariableData,
+    WorkUnit,
+)
+from .tools import hash_records
+from .uploads import count_uploaded_bytes, wait_for_uploads
+from contextlib import ExitStack
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models import Count, F, Max
+import datetime
+import os
+import socket
+import threading
+import time
+import traceback
+
+
+# Stages of sync_to_latest in order.
+# A stage runs its items one by one and checkpoints every completed item,
+# so that a failed run resumes from the first item not completed.
+# A stage is skipped when its inputs are unchanged since it was last completed;
+# an empty fingerprint means inputs are remote and the stage always runs.
+# Workers run work units of stages, see Worker, once stages in depends_on are completed.
+
+class Stage:
+    name = None
+    outputs = []
+    depends_on = []
+
+    def list_items(self):
+        return [self.name]
+
+    def run_item(self, key, changed):
+        return # override
+
+    def list_work_units(self):
+        return self.list_items()
+
+    def run_work_unit(self, key, changed):
+        self.run_item(key, changed)
+
+    def get_fingerprint(self):
+        return dict()
+
+    def count_rows(self):
+        return sum([apps.get_model('api', m).objects.count() for m in self.outputs])
+
+
+class OpenapiStage(Stage):
+    name = 'openapi'
+    outputs = ['StockPrice', 'CorpList']
+
+    def list_items(self):
+        return ['StockPrice', 'CorpList']
+
+    def run_item(self, key, changed):
+        apps.get_model('api', key).objects.bulk_sync()
+
+
+class OpendartStage(Stage):
+    name = 'opendart'
+    outputs = ['OpendartZipfile', 'OpendartTextfile']
+
+    def run_item(self, key, changed):
+        OpendartZipfile.objects.bulk_sync(return_status=False)
+
+    def list_work_units(self):
+        # an archive per unit, whose text files are parsed by the worker downloading it
+        return [source_fnm for obj, source_fnm, created in OpendartZipfile.objects.list_changed()]
+
+    def run_work_unit(self, key, changed):
+        OpendartZipfile.objects.sync_source_file(key)
+
+
+class SingleAccountStage(Stage):
+    name = 'single_accounts'
+    depends_on = ['opendart']
+
+    def list_items(self):
+        return [str(id) for id in SingleAccountClient.objects.order_by('id').values_list('id', flat=True)]
+
+    def run_item(self, key, changed):
+        SingleAccountClient.objects.get(id=int(key)).sync_to_sources()
+
+    def get_fingerprint(self):
+        return {'opendart': hash_opendart_zipfiles()}
+
+
+class VariableStage(Stage):
+    name = 'variables'
+    outputs = ['VariableData']
+    depends_on = ['openapi', 'single_accounts']
+
+    def __init__(self):
+        self.manager = VariableManager()
+
+    def list_items(self):
+        return [f"{conf['model_name']}:{conf['name']}" for tp, conf in self.manager.list_configs()]
+
+    def run_item(self, key, changed):
+        for tp, conf in self.manager.list_configs():
+            if f"{conf['model_name']}:{conf['name']}" == key:
+                self.manager.sync_using_conf(tp, conf, opendart_changed='opendart' in changed)
+
+    def get_fingerprint(self):
+        return {
+            'opendart': hash_opendart_zipfiles(),
+            'configs': hash_records(self.manager.configs),
+        }
+
+
+class BacktesterStage(Stage):
+    name = 'backtesters'
+    outputs = ['FactorPortfolioData']
+    depends_on = ['openapi', 'variables']
+
+    def run_item(self, key, changed):
+        Backtester.objects.bulk_sync()
+
+    def list_work_units(self):
+        return [str(obj.id) for obj in Backtester.objects.get_or_create_all_using_confs()]
+
+    def run_work_unit(self, key, changed):
+        Backtester.objects.get(id=int(key)).bulk_sync_data()
+
+    def get_fingerprint(self):
+        from api.src.backtester_configs import UNIVARIATE_BACKTESTER_CONFIGS
+        from api.src.backtester_configs import MULTIVARIATE_BACKTESTER_CONFIGS
+        prices = StockPrice.objects.aggregate(Count('id'), Max('date'))
+        return {
+            'variables': hash_records(list(VariableData.objects.order_by('id').values_list('id', 'checksum'))),
+            'prices': hash_records(prices),
+            'configs': hash_records([UNIVARIATE_BACKTESTER_CONFIGS, MULTIVARIATE_BACKTESTER_CONFIGS]),
+        }
+
+
+def hash_opendart_zipfiles():
+    return hash_records(list(OpendartZipfile.objects.order_by('id').values_list('identifier', 'last_update')))
+
+def list_stages():
+    return [
+        OpenapiStage(),
+        OpendartStage(),
+        SingleAccountStage(),
+        VariableStage(),
+        BacktesterStage(),
+    ]
+
+
+# Runs are selected under the batch_run lock, one process at a time.
+# A pipeline holds the lock of its run until the run ends,
+# so that the run is resumed by another process only after this one died.
+
+class RunInProgress(Exception):
+    def __init__(self, run):
+        self.run = run
+
+    def __str__(self):
+        return f"{self.run} is being run by another process."
+
+
+def is_run_held(run):
+    try:
+        with advisory_lock(f"batch_run:{run.id}", timeout=0):
+            return False
+    except AdvisoryLockTimeout:
+        return True
+
+
+class Pipeline:
+    def __init__(self, stages=None):
+        self.stages = stages or list_stages()
+
+    def run(self, **kwargs):
+        only = kwargs.get('stages')
+        with ExitStack() as stack:
+            with advisory_lock('batch_run'):
+                run = self.get_or_create_run(resume=kwargs.get('resume', True))
+                stack.enter_context(advisory_lock(f"batch_run:{run.id}", timeout=0))
+            run.selected_stages = only
+            try:
+                for stage in self.stages:
+                    if only and stage.name not in only:
+                        continue
+                    self.run_stage(
+                        run,
+                        stage,
+                        force = kwargs.get('force', False),
+                        profile_dir = kwargs.get('profile_dir')
+                    )
+            except Exception:
+                run.status = 'failed'
+                run.ended_at = datetime.datetime.now()
+                run.save()
+                raise
+            run.status = self.get_finished_status(run)
+            run.ended_at = datetime.datetime.now()
+            run.save()
+        return run
+
+    def get_finished_status(self, run):
+        # a run is completed once every stage is done in it, partial if stages were left out
+        done = set(run.stages.filter(status__in=['completed', 'skipped']).values_list('name', flat=True))
+        if all(stage.name in done for stage in self.stages):
+            return 'completed'
+        return 'partial'
+
+    def get_or_create_run(self, resume=True):
+        last = BatchRun.objects.order_by('id').last()
+        if resume and last and last.status in ['running', 'failed']:
+            if is_run_held(last):
+                raise RunInProgress(last)
+            if last.units.exists():
+                # runs of workers are resumed by workers
+                print(f"{last} is left to workers.")
+                return BatchRun.objects.create()
+            last.status = 'running'
+            last.save()
+            print(f"{last} was resumed.")
+            return last
+        return BatchRun.objects.create()
+
+    def run_stage(self, run, stage, force=False, profile_dir=None):
+        record, created = BatchStage.objects.get_or_create(run=run, name=stage.name)
+        if record.status in ['completed', 'skipped']:
+            print(f"Stage {stage.name} was already done in {run}.")
+            return
+        if created:
+            record.fingerprint = stage.get_fingerprint()
+        changed = self.get_changed(record, force)
+        if changed is None:
+            return
+
+        done = set(record.checkpoints.values_list('key', flat=True))
+        rows = stage.count_rows()
+        uploaded_bytes = count_uploaded_bytes()
+        t = time.perf_counter()
+        record.status = 'running'
+        record.error = None
+        record.save()
+        profile_path = f"{profile_dir}/{stage.name}.prof" if profile_dir else None
+        try:
+            with trace(stage.name, category='stage'), profiling(profile_path):
+                for key in stage.list_items():
+                    if key in done:
+                        continue
+                    with trace(key, category='item'):
+                        stage.run_item(key, changed)
+                    BatchCheckpoint.objects.create(stage=record, key=key)
+                # outputs are not complete until their files are stored
+                wait_for_uploads()
+            record.status = 'completed'
+        except Exception:
+            record.status = 'failed'
+            record.error = traceback.format_exc()
+            raise
+        finally:
+            record.wall_time += time.perf_counter() - t
+            record.rows += stage.count_rows() - rows
+            record.bytes += count_uploaded_bytes() - uploaded_bytes
+            record.ended_at = datetime.datetime.now()
+            record.save()
+            print(f"Stage {stage.name} was {record.status} in {record.wall_time:.1f}s.")
+
+    def get_changed(self, record, force=False):
+        # names of changed inputs, None after skipping a stage whose inputs are unchanged
+        last = BatchStage.objects.filter(
+            name = record.name,
+            status = 'completed'
+        ).exclude(id=record.id).order_by('id').last()
+        last_fingerprint = last.fingerprint if last else dict()
+        changed = set([k for k, v in record.fingerprint.items() if last_fingerprint.get(k) != v])
+        if force:
+            return set(record.fingerprint.keys())
+        if len(record.fingerprint) > 0 and len(changed) == 0:
+            record.status = 'skipped'
+            record.ended_at = datetime.datetime.now()
+            record.save()
+            print(f"Stage {record.name} was skipped as its inputs are unchanged.")
+            return None
+        return changed
+
+
+# Distributed runs of `batch --worker`.
+# The first worker creates a run with a planning unit per stage.
+# Planning a stage fingerprints its inputs and queues its items as units,
+# so that workers on several nodes lease, run and complete them concurrently.
+# Leases are extended by heartbeats and expire when a worker crashes,
+# after which the unit is leased again by another worker.
+
+class Heartbeat:
+    def __init__(self, unit, lease_seconds):
+        self.unit = unit
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+    def beat(self):
+        try:
+            while not self.stopped.wait(self.lease_seconds / 3):
+                if not WorkUnit.objects.heartbeat(self.unit, self.lease_seconds):
+                    print(f"Lease of {self.unit} was lost.")
+                    return
+        finally:
+            connection.close()
+
+
+class Worker:
+    def __init__(self, stages=None, **kwargs):
+        self.stages = stages or list_stages()
+        self.pipeline = Pipeline(self.stages)
+        self.owner = kwargs.get('owner') or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = kwargs.get('lease_seconds', 600)
+        self.poll_seconds = kwargs.get('poll_seconds', 5)
+        self.max_attempts = kwargs.get('max_attempts', 3)
+
+    def run(self, **kwargs):
+        run = self.get_or_create_run(only=kwargs.get('stages'))
+        print(f"Worker {self.owner} joined {run}.")
+        while True:
+            unit = WorkUnit.objects.lease(run, self.owner, self.lease_seconds, self.max_attempts)
+            if unit is not None:
+                self.run_unit(run, unit, force=kwargs.get('force', False))
+                continue
+            if self.finish_run(run):
+                break
+            time.sleep(self.poll_seconds)
+        run.refresh_from_db()
+        return run
+
+    @advisory_lock('batch_run')
+    def get_or_create_run(self, only=None):
+        # workers join the earliest unfinished run, but not one held by a pipeline
+        first = BatchRun.objects.filter(status__in=['running', 'failed']).order_by('id').first()
+        if first is not None:
+            if is_run_held(first):
+                raise RunInProgress(first)
+            if first.status == 'failed':
+                WorkUnit.objects.retry_failed(first)
+                BatchRun.objects.filter(id=first.id).update(status='running')
+            self.plan_run(first, only)
+            return first
+        with transaction.atomic():
+            run = BatchRun.objects.create(selected_stages=only)
+            self.plan_run(run, only)
+        return run
+
+    def plan_run(self, run, only=None):
+        names = [stage.name for stage in self.stages if not only or stage.name in only]
+        for stage in self.stages:
+            if stage.name not in names:
+                continue
+            WorkUnit.objects.enqueue(run, stage.name, [''], depends_on=[n for n in stage.depends_on if n in names])
+
+    def run_unit(self, run, unit, force=False):
+        stage = [s for s in self.stages if s.name == unit.stage][0]
+        t = time.perf_counter()
+        try:
+            with Heartbeat(unit, self.lease_seconds), trace(f"{unit.stage}:{unit.key or '*'}", category='unit'):
+                if unit.key == '':
+                    self.plan_stage(run, stage, force)
+                else:
+                    self.run_item(run, stage, unit)
+        except Exception:
+            WorkUnit.objects.fail(unit, traceback.format_exc(), time.perf_counter() - t, self.max_attempts)
+            print(f"{unit} failed on attempt {unit.attempts}.")
+            return
+        if not WorkUnit.objects.complete(unit, time.perf_counter() - t):
+            print(f"{unit} was completed after its lease was lost.")
+        self.finish_stage(run, stage)
+
+    def plan_stage(self, run, stage, force=False):
+        record, created = BatchStage.objects.get_or_create(run=run, name=stage.name)
+        if record.status in ['completed', 'skipped']:
+            print(f"Stage {stage.name} was already done in {run}.")
+            return
+        if created:
+            record.fingerprint = stage.get_fingerprint()
+        changed = self.pipeline.get_changed(record, force)
+        if changed is None:
+            return
+        done = set(record.checkpoints.values_list('key', flat=True))
+        record.status = 'running'
+        record.error = None
+        # units of a stage run concurrently, so rows are counted from planning to the last unit
+        record.rows -= stage.count_rows()
+        record.save()
+        keys = [key for key in stage.list_work_units() if key not in done]
+        WorkUnit.objects.enqueue(run, stage.name, keys, params={'changed': sorted(changed)})
+        print(f"Stage {stage.name} was planned as {len(keys)} units.")
+
+    def run_item(self, run, stage, unit):
+        record = BatchStage.objects.get(run=run, name=stage.name)
+        uploaded_bytes = count_uploaded_bytes()
+        t = time.perf_counter()
+        stage.run_work_unit(unit.key, set(unit.params.get('changed', [])))
+        # outputs are not complete until their files are stored
+        wait_for_uploads()
+        BatchCheckpoint.objects.get_or_create(stage=record, key=unit.key)
+        BatchStage.objects.filter(id=record.id).update(
+            wall_time = F('wall_time') + time.perf_counter() - t,
+            bytes = F('bytes') + count_uploaded_bytes() - uploaded_bytes
+        )
+
+    def finish_stage(self, run, stage):
+        if WorkUnit.objects.filter(run=run, stage=stage.name).exclude(status='completed').exists():
+            return
+        qs = BatchStage.objects.filter(run=run, name=stage.name, status='running')
+        if qs.update(status='completed', ended_at=datetime.datetime.now()) == 0:
+            return
+        BatchStage.objects.filter(run=run, name=stage.name).update(rows=F('rows') + stage.count_rows())
+        print(f"Stage {stage.name} was completed.")
+
+    def finish_run(self, run):
+        # a run ends when no unit is leased or ready, failed if units are left incomplete
+        units = WorkUnit.objects.filter(run=run)
+        if units.filter(status='leased').exists() or len(WorkUnit.objects.list_ready(run)) > 0:
+            return False
+        if units.exclude(status='completed').exists():
+            status = 'failed'
+        else:
+            status = self.pipeline.get_finished_status(run)
+        BatchRun.objects.filter(id=run.id, status='running').update(
+            status = status,
+            ended_at = datetime.datetime.now()
+        )
+        if status == 'failed':
+            BatchStage.objects.filter(run=run, status='running').update(status='failed')
+        return True
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from django.apps import apps
+
+
+# Variables are addressed by {'model_name', 'id'} in factors of backtesters
+# and inputs of composite variables.
+# Addresses are resolved to model classes of the app instead of eval,
+# and resolved instances are memoized while a registry is active, e.g. for a batch,
+# so that variables shared by several factors and inputs are fetched once.
+# Outside of an active registry every resolution fetches its instances.
+
+VARIABLE_MODEL_NAMES = ['SingleAccount', 'MixedAccount', 'AccountRatio', 'PriceRatio', 'Momentum', 'Size']
+
+
+class Registry:
+    def __init__(self):
+        # result looks like {(model_name, id): instance, ...}
+        self.instances = dict()
+
+    def get_model(self, model_name):
+        if model_name not in VARIABLE_MODEL_NAMES:
+            raise LookupError(f"{model_name} is not a variable model.")
+        return apps.get_model('api', model_name)
+
+    def resolve(self, address):
+        return self.resolve_many([address])[0]
+
+    def resolve_many(self, addresses):
+        # missing instances are fetched in one query per model
+        missing = dict()
+        for address in addresses:
+            key = (address['model_name'], address['id'])
+            if key not in self.instances:
+                missing.setdefault(address['model_name'], set()).add(address['id'])
+        for model_name, ids in missing.items():
+            model = self.get_model(model_name)
+            found = model.objects.in_bulk(list(ids))
+            for id in ids:
+                if id not in found:
+                    raise model.DoesNotExist(f"{model_name} {id} does not exist.")
+                self.instances[(model_name, id)] = found[id]
+        return [self.instances[(address['model_name'], address['id'])] for address in addresses]
+
+
+_REGISTRY = None
+
+@contextmanager
+def resolving():
+    # memoizes resolved variables within the block, nested blocks share the outer registry
+    global _REGISTRY
+    if _REGISTRY is not None:
+        yield _REGISTRY
+        return
+    _REGISTRY = Registry()
+    try:
+        yield _REGISTRY
+    finally:
+        _REGISTRY = None
+
+def get_registry():
+    if _REGISTRY is None:
+        return Registry()
+    return _REGISTRY
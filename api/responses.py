@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+import datetime
+import gzip
+import json
+
+
+# Raw responses of data.go.kr kept on the file storage, keyed by (client, basDt, page).
+# Days older than OPENAPI_CACHE_RECENT_DAYS do not change after publication,
+# so their responses are served from the cache instead of the network.
+# Modes are
+#   off: the cache is not used,
+#   cache: valid responses are read and fetched ones are written,
+#   record: every response is fetched and written, e.g. to build fixtures,
+#   replay: responses are read only, a missing one raises OpenApiCacheMiss.
+
+class OpenApiCacheMiss(Exception):
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return f"{self.path} is not in the response cache."
+
+
+class ResponseCache:
+    def __init__(self, mode, prefix, recent_days, storage=None):
+        self.mode = mode
+        self.prefix = prefix
+        self.recent_days = recent_days
+        self.storage = storage or default_storage
+
+    def get_path(self, name, params):
+        if not params.get('basDt'):
+            return None
+        return f"{self.prefix}/{name}/{params['basDt']}/{params.get('pageNo', 1)}_{params.get('numOfRows', 10)}.json.gz"
+
+    def is_recent(self, params):
+        date = datetime.datetime.strptime(params['basDt'], '%Y%m%d').date()
+        return date > datetime.date.today() - datetime.timedelta(days=self.recent_days)
+
+    def get(self, name, params):
+        path = self.get_path(name, params)
+        if self.mode in ['off', 'record'] or path is None:
+            return None
+        if self.mode == 'cache' and self.is_recent(params):
+            return None
+        if not self.storage.exists(path):
+            if self.mode == 'replay':
+                raise OpenApiCacheMiss(path)
+            return None
+        with self.storage.open(path, 'rb') as f:
+            return json.loads(gzip.decompress(f.read()))
+
+    def put(self, name, params, d):
+        path = self.get_path(name, params)
+        if self.mode in ['off', 'replay'] or path is None:
+            return
+        if self.mode == 'cache' and self.is_recent(params):
+            return
+        content = gzip.compress(json.dumps(d, ensure_ascii=False).encode('utf-8'), mtime=0)
+        if self.storage.exists(path):
+            self.storage.delete(path)
+        self.storage.save(path, ContentFile(content))
+
+
+_RESPONSE_CACHE = None
+
+def get_response_cache():
+    global _RESPONSE_CACHE
+    if _RESPONSE_CACHE is None:
+        _RESPONSE_CACHE = ResponseCache(
+            mode = settings.OPENAPI_CACHE_MODE,
+            prefix = settings.OPENAPI_CACHE_PREFIX,
+            recent_days = settings.OPENAPI_CACHE_RECENT_DAYS
+        )
+    return _RESPONSE_CACHE
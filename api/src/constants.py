@@ -95,3 +95,17 @@ STOCK_PRICE_DATA_RENAME_MAP = {
     'lstgStCnt': 'n_listed',
     'mrktTotAmt': 'mktcap',
 }
+
+# data.go.kr result codes by how clients react to them.
+# Codes come as resultCode of json headers or returnReasonCode of xml errors.
+OPENAPI_RESULT_CODE_TO_KIND_MAP = {
+    '00': 'normal', # NORMAL_SERVICE
+    '03': 'normal', # NODATA_ERROR
+    '01': 'transient', # APPLICATION_ERROR
+    '02': 'transient', # DB_ERROR
+    '04': 'transient', # HTTP_ERROR
+    '05': 'transient', # SERVICETIME_OUT
+    '99': 'transient', # UNKNOWN_ERROR
+    '22': 'quota', # LIMITED_NUMBER_OF_SERVICE_REQUESTS_EXCEEDS_ERROR
+    '30': 'service_key', # SERVICE_KEY_IS_NOT_REGISTERED_ERROR, also raised on a wrongly encoded key
+}
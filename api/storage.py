@@ -0,0 +1,14 @@
+from django.conf import settings
+from storages.backends.s3boto3 import S3Boto3Storage
+
+
+# S3 storage of file fields.
+# django-storages 1.13 builds its TransferConfig from use_threads only and never reads
+# AWS_S3_TRANSFER_CONFIG, so that large objects would not go multipart as configured.
+
+class S3Storage(S3Boto3Storage):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        transfer_config = getattr(settings, 'AWS_S3_TRANSFER_CONFIG', None)
+        if transfer_config is not None:
+            self._transfer_config = transfer_config
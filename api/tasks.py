@@ -6,6 +6,7 @@ from .models import (
     Backtester,
 )
 from .managers import VariableManager
+from .pipeline import Pipeline
 
 
 def sync_openapi_to_latest():
@@ -22,12 +23,7 @@ def sync_opendart_to_latest():
     return changed
 
 
-def sync_to_latest():
-    # sync sources
-    sync_openapi_to_latest()
-    opendart_changed = sync_opendart_to_latest()
-
-    # sync products
-    vm = VariableManager()
-    vm.bulk_sync(opendart_changed=opendart_changed)
-    Backtester.objects.bulk_sync()
+def sync_to_latest(**kwargs):
+    # stages are run by the pipeline so that a failed batch resumes where it stopped,
+    # see pipeline.list_stages
+    return Pipeline().run(**kwargs)
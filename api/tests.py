@@ -1,3 +1,754 @@
-from django.test import TestCase
+from api.benchmarks import SyntheticMarket, SyntheticOpendart, load_prices
+from api.clients import OpendartDownloader, OpendartDownloadError
+from api.locks import advisory_lock
+from api.models import (
+    Backtester,
+    BatchRun,
+    FactorPortfolio,
+    FactorPortfolioData,
+    Momentum,
+    OpendartZipfile,
+    PriceRatio,
+    SingleAccount,
+    SingleAccountClient,
+    Size,
+    StockPrice,
+    StockSeries,
+    VariableData,
+    WorkUnit,
+)
+from api.pipeline import Pipeline, RunInProgress, Stage, Worker
+from api.registry import resolving
+from api.src.variable_configs import VARIABLE_CONFIGS
+from api.uploads import UploadQueue
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import csv
+import datetime
+import hashlib
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
+
+class NoopStage(Stage):
+    name = 'noop'
+
+
+def run_in_threads(target, n):
+    # result looks like [return value of target(i), ...], each thread on its own connection
+    results = [None] * n
+    errors = list()
+    barrier = threading.Barrier(n)
+
+    def run(i):
+        try:
+            barrier.wait()
+            results[i] = target(i)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
+
+class WorkUnitLeaseTests(TransactionTestCase):
+    def setUp(self):
+        self.run = BatchRun.objects.create()
+
+    def expire(self, unit):
+        WorkUnit.objects.filter(id=unit.id).update(
+            leased_until = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        )
+
+    def test_concurrent_leases_are_exclusive(self):
+        WorkUnit.objects.enqueue(self.run, 'noop', [str(i) for i in range(20)])
+
+        def lease_all(i):
+            ids = list()
+            while True:
+                unit = WorkUnit.objects.lease(self.run, f"worker{i}", 60, 3)
+                if unit is None:
+                    return ids
+                ids.append(unit.id)
+        leased = sum(run_in_threads(lease_all, 4), [])
+        self.assertEqual(sorted(leased), sorted(WorkUnit.objects.values_list('id', flat=True)))
+        self.assertEqual(set(WorkUnit.objects.values_list('attempts', flat=True)), {1})
+
+    def test_lease_of_a_stale_read_is_refused(self):
+        WorkUnit.objects.enqueue(self.run, 'noop', ['1'])
+        stale = WorkUnit.objects.list_ready(self.run)
+        self.assertIsNotNone(WorkUnit.objects.lease(self.run, 'worker0', 60, 3))
+        with mock.patch.object(WorkUnit.objects, 'list_ready', return_value=stale):
+            self.assertIsNone(WorkUnit.objects.lease(self.run, 'worker1', 60, 3))
+
+    def test_expired_lease_of_a_crashed_worker_is_leased_again(self):
+        WorkUnit.objects.enqueue(self.run, 'noop', ['1'])
+        crashed = WorkUnit.objects.lease(self.run, 'worker0', 60, 3)
+        self.assertIsNone(WorkUnit.objects.lease(self.run, 'worker1', 60, 3))
+        self.expire(crashed)
+        unit = WorkUnit.objects.lease(self.run, 'worker1', 60, 3)
+        self.assertEqual((unit.id, unit.owner, unit.attempts), (crashed.id, 'worker1', 2))
+        self.assertFalse(WorkUnit.objects.heartbeat(crashed, 60))
+        self.assertFalse(WorkUnit.objects.complete(crashed, 1.0))
+        self.assertTrue(WorkUnit.objects.complete(unit, 1.0))
+
+    def test_unit_fails_after_max_attempts(self):
+        WorkUnit.objects.enqueue(self.run, 'noop', ['1'])
+        for attempt in range(2):
+            unit = WorkUnit.objects.lease(self.run, f"worker{attempt}", 60, 2)
+            self.expire(unit)
+        self.assertIsNone(WorkUnit.objects.lease(self.run, 'worker2', 60, 2))
+        unit.refresh_from_db()
+        self.assertEqual((unit.status, unit.attempts), ('failed', 2))
+        self.assertTrue(Worker([NoopStage()]).finish_run(self.run))
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.status, 'failed')
+
+    def test_failed_unit_is_retried_until_max_attempts(self):
+        WorkUnit.objects.enqueue(self.run, 'noop', ['1'])
+        for attempt in range(2):
+            unit = WorkUnit.objects.lease(self.run, f"worker{attempt}", 60, 2)
+            self.assertTrue(WorkUnit.objects.fail(unit, 'error', 1.0, 2))
+        unit.refresh_from_db()
+        self.assertEqual((unit.status, unit.attempts), ('failed', 2))
+        self.assertIsNone(WorkUnit.objects.lease(self.run, 'worker2', 60, 2))
+
+
+class BatchRunSelectionTests(TransactionTestCase):
+    def hold(self, run):
+        # holds the lock of run in another thread, as a running pipeline does
+        acquired = threading.Event()
+        released = threading.Event()
+
+        def hold_lock():
+            with advisory_lock(f"batch_run:{run.id}"):
+                acquired.set()
+                released.wait()
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        acquired.wait()
+        self.addCleanup(thread.join)
+        self.addCleanup(released.set)
+
+    def test_run_held_by_another_pipeline_is_not_taken_over(self):
+        run = BatchRun.objects.create()
+        self.hold(run)
+        with self.assertRaises(RunInProgress):
+            Pipeline([NoopStage()]).run()
+        with self.assertRaises(RunInProgress):
+            Worker([NoopStage()]).get_or_create_run()
+        self.assertEqual(list(BatchRun.objects.values_list('id', 'status')), [(run.id, 'running')])
+
+    def test_run_of_a_crashed_pipeline_is_resumed(self):
+        run = BatchRun.objects.create()
+        resumed = Pipeline([NoopStage()]).run()
+        self.assertEqual((resumed.id, resumed.status), (run.id, 'completed'))
+
+    def test_workers_starting_together_join_one_run(self):
+        ids = run_in_threads(lambda i: Worker([NoopStage()]).get_or_create_run().id, 4)
+        self.assertEqual(len(set(ids)), 1)
+        self.assertEqual(BatchRun.objects.count(), 1)
+        self.assertEqual(WorkUnit.objects.filter(run_id=ids[0]).count(), 1)
+
+
+class StockSeriesMergeTests(TestCase):
+    def data(self, date, values):
+        # values looks like {stock_code: value, ...}
+        return VariableData(
+            variable = {'model_name': 'Size', 'id': 1},
+            date = date,
+            records = [{'stock_code': k, 'market': 'KOSPI', 'value': v} for k, v in values.items()]
+        )
+
+    def series(self):
+        return {
+            obj.stock_code: obj.get_columns()['value'].tolist()
+            for obj in StockSeries.objects.filter(series_key='Size:1')
+        }
+
+    def test_resynced_dates_are_removed_from_stocks_missing_on_them(self):
+        d1, d2 = datetime.date(2020, 1, 31), datetime.date(2020, 2, 28)
+        StockSeries.objects.merge('Size:1', [self.data(d1, {'A': 1.0, 'B': 2.0}), self.data(d2, {'A': 3.0, 'B': 4.0})])
+        StockSeries.objects.merge('Size:1', [self.data(d2, {'A': 5.0})])
+        self.assertEqual(self.series(), {'A': [1.0, 5.0], 'B': [2.0]})
+        StockSeries.objects.merge('Size:1', [self.data(d1, {'A': 6.0})])
+        self.assertEqual(self.series(), {'A': [6.0, 5.0]})
+
+
+def save_file(obj, filename, content):
+    # Saves in place of the background upload queue, so that tests run in one transaction.
+    # As uploads of the queue do, the file is written by pk and the instance is left as it is.
+    if hasattr(content, 'getvalue'):
+        content = content.getvalue()
+    field = obj._meta.get_field('file')
+    name = field.storage.save(field.generate_filename(None, filename), ContentFile(content))
+    type(obj).objects.filter(pk=obj.pk).update(file=name)
+
+
+class QueryCountTests(TestCase):
+    # Queries of hot paths are counted on a universe of N_STOCKS stocks,
+    # and subclasses count them again on larger universes against the same numbers,
+    # so that queries run per stock, e.g. N+1 lookups in loops, fail the tests.
+    N_STOCKS = 4
+
+    @classmethod
+    def setUpTestData(cls):
+        market = SyntheticMarket(cls.N_STOCKS, datetime.date(2021, 6, 1), datetime.date(2023, 7, 31))
+        conf = [conf for conf in VARIABLE_CONFIGS['single_account'] if conf['name'] == 'equity'][0]
+        opendart = SyntheticOpendart(market, [conf])
+        with mock.patch('api.models.upload_file', save_file):
+            load_prices(market, market.days[-1])
+            for filename, content in opendart.zipfiles.items():
+                if f"_{conf['fs_div']}_" not in filename:
+                    continue
+                zf = OpendartZipfile(**OpendartZipfile.objects.parse_filename(filename))
+                zf.file.save(filename, ContentFile(content))
+                zf.bootstrap_text_files(use_file=BytesIO(content))
+            cls.client_ = SingleAccountClient.objects.create(
+                fs_div = conf['fs_div'],
+                name = conf['name'],
+                cfs = conf['cfs'],
+                label_en = conf['name'],
+                label_kr = conf['name']
+            )
+            cls.client_.sync_to_sources()
+            cls.account = SingleAccount.objects.create(name=conf['name'], client=cls.client_)
+            cls.size = Size.objects.create(name='size')
+            cls.variables = [
+                cls.account,
+                cls.size,
+                PriceRatio.objects.create(name='book_to_market', numerator=cls.account.address),
+                Momentum.objects.create(name='momentum', near=1, far=12),
+            ]
+            for var in cls.variables:
+                var.bulk_sync_data()
+            cls.backtester = Backtester.objects.create(factors=[{
+                **cls.size.address,
+                'quantiles': [0, 0.3, 0.7, 1],
+                'labels': ['bottom', 'middle', 'top'],
+                'lookback': 6,
+            }])
+            cls.backtester.get_or_create_portfolios()
+            with resolving():
+                cls.backtester.bulk_sync_data()
+
+    def setUp(self):
+        patcher = mock.patch('api.models.upload_file', save_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fixture_spans_the_universe(self):
+        self.assertEqual(StockSeries.objects.filter(series_key=self.size.address_key).count(), self.N_STOCKS)
+
+    def test_variable_bulk_sync_data(self):
+        # every date is synced again, as after a change of sources
+        for var in self.variables:
+            VariableData.objects.filter(variable_key=var.address_key).update(checksum=None)
+        # book_to_market writes the 3 years of the fixture one after another
+        for var, n_queries in zip(self.variables, [10, 11, 20, 11]):
+            with self.subTest(var=var.name), self.assertNumQueries(n_queries):
+                type(var).objects.get(pk=var.pk).bulk_sync_data()
+
+    def test_variable_write_file(self):
+        for var in self.variables:
+            with self.subTest(var=var.name), self.assertNumQueries(3):
+                var.write_file()
+
+    def test_backtester_write_file(self):
+        backtester = Backtester.objects.get(pk=self.backtester.pk)
+        with self.assertNumQueries(4):
+            backtester.write_file()
+
+    def test_single_account_client_get_records_from_sources(self):
+        with self.assertNumQueries(1):
+            records = self.client_.get_records_from_sources()
+        self.assertEqual(len(set([r['stock_code'] for r in records])), self.N_STOCKS)
+
+    def test_labels_of_portfolios(self):
+        backtester = Backtester.objects.get(pk=self.backtester.pk)
+        with self.assertNumQueries(1):
+            qlmap = backtester.quantile_locs_to_label_map
+            labels = [pf.label for pf in backtester.get_portfolios()]
+            self.assertEqual(backtester.label_to_quantile_locs_map, {v: k for k, v in qlmap.items()})
+        self.assertEqual(sorted(labels), ['bottom', 'middle', 'top'])
+
+
+class LargerUniverseQueryCountTests(QueryCountTests):
+    N_STOCKS = 12
+
+
+class ArchiveServer:
+    # local http server of opendart archives answering Range requests,
+    # the first response of each archive is cut after drop_ratio of its body if given,
+    # and ranges are answered with whole bodies if ignores_range
+    def __init__(self, archives, drop_ratio=0, ignores_range=False):
+        self.archives = archives
+        self.drop_ratio = drop_ratio
+        self.ignores_range = ignores_range
+        self.dropped = set()
+        # result looks like [(filename, range header, status), ...]
+        self.responses = list()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.get_handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def list_statuses(self, filename):
+        return [status for name, range, status in self.responses if name == filename]
+
+    def get_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = parse_qs(urlparse(self.path).query).get('fl_nm', [None])[0]
+                body = stub.archives.get(name)
+                start = 0
+                if self.headers['Range'] and not stub.ignores_range:
+                    start = int(self.headers['Range'].split('=')[1].split('-')[0])
+                status = 404 if body is None else (416 if start >= len(body) else (206 if start > 0 else 200))
+                with stub.lock:
+                    stub.responses.append((name, self.headers['Range'], status))
+                    is_dropped = status in [200, 206] and stub.drop_ratio > 0 and name not in stub.dropped
+                    stub.dropped.add(name)
+                if status in [404, 416]:
+                    self.send_error(status)
+                    return
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body) - start))
+                if status == 206:
+                    self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+                self.end_headers()
+                if is_dropped:
+                    self.wfile.write(body[start:start + int((len(body) - start) * stub.drop_ratio)])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body[start:])
+
+            def log_message(self, *args):
+                return
+
+        return Handler
+
+
+def create_archive(compression=zipfile.ZIP_DEFLATED):
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=compression) as zf:
+        zf.writestr('statements.txt', ''.join([str(i) for i in range(1000)]))
+    return buffer.getvalue()
+
+
+class OpendartDownloaderTests(TestCase):
+    FILENAME = '2022_1Q_BS_20220530090000.zip'
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.body = create_archive()
+
+    def download(self, server, filename=FILENAME):
+        with override_settings(
+            OPENDART_URL = server.url,
+            OPENDART_DOWNLOAD_DIR = self.dir.name,
+            OPENDART_DOWNLOAD_CHUNK = 64,
+            OPENDART_BACKOFF = 0
+        ):
+            return OpendartDownloader().download(filename)
+
+    def assertDownloaded(self, path, body):
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), body)
+        self.assertEqual(os.listdir(self.dir.name), [self.FILENAME])
+
+    def assertResumedWithinDroppedHalf(self, range_header):
+        # bytes of a chunk cut by the drop are not written, the range starts from bytes on disk
+        start = int(range_header.split('=')[1].split('-')[0])
+        self.assertTrue(0 < start <= len(self.body) // 2)
+
+    def test_dropped_connection_resumes_from_received_bytes(self):
+        with ArchiveServer({self.FILENAME: self.body}, drop_ratio=0.5) as server:
+            path = self.download(server)
+        self.assertDownloaded(path, self.body)
+        self.assertEqual(server.list_statuses(self.FILENAME), [200, 206])
+        self.assertResumedWithinDroppedHalf(server.responses[1][1])
+
+    def test_server_ignoring_ranges_restarts_from_zero(self):
+        with ArchiveServer({self.FILENAME: self.body}, drop_ratio=0.5, ignores_range=True) as server:
+            path = self.download(server)
+        self.assertDownloaded(path, self.body)
+        self.assertEqual(server.list_statuses(self.FILENAME), [200, 200])
+        self.assertResumedWithinDroppedHalf(server.responses[1][1])
+
+    def test_complete_partial_file_is_verified_on_416(self):
+        with open(os.path.join(self.dir.name, f"{self.FILENAME}.part"), 'wb') as f:
+            f.write(self.body)
+        with ArchiveServer({self.FILENAME: self.body}) as server:
+            path = self.download(server)
+        self.assertDownloaded(path, self.body)
+        self.assertEqual(server.list_statuses(self.FILENAME), [416])
+
+    def test_corrupt_archive_is_removed(self):
+        stored = bytearray(create_archive(zipfile.ZIP_STORED))
+        # a byte of a stored member fails its crc
+        stored[100] ^= 0xff
+        deflated = bytearray(self.body)
+        # zeros of a deflated member fail to decompress
+        deflated[50:66] = bytes(16)
+        for name, body in [('crc', bytes(stored)), ('deflate', bytes(deflated)), ('truncated', self.body[:-100])]:
+            with self.subTest(corruption=name), ArchiveServer({self.FILENAME: body}) as server:
+                with self.assertRaises(OpendartDownloadError):
+                    self.download(server)
+                self.assertEqual(os.listdir(self.dir.name), [])
+                self.assertEqual(server.list_statuses(self.FILENAME), [200])
+
+
+class OpendartParallelDownloadTests(TestCase):
+    def test_failed_archive_keeps_the_others_and_its_last_update(self):
+        market = SyntheticMarket(3, datetime.date(2022, 1, 1), datetime.date(2022, 12, 31))
+        confs = [conf for conf in VARIABLE_CONFIGS['single_account'] if conf['name'] in ['equity', 'revenue']]
+        archives = SyntheticOpendart(market, confs).zipfiles
+        filenames = sorted(archives.keys())
+        failed = filenames[0]
+        archives[failed] = archives[failed][:-100]
+        previous = OpendartZipfile.objects.create(
+            identifier = OpendartZipfile.objects.parse_filename(failed)['identifier'],
+            last_update = datetime.datetime(2022, 1, 1)
+        )
+        ls_changed = list()
+        for filename in filenames:
+            d = OpendartZipfile.objects.parse_filename(filename)
+            obj, created = OpendartZipfile.objects.get_or_create(identifier=d['identifier'])
+            obj.last_update = d['last_update']
+            ls_changed.append((obj, filename, created))
+
+        download_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(download_dir.cleanup)
+        uploaded = list()
+
+        def upload_file(obj, filename, content):
+            uploaded.append(filename)
+            content.close()
+
+        with ArchiveServer(archives) as server, override_settings(
+            OPENDART_URL = server.url,
+            OPENDART_DOWNLOAD_DIR = download_dir.name,
+            OPENDART_BACKOFF = 0
+        ), mock.patch('api.managers.upload_file', upload_file):
+            with self.assertRaises(OpendartDownloadError):
+                OpendartZipfile.objects.download_in_parallel(ls_changed)
+
+        self.assertEqual(sorted(uploaded), filenames[1:])
+        self.assertEqual(os.listdir(download_dir.name), [])
+        previous.refresh_from_db()
+        self.assertEqual(previous.last_update, datetime.datetime(2022, 1, 1))
+        self.assertEqual(previous.text_files.count(), 0)
+        for filename in filenames[1:]:
+            d = OpendartZipfile.objects.parse_filename(filename)
+            obj = OpendartZipfile.objects.get(identifier=d['identifier'])
+            self.assertEqual(obj.last_update, d['last_update'])
+            self.assertEqual(obj.text_files.count(), 1)
+
+
+@override_settings(MEDIA_ROOT=os.path.join(tempfile.gettempdir(), 'marketdata-test-media'))
+class UploadQueueTests(TransactionTestCase):
+    # the real queue on FileSystemStorage, its threads write rows on their own connections
+    def setUp(self):
+        self.queue = UploadQueue(max_workers=2, max_pending=4, retries=1)
+        self.client_ = SingleAccountClient.objects.create(fs_div='BS', name='equity', cfs=True)
+        self.saved = list()
+        save = FileSystemStorage.save
+
+        def record_save(storage, name, content, max_length=None):
+            self.saved.append(content.read())
+            return save(storage, name, content, max_length=max_length)
+        patcher = mock.patch.object(FileSystemStorage, 'save', record_save)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read_row(self):
+        obj = SingleAccountClient.objects.get(pk=self.client_.pk)
+        with obj.file.open('rb') as f:
+            return f.read(), obj.file_checksum
+
+    def test_storage_is_the_file_system(self):
+        self.assertIsInstance(SingleAccountClient._meta.get_field('file').storage, FileSystemStorage)
+
+    def test_unchanged_content_is_not_uploaded_again(self):
+        self.queue.submit(self.client_, 'a.zip', b'a')
+        # compared with the result of the pending upload
+        self.queue.submit(self.client_, 'a.zip', b'a')
+        self.queue.wait()
+        # compared with the file of the row
+        self.queue.wait_for(self.client_)
+        self.assertIsNone(self.queue.submit(self.client_, 'a.zip', b'a'))
+        self.assertEqual(self.saved, [b'a'])
+        self.assertEqual(self.read_row()[0], b'a')
+
+    def test_chained_uploads_of_an_object_keep_their_order(self):
+        save = FileSystemStorage.save
+
+        def slow_first(storage, name, content, max_length=None):
+            if content.read() == b'first':
+                time.sleep(0.3)
+            content.seek(0)
+            return save(storage, name, content, max_length=max_length)
+        with mock.patch.object(FileSystemStorage, 'save', slow_first):
+            self.queue.submit(self.client_, 'a.zip', b'first')
+            self.queue.submit(self.client_, 'a.zip', b'second')
+            self.queue.wait()
+        self.assertEqual(self.read_row(), (b'second', hashlib.sha256(b'second').hexdigest()))
+
+    def test_failing_save_is_retried(self):
+        save = FileSystemStorage.save
+        attempts = list()
+
+        def fail_once(storage, name, content, max_length=None):
+            attempts.append(name)
+            if len(attempts) == 1:
+                raise OSError('storage is unavailable')
+            return save(storage, name, content, max_length=max_length)
+        with mock.patch.object(FileSystemStorage, 'save', fail_once), mock.patch('api.uploads.time.sleep'):
+            self.queue.submit(self.client_, 'a.zip', b'a')
+            self.queue.wait()
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.read_row()[0], b'a')
+
+    def test_errors_are_raised_by_wait_for_and_wait(self):
+        failing = mock.patch.object(FileSystemStorage, 'save', side_effect=OSError('storage is unavailable'))
+        with failing, mock.patch('api.uploads.time.sleep'):
+            self.queue.submit(self.client_, 'a.zip', b'a')
+            with self.assertRaises(OSError):
+                self.queue.wait_for(self.client_)
+            with self.assertRaises(OSError):
+                self.queue.wait()
+        self.assertFalse(SingleAccountClient.objects.get(pk=self.client_.pk).file)
+
+    def test_file_is_read_right_after_write_file(self):
+        records = [{'stock_code': '005930', 'value': '1'}]
+        with mock.patch('api.uploads._UPLOAD_QUEUE', self.queue):
+            self.client_.write_file(use_records=records)
+            # the instance is left as it is by the upload, get_file waits for it
+            zf = self.client_.get_file()
+            self.assertEqual(zf.namelist(), [self.client_.CSV_FILENAME])
+            # instances read before the upload find the file of the row once the queue was waited for
+            stale = SingleAccountClient.objects.get(pk=self.client_.pk)
+            self.queue.wait()
+            self.assertEqual(stale.get_file().namelist(), [self.client_.CSV_FILENAME])
+
+
+@skipUnless(importlib.util.find_spec('storages'), 'django-storages is not installed')
+class S3StorageTests(TestCase):
+    def test_transfer_config_is_read_from_settings(self):
+        from api.storage import S3Storage
+        from boto3.s3.transfer import TransferConfig
+        transfer_config = TransferConfig(multipart_threshold=1024 * 1024)
+        with override_settings(AWS_S3_TRANSFER_CONFIG=transfer_config, AWS_STORAGE_BUCKET_NAME='bucket'):
+            self.assertIs(S3Storage()._transfer_config, transfer_config)
+
+
+class LegacyPortfolioDataTests(TransactionTestCase):
+    # rows of the former one-row-per-day schema of FactorPortfolioData, without blob and last_date
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.migrate([('api', target)])
+        return executor.loader.project_state([('api', target)]).apps
+
+    def test_legacy_rows_are_removed_and_backtesters_sync_again(self):
+        apps = self.migrate('0007_stock_price_last_update')
+        self.addCleanup(self.migrate, '0008_drop_legacy_portfolio_data')
+        btmodel = apps.get_model('api', 'Backtester')
+        fpdmodel = apps.get_model('api', 'FactorPortfolioData')
+        legacy, synced = [btmodel.objects.create(
+            rebalancing_history = {'20220630': {'bottom': ['005930']}},
+            formation_fingerprints = {'20220630': 'fingerprint'}
+        ) for i in range(2)]
+        for backtester, blob in [(legacy, None), (synced, b'blob')]:
+            portfolio = apps.get_model('api', 'FactorPortfolio').objects.create(
+                backtester = backtester,
+                quantile_locs = [0],
+                quantile_key = '0'
+            )
+            fpdmodel.objects.create(portfolio=portfolio, date=datetime.date(2022, 6, 30), blob=blob)
+        self.migrate('0008_drop_legacy_portfolio_data')
+        self.assertEqual(list(FactorPortfolioData.objects.values_list('portfolio__backtester_id', flat=True)), [synced.id])
+        legacy = Backtester.objects.get(id=legacy.id)
+        self.assertEqual((legacy.rebalancing_history, legacy.formation_fingerprints), (dict(), dict()))
+        synced = Backtester.objects.get(id=synced.id)
+        self.assertEqual(synced.formation_fingerprints, {'20220630': 'fingerprint'})
+
+    def test_legacy_rows_read_as_empty_periods(self):
+        backtester = Backtester.objects.create()
+        portfolio = FactorPortfolio.objects.create(backtester=backtester, quantile_locs=[0], quantile_key='0')
+        data = FactorPortfolioData.objects.create(portfolio=portfolio, date=datetime.date(2022, 6, 30))
+        self.assertEqual({k: len(v) for k, v in data.get_columns().items()}, {'date': 0, 'value_vw': 0, 'value_ew': 0})
+        starts_on = backtester.DATA_STARTS_ON
+        for date in [starts_on, starts_on + datetime.timedelta(days=1)]:
+            StockPrice.objects.create(date=date)
+        prices = backtester.detect_new_prices()
+        self.assertEqual(list(prices.values_list('date', flat=True)), [starts_on + datetime.timedelta(days=1)])
+
+
+class DataApiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.market = SyntheticMarket(3, datetime.date(2021, 6, 1), datetime.date(2023, 7, 31))
+        conf = [conf for conf in VARIABLE_CONFIGS['single_account'] if conf['name'] == 'equity'][0]
+        opendart = SyntheticOpendart(cls.market, [conf])
+        with mock.patch('api.models.upload_file', save_file):
+            load_prices(cls.market, cls.market.days[-1])
+            for filename, content in opendart.zipfiles.items():
+                if f"_{conf['fs_div']}_" not in filename:
+                    continue
+                zf = OpendartZipfile(**OpendartZipfile.objects.parse_filename(filename))
+                zf.file.save(filename, ContentFile(content))
+                zf.bootstrap_text_files(use_file=BytesIO(content))
+            cls.client_ = SingleAccountClient.objects.create(
+                fs_div = conf['fs_div'],
+                name = conf['name'],
+                cfs = conf['cfs'],
+                label_en = conf['name'],
+                label_kr = conf['name']
+            )
+            cls.client_.sync_to_sources()
+            cls.size = Size.objects.create(name='size')
+            cls.size.bulk_sync_data()
+            cls.backtester = Backtester.objects.create(factors=[{
+                **cls.size.address,
+                'quantiles': [0, 0.5, 1],
+                'labels': ['bottom', 'top'],
+                'lookback': 6,
+            }])
+            cls.backtester.get_or_create_portfolios()
+            with resolving():
+                cls.backtester.bulk_sync_data()
+        cls.urls = {
+            'prices': '/api/prices',
+            'variable': f"/api/variables/Size/{cls.size.id}",
+            'single-account': f"/api/single-accounts/{cls.client_.id}",
+            'backtester-returns': f"/api/backtesters/{cls.backtester.id}/returns",
+            'stock-history': f"/api/stocks/{cls.market.stock_codes[0]}/history",
+        }
+
+    def setUp(self):
+        caches['api'].clear()
+
+    def get(self, url, **kwargs):
+        response = self.client.get(url, **kwargs)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def get_rows(self, url, params):
+        response, body = self.get(url, data={**params, 'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(body)
+
+    def test_json_and_csv_bodies(self):
+        for name, url in self.urls.items():
+            with self.subTest(endpoint=name):
+                response, body = self.get(url, data={'format': 'json'})
+                self.assertEqual((response.status_code, response['Content-Type']), (200, 'application/json'))
+                rows = json.loads(body)
+                self.assertGreater(len(rows), 0)
+                response, body = self.get(url, data={'format': 'csv'})
+                self.assertEqual((response.status_code, response['Content-Type']), (200, 'text/csv'))
+                header, *lines = list(csv.reader(StringIO(body.decode('utf-8'))))
+                self.assertEqual(header, list(rows[0].keys()))
+                self.assertEqual(len(lines), len(rows))
+                self.assertEqual(lines[0], ['' if v is None else str(v) for v in rows[0].values()])
+
+    def test_date_and_stock_code_filters(self):
+        stock_codes = self.market.stock_codes[1:]
+        params = {'start': '20230101', 'end': '2023-06-30', 'stock_codes': ','.join(stock_codes)}
+        for name, url in self.urls.items():
+            with self.subTest(endpoint=name):
+                rows = self.get_rows(url, params)
+                all_rows = self.get_rows(url, dict())
+                self.assertGreater(len(rows), 0)
+                self.assertLess(len(rows), len(all_rows))
+                self.assertTrue(all(['20230101' <= str(r['date']) <= '20230630' for r in rows]))
+                if 'stock_code' in rows[0]:
+                    self.assertEqual(set([r['stock_code'] for r in rows]), set(stock_codes))
+
+    def test_bad_filters(self):
+        for params in [{'format': 'xml'}, {'start': '2022-13-01'}, {'fields': 'close,volume'}]:
+            with self.subTest(params=params):
+                response, body = self.get(self.urls['prices'], data=params)
+                self.assertEqual(response.status_code, 400)
+
+    def test_if_none_match(self):
+        response, body = self.get(self.urls['prices'])
+        etag = response['ETag']
+        response, body = self.get(self.urls['prices'], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, body), (304, b''))
+        self.assertEqual(response['ETag'], etag)
+        response, body = self.get(self.urls['prices'], data={'format': 'csv'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_ranges(self):
+        url = self.urls['variable']
+        # the first range is rendered and cached, and later ones are cut from the cached body
+        response, body = self.get(url, HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        etag = response['ETag']
+        response, full = self.get(url)
+        self.assertFalse(response.streaming)
+        self.assertEqual(body, full[:10])
+        self.assertIsNone(response.get('Content-Range'))
+        cases = [
+            ({'HTTP_RANGE': 'bytes=10-19'}, 206, full[10:20], f"bytes 10-19/{len(full)}"),
+            ({'HTTP_RANGE': 'bytes=-5'}, 206, full[-5:], f"bytes {len(full) - 5}-{len(full) - 1}/{len(full)}"),
+            ({'HTTP_RANGE': f"bytes={len(full) - 3}-"}, 206, full[-3:], f"bytes {len(full) - 3}-{len(full) - 1}/{len(full)}"),
+            ({'HTTP_RANGE': f"bytes={len(full)}-"}, 416, b'', f"bytes */{len(full)}"),
+            ({'HTTP_RANGE': 'bytes=5-3'}, 200, full, None),
+            ({'HTTP_RANGE': 'items=0-9'}, 200, full, None),
+            ({'HTTP_RANGE': 'bytes=0-9', 'HTTP_IF_RANGE': etag}, 206, full[:10], f"bytes 0-9/{len(full)}"),
+            ({'HTTP_RANGE': 'bytes=0-9', 'HTTP_IF_RANGE': '"stale"'}, 200, full, None),
+        ]
+        for headers, status, expected, content_range in cases:
+            with self.subTest(headers=headers):
+                response, body = self.get(url, **headers)
+                self.assertEqual((response.status_code, body), (status, expected))
+                self.assertEqual(response.get('Content-Range'), content_range)
+                self.assertEqual(response['ETag'], etag)
+
+    @skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_arrow_bodies(self):
+        import pyarrow.ipc
+        for name, url in self.urls.items():
+            with self.subTest(endpoint=name):
+                rows = self.get_rows(url, dict())
+                response, body = self.get(url, data={'format': 'arrow'})
+                self.assertEqual(response['Content-Type'], 'application/vnd.apache.arrow.stream')
+                table = pyarrow.ipc.open_stream(body).read_all()
+                self.assertEqual(table.column_names, list(rows[0].keys()))
+                self.assertEqual(table.num_rows, len(rows))
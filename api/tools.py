@@ -1,5 +1,8 @@
+from django.db import connections
 from io import BytesIO, StringIO
 import csv
+import hashlib
+import json
 import zipfile
 
 def convert_records_to_csv(records):
@@ -15,9 +18,26 @@ def create_zipfile(files_to_zip):
     zip_buffer = BytesIO()
     zipfile_instance = zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_DEFLATED)
     for d in files_to_zip:
+        # fixed timestamps keep the bytes of unchanged contents equal
         zipfile_instance.writestr(
-            d['name'],
-            d['file'].getvalue()
+            zipfile.ZipInfo(d['name'], date_time=(1980, 1, 1, 0, 0, 0)),
+            d['file'].getvalue(),
+            compress_type = zipfile.ZIP_DEFLATED
         )
     zipfile_instance.close()
     return zip_buffer
+
+def hash_records(records):
+    serialized = json.dumps(records, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+def bulk_upsert(manager, objs, unique_fields, update_fields, batch_size=None):
+    # mysql updates on conflicts of any unique key and takes no conflict target
+    features = connections[manager.db].features
+    return manager.bulk_create(
+        objs,
+        batch_size = batch_size,
+        update_conflicts = True,
+        unique_fields = unique_fields if features.supports_update_conflicts_with_target else None,
+        update_fields = update_fields
+    )
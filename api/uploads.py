@@ -0,0 +1,157 @@
+from .instrumentation import traced
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.db import connection
+
+import hashlib
+import os
+import threading
+import time
+
+
+# Background uploads of FileFields.
+# Uploads run on a bounded thread pool while computation continues,
+# uploads of the same object keep their order,
+# and content equal to the last uploaded one is not uploaded again.
+# Content is bytes, a buffer or a file opened in binary mode,
+# files are streamed from disk and closed once uploaded.
+
+class UploadQueue:
+    def __init__(self, max_workers, max_pending, retries):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload')
+        # submit blocks while max_pending uploads hold their content in memory
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.retries = retries
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.uploaded_bytes = 0
+
+    def submit(self, obj, filename, content):
+        # obj is only read here, the upload writes its row by pk
+        if hasattr(content, 'getvalue'):
+            content = content.getvalue()
+        checksum = get_checksum(content)
+        key = (obj._meta.label, obj.pk)
+        with self.lock:
+            if self.pending.get(key) is None and obj.file and obj.file_checksum == checksum:
+                print(f"{filename} is unchanged on cloud storage.")
+                close(content)
+                return None
+        self.slots.acquire()
+        with self.lock:
+            previous = self.pending.get(key)
+            future = self.executor.submit(
+                self.upload,
+                type(obj),
+                obj.pk,
+                filename,
+                content,
+                checksum,
+                previous,
+                (obj.file.name, obj.file_checksum)
+            )
+            self.pending[key] = future
+        return future
+
+    @traced
+    def upload(self, model, pk, filename, content, checksum, previous, current):
+        # result looks like (file name, checksum) of the row after the upload
+        try:
+            if previous is not None:
+                current = previous.result()
+            if current[0] and current[1] == checksum:
+                print(f"{filename} is unchanged on cloud storage.")
+                return current
+            field = model._meta.get_field('file')
+            name = field.generate_filename(None, filename)
+            for attempt in range(self.retries + 1):
+                try:
+                    name = field.storage.save(name, as_file(content), max_length=field.max_length)
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        raise
+                    print(f"uploading {filename} failed ({e}), retrying.")
+                    time.sleep(2 ** attempt)
+            values = {'file': name, 'file_checksum': checksum}
+            if any(f.name == 'url' for f in model._meta.concrete_fields):
+                values['url'] = field.storage.url(name).split('?')[0]
+            model.objects.filter(pk=pk).update(**values)
+            with self.lock:
+                self.uploaded_bytes += get_size(content)
+            print(f"{filename} was saved on cloud storage.")
+            return (name, checksum)
+        finally:
+            close(content)
+            self.slots.release()
+            connection.close()
+
+    def wait_for(self, obj):
+        # makes the file of obj readable after its pending upload
+        with self.lock:
+            future = self.pending.get((obj._meta.label, obj.pk))
+        if future is not None:
+            obj.file, obj.file_checksum = future.result()
+        elif not obj.file and obj.pk is not None:
+            # uploaded before the queue was waited for, the row holds the file
+            obj.refresh_from_db(fields=['file', 'file_checksum'])
+
+    def wait(self):
+        with self.lock:
+            futures = list(self.pending.values())
+            self.pending = dict()
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if len(errors) > 0:
+            raise errors[0]
+
+
+def get_checksum(content):
+    if isinstance(content, bytes):
+        return hashlib.sha256(content).hexdigest()
+    h = hashlib.sha256()
+    content.seek(0)
+    for chunk in iter(lambda: content.read(1024 * 1024), b''):
+        h.update(chunk)
+    return h.hexdigest()
+
+def as_file(content):
+    if isinstance(content, bytes):
+        return ContentFile(content)
+    # rewound for retries
+    content.seek(0)
+    return File(content)
+
+def get_size(content):
+    if isinstance(content, bytes):
+        return len(content)
+    return os.fstat(content.fileno()).st_size
+
+def close(content):
+    if not isinstance(content, bytes):
+        content.close()
+
+
+_UPLOAD_QUEUE = None
+
+def get_upload_queue():
+    global _UPLOAD_QUEUE
+    if _UPLOAD_QUEUE is None:
+        _UPLOAD_QUEUE = UploadQueue(
+            max_workers = settings.UPLOAD_WORKERS,
+            max_pending = settings.UPLOAD_MAX_PENDING,
+            retries = settings.UPLOAD_RETRIES
+        )
+    return _UPLOAD_QUEUE
+
+def upload_file(obj, filename, content):
+    return get_upload_queue().submit(obj, filename, content)
+
+def wait_for_upload(obj):
+    get_upload_queue().wait_for(obj)
+
+def wait_for_uploads():
+    get_upload_queue().wait()
+
+def count_uploaded_bytes():
+    return get_upload_queue().uploaded_bytes
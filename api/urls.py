@@ -0,0 +1,10 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('prices', views.prices, name='prices'),
+    path('variables/<str:model_name>/<int:id>', views.variable, name='variable'),
+    path('single-accounts/<int:id>', views.single_account, name='single-account'),
+    path('backtesters/<int:id>/returns', views.backtester_returns, name='backtester-returns'),
+    path('stocks/<str:stock_code>/history', views.stock_history, name='stock-history'),
+]
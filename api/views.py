@@ -0,0 +1,376 @@
+from .engines import normalize_stock_codes
+from .registry import VARIABLE_MODEL_NAMES
+from .tools import hash_records
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max, Q
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.views.decorators.http import require_safe
+from itertools import groupby
+
+import csv
+import datetime
+import io
+import json
+import numpy as np
+import re
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+# Read-only data of sources and products, filtered by
+# ?start=YYYYMMDD&end=YYYYMMDD&stock_codes=005930,000660 and rendered by ?format=json, csv or arrow.
+# Bodies are streamed and tagged by versions of their sources,
+# and are cached under the tag so that Range requests and later requests are served from the api cache.
+# A changed source changes the tag, which leaves the cached bodies of former versions unused.
+
+PRICE_FIELDS = ['open', 'high', 'low', 'close', 'ri', 'vol_n', 'vol_m', 'n_listed', 'mktcap']
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+CHUNK_ROWS = 5000
+
+
+@require_safe
+def prices(request):
+    try:
+        filters = parse_filters(request)
+        fields = request.GET['fields'].split(',') if request.GET.get('fields') else PRICE_FIELDS
+        if any([f not in PRICE_FIELDS for f in fields]):
+            raise ValueError(f"fields should be in {', '.join(PRICE_FIELDS)}.")
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    sdmodel = apps.get_model('api', 'StockDaily')
+    spmodel = apps.get_model('api', 'StockPrice')
+    # rows of a day are replaced on each load, which updates last_update of its StockPrice
+    version = filter_dates(spmodel.objects.all(), filters).aggregate(
+        Count('id'),
+        Max('last_update'),
+        normalized = Count('id', filter=Q(is_normalized=True))
+    )
+    qs = filter_dates(sdmodel.objects.all(), filters)
+    if filters['stock_codes']:
+        qs = qs.filter(stock_code__in=filters['stock_codes'])
+    columns = ['date', 'stock_code', 'market', *fields]
+
+    def get_chunks():
+        rows = qs.order_by('date', 'stock_code').values_list(*columns).iterator(chunk_size=CHUNK_ROWS)
+        for chunk in chunked(rows, CHUNK_ROWS):
+            yield [(r[0].strftime('%Y%m%d'), *r[1:]) for r in chunk]
+
+    return serve(request, 'prices', version, columns, get_chunks, filters)
+
+
+@require_safe
+def variable(request, model_name, id):
+    if model_name not in VARIABLE_MODEL_NAMES:
+        raise Http404(f"{model_name} is not a variable.")
+    try:
+        filters = parse_filters(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    obj = get_object_or_404(apps.get_model('api', model_name), id=id)
+    version = {
+        'last_update': obj.last_update,
+        'data': hash_records(list(obj.queryset.order_by('date').values_list('date', 'checksum'))),
+    }
+    qs = filter_dates(obj.queryset, filters).order_by('date').only('date', 'records', 'blob')
+    columns = ['date', 'stock_code', 'market', 'value']
+
+    def get_chunks():
+        for data in qs.iterator(chunk_size=20):
+            cols = data.get_columns()
+            if len(cols) == 0:
+                continue
+            is_kept = filter_stock_codes(cols['stock_code'], filters)
+            values = [cols[c][is_kept].tolist() for c in columns[1:]]
+            yield list(zip([data.date.strftime('%Y%m%d')] * len(values[0]), *values))
+
+    return serve(request, f"variables/{model_name}/{id}", version, columns, get_chunks, filters)
+
+
+@require_safe
+def single_account(request, id):
+    try:
+        filters = parse_filters(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    obj = get_object_or_404(apps.get_model('api', 'SingleAccountClient'), id=id)
+    if not obj.file:
+        raise Http404(f"{obj} has not been synced.")
+    # file_checksum is saved once the file of last_update is uploaded
+    version = {'last_update': obj.last_update, 'file_checksum': obj.file_checksum}
+    columns = obj.RESPONSE_PARAMETERS
+
+    def get_chunks():
+        df = obj.get_dataframe()[columns]
+        if filters['start']:
+            df = df.loc[df.date.dt.date >= filters['start']]
+        if filters['end']:
+            df = df.loc[df.date.dt.date <= filters['end']]
+        df = df.loc[filter_stock_codes(df.stock_code.to_numpy(), filters)].copy()
+        df['date'] = df.date.dt.strftime('%Y%m%d')
+        df = df.astype(object).where(df.notnull(), None)
+        yield from chunked(df.itertuples(index=False, name=None), CHUNK_ROWS)
+
+    return serve(request, f"single-accounts/{id}", version, columns, get_chunks, filters)
+
+
+@require_safe
+def backtester_returns(request, id):
+    try:
+        filters = parse_filters(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    obj = get_object_or_404(apps.get_model('api', 'Backtester'), id=id)
+    fpdmodel = apps.get_model('api', 'FactorPortfolioData')
+    qs = fpdmodel.objects.filter(portfolio__backtester=obj)
+    version = {
+        'file_checksum': obj.file_checksum,
+        'data': hash_records(list(qs.order_by('id').values_list('id', 'last_date'))),
+    }
+    # holding periods overlapping the range, from rebalancing dates to their last dates
+    if filters['end']:
+        qs = qs.filter(date__lte=filters['end'])
+    if filters['start']:
+        qs = qs.filter(last_date__gte=filters['start'])
+    columns = ['date', 'label', 'value_vw', 'value_ew']
+    start = filters['start'].strftime('%Y%m%d') if filters['start'] else None
+    end = filters['end'].strftime('%Y%m%d') if filters['end'] else None
+
+    def get_chunks():
+        labels = {pf.id: pf.label for pf in obj.get_portfolios()}
+        periods = qs.order_by('date', 'portfolio_id').iterator(chunk_size=100)
+        for date, ls_data in groupby(periods, key=lambda data: data.date):
+            rows = list()
+            for data in ls_data:
+                cols = data.get_columns()
+                dates = cols['date'].astype(str)
+                is_kept = np.ones(len(dates), dtype=bool)
+                if start:
+                    is_kept &= dates >= start
+                if end:
+                    is_kept &= dates <= end
+                rows += zip(
+                    dates[is_kept].tolist(),
+                    [labels[data.portfolio_id]] * int(is_kept.sum()),
+                    cols['value_vw'][is_kept].tolist(),
+                    cols['value_ew'][is_kept].tolist(),
+                )
+            yield sorted(rows, key=lambda r: (r[0], r[1]))
+
+    return serve(request, f"backtesters/{id}/returns", version, columns, get_chunks, filters)
+
+
+@require_safe
+def stock_history(request, stock_code):
+    try:
+        filters = parse_filters(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    ssmodel = apps.get_model('api', 'StockSeries')
+    series_keys = request.GET['series'].split(',') if request.GET.get('series') else None
+    stock_code = normalize_stock_codes([stock_code])[0]
+    qs = ssmodel.objects.filter(stock_code=stock_code)
+    if series_keys:
+        qs = qs.filter(series_key__in=series_keys)
+    version = list(qs.order_by('series_key').values_list('series_key', 'checksum'))
+    if len(version) == 0:
+        raise Http404(f"no series of {stock_code}.")
+    columns = ['series', 'date', 'value']
+    start = int(filters['start'].strftime('%Y%m%d')) if filters['start'] else None
+    end = int(filters['end'].strftime('%Y%m%d')) if filters['end'] else None
+
+    def get_chunks():
+        for series_key, cols in sorted(ssmodel.objects.get_history(stock_code, series_keys).items()):
+            is_kept = np.ones(len(cols['date']), dtype=bool)
+            if start:
+                is_kept &= cols['date'] >= start
+            if end:
+                is_kept &= cols['date'] <= end
+            dates = cols['date'][is_kept].astype(str).tolist()
+            yield list(zip([series_key] * len(dates), dates, cols['value'][is_kept].tolist()))
+
+    return serve(request, f"stocks/{stock_code}", version, columns, get_chunks, filters)
+
+
+def parse_filters(request):
+    fmt = request.GET.get('format', 'json')
+    if fmt not in CONTENT_TYPES:
+        raise ValueError(f"format should be in {', '.join(CONTENT_TYPES.keys())}.")
+    stock_codes = request.GET.get('stock_codes')
+    return {
+        'start': parse_date(request.GET.get('start')),
+        'end': parse_date(request.GET.get('end')),
+        'stock_codes': set(normalize_stock_codes(stock_codes.split(',')).tolist()) if stock_codes else None,
+        'format': fmt,
+    }
+
+def parse_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value.replace('-', ''), '%Y%m%d').date()
+    except ValueError:
+        raise ValueError(f"{value} is not a date of YYYYMMDD.")
+
+def filter_dates(qs, filters):
+    if filters['start']:
+        qs = qs.filter(date__gte=filters['start'])
+    if filters['end']:
+        qs = qs.filter(date__lte=filters['end'])
+    return qs
+
+def filter_stock_codes(stock_codes, filters):
+    if not filters['stock_codes']:
+        return np.ones(len(stock_codes), dtype=bool)
+    return np.isin(stock_codes, list(filters['stock_codes']))
+
+def chunked(rows, size):
+    chunk = list()
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+
+def serve(request, name, version, columns, get_chunks, filters):
+    fmt = filters['format']
+    if fmt == 'arrow' and pyarrow is None:
+        return HttpResponse('arrow format needs pyarrow installed.', status=406)
+    tag = hash_records({'name': name, 'version': version, 'query': sorted(request.GET.items())})
+    etag = f'"{tag}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        response['ETag'] = etag
+        return response
+
+    key = f"api-responses:{tag}"
+    body = caches['api'].get(key)
+    range_header = request.headers.get('Range')
+    if range_header and request.headers.get('If-Range', etag) != etag:
+        range_header = None
+    if range_header and body is None:
+        body = b''.join(render(fmt, columns, get_chunks()))
+        if len(body) <= settings.API_CACHE_MAX_BYTES:
+            caches['api'].set(key, body, settings.API_CACHE_TIMEOUT)
+    byte_range = parse_range(range_header, len(body)) if range_header else None
+
+    if body is None:
+        response = StreamingHttpResponse(
+            stream_to_cache(key, render(fmt, columns, get_chunks())),
+            content_type = CONTENT_TYPES[fmt]
+        )
+    elif byte_range and byte_range[0] > byte_range[1]:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{len(body)}"
+    elif byte_range:
+        start, end = byte_range
+        response = HttpResponse(body[start:end + 1], status=206, content_type=CONTENT_TYPES[fmt])
+        response['Content-Range'] = f"bytes {start}-{end}/{len(body)}"
+    else:
+        response = HttpResponse(body, content_type=CONTENT_TYPES[fmt])
+    response['ETag'] = etag
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+def parse_range(header, length):
+    # (start, end) of a single byte range, start > end if unsatisfiable,
+    # None if malformed, e.g. bytes=5-3, so that the range is ignored as of RFC 7233
+    m = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if m is None or m.groups() == ('', ''):
+        return None
+    first, last = m.groups()
+    if first and last and int(first) > int(last):
+        return None
+    if first == '':
+        return max(length - int(last), 0), length - 1
+    start = int(first)
+    end = min(int(last), length - 1) if last else length - 1
+    return (start, end) if start < length else (start, start - 1)
+
+def stream_to_cache(key, chunks):
+    # the streamed body is cached unless it is larger than API_CACHE_MAX_BYTES
+    kept = list()
+    size = 0
+    for chunk in chunks:
+        if kept is not None:
+            kept.append(chunk)
+            size += len(chunk)
+            if size > settings.API_CACHE_MAX_BYTES:
+                kept = None
+        yield chunk
+    if kept is not None:
+        caches['api'].set(key, b''.join(kept), settings.API_CACHE_TIMEOUT)
+
+
+def render(fmt, columns, chunks):
+    if fmt == 'csv':
+        return render_csv(columns, chunks)
+    if fmt == 'arrow':
+        return render_arrow(columns, chunks)
+    return render_json(columns, chunks)
+
+def clean(value):
+    # NaN is not json and is written as an empty value
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+def render_json(columns, chunks):
+    yield b'['
+    separator = ''
+    for rows in chunks:
+        if len(rows) == 0:
+            continue
+        text = ','.join([
+            json.dumps(dict(zip(columns, [clean(v) for v in row])), ensure_ascii=False, default=str)
+            for row in rows
+        ])
+        yield f"{separator}{text}".encode('utf-8')
+        separator = ','
+    yield b']'
+
+def render_csv(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows([[clean(v) for v in row] for row in rows])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def render_arrow(columns, chunks):
+    sink = io.BytesIO()
+    writer = None
+    for rows in chunks:
+        if len(rows) == 0:
+            continue
+        data = {c: list(values) for c, values in zip(columns, zip(*rows))}
+        if writer is None:
+            batch = pyarrow.RecordBatch.from_pydict(data)
+            writer = pyarrow.ipc.new_stream(sink, batch.schema)
+        else:
+            batch = pyarrow.RecordBatch.from_pydict(data, schema=writer.schema)
+        writer.write_batch(batch)
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    if writer is None:
+        writer = pyarrow.ipc.new_stream(sink, pyarrow.schema([(c, pyarrow.string()) for c in columns]))
+    writer.close()
+    yield sink.getvalue()
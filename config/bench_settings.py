@@ -0,0 +1,143 @@
+from pathlib import Path
+import datetime
+import os
+import tempfile
+
+# Settings of offline benchmarks and tests, used as
+# DJANGO_SETTINGS_MODULE=config.bench_settings python manage.py bench
+# DJANGO_SETTINGS_MODULE=config.bench_settings python manage.py test api
+# Sources are served by a local stub, so that no secrets are needed.
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+BENCH_DIR = os.environ.get('MARKETDATA_BENCH_DIR', os.path.join(tempfile.gettempdir(), 'marketdata-bench'))
+
+SECRET_KEY = 'bench'
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['127.0.0.1', 'localhost']
+
+INSTALLED_APPS = [
+    'django.contrib.admin',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django.contrib.staticfiles',
+    'api',
+]
+
+MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+]
+
+ROOT_URLCONF = 'config.urls'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCH_DIR, 'bench.sqlite3'),
+        # a file, so that threads of tests share the test database
+        'TEST': {'NAME': os.path.join(tempfile.gettempdir(), 'marketdata-test.sqlite3')},
+    }
+}
+
+LANGUAGE_CODE = 'en-us'
+
+TIME_ZONE = 'Asia/Seoul'
+
+USE_I18N = True
+
+USE_TZ = False
+
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# filesystem instead of s3
+DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+MEDIA_ROOT = os.path.join(BENCH_DIR, 'media')
+MEDIA_URL = '/media/'
+UPLOAD_WORKERS = 4
+UPLOAD_MAX_PENDING = 8
+UPLOAD_RETRIES = 0
+
+
+# sources, overridden by the address of the stub while benchmarking
+OPENAPI_URL = 'http://127.0.0.1'
+OPENDART_URL = 'http://127.0.0.1'
+OPENAPI_SERVICE_KEY_DECODED = 'bench'
+OPENAPI_SERVICE_KEY_ENCODED = 'bench'
+OPENAPI_DATA_STARTS_ON = datetime.date(year=2020, month=1, day=2)
+OPENAPI_TIMEOUT = 5
+OPENAPI_RETRIES = 5
+OPENAPI_BACKOFF = 0.1
+OPENAPI_BACKOFF_MAX = 1
+OPENAPI_DEADLINE = 30
+OPENAPI_CIRCUIT_THRESHOLD = 5
+OPENAPI_CIRCUIT_COOLDOWN = 10
+OPENAPI_CACHE_MODE = 'off'
+OPENAPI_CACHE_PREFIX = 'openapi-responses'
+OPENAPI_CACHE_RECENT_DAYS = 7
+
+OPENDART_SERVICE_KEY = 'bench'
+OPENDART_TIMEOUT = 5
+OPENDART_DOWNLOAD_DIR = os.path.join(BENCH_DIR, 'downloads')
+OPENDART_DOWNLOAD_WORKERS = 4
+OPENDART_DOWNLOAD_RETRIES = 5
+OPENDART_DOWNLOAD_CHUNK = 1024
+OPENDART_BACKOFF = 0.1
+OPENDART_BACKOFF_MAX = 1
+
+
+# products
+PORTFOLIO_DATA_STARTS_ON = datetime.date(year=2022, month=12, day=29)
+BACKTESTER_PROCESSES = 1
+
+
+# concurrency
+ADVISORY_LOCK_TIMEOUT = 600
+ADVISORY_LOCK_DIR = os.path.join(BENCH_DIR, 'locks')
+
+
+# data api
+API_CACHE_TIMEOUT = 24 * 3600
+API_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# bodies are cached on disk, shared by processes of the host and
+# bounded by MAX_ENTRIES x API_CACHE_MAX_BYTES
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BENCH_DIR, 'api-cache'),
+        'TIMEOUT': API_CACHE_TIMEOUT,
+        'OPTIONS': {'MAX_ENTRIES': 64},
+    },
+}
+
+
+STATIC_URL = 'static/'
+
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.debug',
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    },
+]
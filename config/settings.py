@@ -1,6 +1,8 @@
+from boto3.s3.transfer import TransferConfig
 from pathlib import Path
 import datetime
 import os
+import tempfile
 
 def read_secret(secret_name):
     with open(f'.secrets/{secret_name}', 'r') as f:
@@ -65,20 +67,72 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # s3
 AWS_ACCESS_KEY_ID = read_secret('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = read_secret('AWS_SECRET_ACCESS_KEY')
-DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+DEFAULT_FILE_STORAGE = 'api.storage.S3Storage'
 AWS_STORAGE_BUCKET_NAME = 'opendata-finance-kr'
+# read by api.storage.S3Storage, large objects go multipart in parts of 16MB
+AWS_S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold = 16 * 1024 * 1024,
+    multipart_chunksize = 16 * 1024 * 1024,
+    max_concurrency = 4,
+)
+UPLOAD_WORKERS = 4
+UPLOAD_MAX_PENDING = 8
+UPLOAD_RETRIES = 3
 
 
 # sources
+OPENAPI_URL = 'http://apis.data.go.kr'
+OPENDART_URL = 'https://opendart.fss.or.kr'
 OPENAPI_SERVICE_KEY_DECODED = read_secret('OPENAPI_SERVICE_KEY_DECODED')
 OPENAPI_SERVICE_KEY_ENCODED = read_secret('OPENAPI_SERVICE_KEY_ENCODED')
 OPENAPI_DATA_STARTS_ON = datetime.date(year=2020, month=1, day=2)
+OPENAPI_TIMEOUT = 30
+OPENAPI_RETRIES = 5
+OPENAPI_BACKOFF = 1.0
+OPENAPI_BACKOFF_MAX = 60
+OPENAPI_DEADLINE = 600
+OPENAPI_CIRCUIT_THRESHOLD = 5
+OPENAPI_CIRCUIT_COOLDOWN = 300
+OPENAPI_CACHE_MODE = 'cache'
+OPENAPI_CACHE_PREFIX = 'openapi-responses'
+OPENAPI_CACHE_RECENT_DAYS = 7
 
 OPENDART_SERVICE_KEY = read_secret('OPENDART_SERVICE_KEY')
+OPENDART_TIMEOUT = 60
+OPENDART_DOWNLOAD_DIR = os.path.join(tempfile.gettempdir(), 'marketdata-downloads')
+OPENDART_DOWNLOAD_WORKERS = 4
+OPENDART_DOWNLOAD_RETRIES = 5
+OPENDART_DOWNLOAD_CHUNK = 1024 * 1024
+OPENDART_BACKOFF = 1.0
+OPENDART_BACKOFF_MAX = 60
 
 
 # products
 PORTFOLIO_DATA_STARTS_ON = datetime.date(year=2022, month=12, day=29)
+BACKTESTER_PROCESSES = os.cpu_count() or 1
+
+
+# concurrency
+ADVISORY_LOCK_TIMEOUT = 3600
+ADVISORY_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'marketdata-locks')
+
+
+# data api
+API_CACHE_TIMEOUT = 24 * 3600
+API_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# bodies are cached on disk, shared by processes of the host and
+# bounded by MAX_ENTRIES x API_CACHE_MAX_BYTES
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'marketdata-api-cache'),
+        'TIMEOUT': API_CACHE_TIMEOUT,
+        'OPTIONS': {'MAX_ENTRIES': 64},
+    },
+}
 
 
 #########################